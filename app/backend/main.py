@@ -213,7 +213,10 @@ def compute_target_embeddings(target_count_df: pl.DataFrame):
     if missing_targets:
         logger.info(f"Computing embeddings for {len(missing_targets)} new targets...")
         result = embedding_model.create_embedding(ProgressList(missing_targets))
-        new_embeddings = np.stack([np.array(o['embedding']) for o in result['data']])
+        # fill a preallocated array, rather than converting each embedding and stacking copies
+        new_embeddings = np.empty((len(result['data']), len(result['data'][0]['embedding'])), dtype=np.float32)
+        for i, o in enumerate(result['data']):
+            new_embeddings[i] = o['embedding']
         
         # Create dataframe for new embeddings
         new_embeddings_df = pl.DataFrame({
@@ -0,0 +1,81 @@
+import itertools
+import time
+
+import numpy as np
+import polars as pl
+import torch
+
+from stancemining import datasets
+from stancemining.llms import Transformers
+from stancemining.prompting import ask_llm_zero_shot_stance_target
+
+def distinct_ngram_ratio(outputs, n=2):
+    """Fraction of unique word n-grams across a document's completions."""
+    ngrams = [
+        tuple(words[i:i+n])
+        for output in outputs
+        for words in [output.split()]
+        for i in range(max(len(words) - n + 1, 0))
+    ]
+    if not ngrams:
+        return 0.0
+    return len(set(ngrams)) / len(ngrams)
+
+def jaccard(a, b):
+    a, b = set(a), set(b)
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+def benchmark_sampling_method(llm, docs, sampling_method, num_samples):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    targets = ask_llm_zero_shot_stance_target(llm, docs, {'num_samples': num_samples, 'sampling_method': sampling_method})
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    duration = time.time() - start_time
+    peak_memory = torch.cuda.max_memory_allocated() / 1e9 if torch.cuda.is_available() else float('nan')
+    return targets, duration, peak_memory
+
+def main():
+    """Compare the cost and diversity of n-best target generation strategies."""
+    model_name = 'Qwen/Qwen3-1.7B'
+    dataset_name = 'vast'
+    num_docs = 200
+    sampling_methods = ['beam', 'sample', 'topk']
+    all_num_samples = [3, 5]
+
+    docs = datasets.load_dataset(dataset_name)['Text'].unique(maintain_order=True).head(num_docs).to_list()
+    llm = Transformers(model_name, model_kwargs={'device_map': 'auto', 'torch_dtype': torch.bfloat16})
+
+    results = []
+    for num_samples in all_num_samples:
+        beam_targets = None
+        for sampling_method in sampling_methods:
+            torch.manual_seed(0)
+            targets, duration, peak_memory = benchmark_sampling_method(llm, docs, sampling_method, num_samples)
+            if sampling_method == 'beam':
+                beam_targets = targets
+            results.append({
+                'sampling_method': sampling_method,
+                'num_samples': num_samples,
+                'seconds_per_doc': duration / len(docs),
+                'peak_memory_gb': peak_memory,
+                'mean_unique_targets': np.mean([len(set(t)) for t in targets]),
+                'distinct_2': np.mean([distinct_ngram_ratio(t) for t in targets]),
+                'mean_pairwise_jaccard': np.mean([
+                    np.mean([jaccard(a.split(), b.split()) for a, b in itertools.combinations(t, 2)]) if len(t) > 1 else 1.0
+                    for t in targets
+                ]),
+                'jaccard_with_beam': np.mean([jaccard(t, b) for t, b in zip(targets, beam_targets)]),
+            })
+            print(results[-1])
+
+    results_df = pl.DataFrame(results)
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(results_df)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import logging
+
+def serve(args):
+    from stancemining.main import StanceMining
+    from stancemining.serve import StanceMiningServer
+
+    model = StanceMining(
+        stance_target_type=args.stance_target_type,
+        llm_method='finetuned',
+        model_inference=args.model_inference,
+        stance_detection_model=args.stance_detection_model,
+        target_extraction_model=args.target_extraction_model,
+        embedding_model=args.embedding_model,
+        embedding_model_inference=args.embedding_model_inference,
+        verbose=args.verbose,
+    )
+    server = StanceMiningServer(
+        model,
+        host=args.host,
+        port=args.port,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    server.serve_forever()
+
+def prefetch(args):
+    from stancemining import artifacts
+
+    for path in artifacts.prefetch(args.repo_ids):
+        print(path)
+    print(f"Artifacts cached in {artifacts.get_cache_dir()}")
+
+def export_merged(args):
+    from stancemining.finetune import CLASSIFICATION_TASKS, export_merged_model
+
+    config = {'prompting_method': args.prompting_method}
+    if args.hf_model is not None:
+        config['hf_model'] = args.hf_model
+    else:
+        config['model_path'] = args.model_path
+    if args.task in CLASSIFICATION_TASKS:
+        config['classification_method'] = args.classification_method
+    else:
+        config['generation_method'] = args.generation_method
+    merged_model = export_merged_model(
+        args.task,
+        config,
+        output_path=args.output_path,
+        hub_repo_id=args.hub_repo_id,
+        update_hub_metadata=args.update_hub_metadata,
+    )
+    print(merged_model)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='stancemining')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="Keep the extraction, stance and embedding models loaded and serve them over HTTP")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--max-batch-size', type=int, default=256, help="Number of items at which a micro-batch is run without waiting")
+    serve_parser.add_argument('--max-wait-ms', type=float, default=20, help="Latency deadline for the first request in a micro-batch")
+    serve_parser.add_argument('--stance-target-type', default='noun-phrases', choices=['noun-phrases', 'claims'])
+    serve_parser.add_argument('--model-inference', default='vllm', choices=['vllm', 'transformers', 'openai-compatible'])
+    serve_parser.add_argument('--stance-detection-model', default=None)
+    serve_parser.add_argument('--target-extraction-model', default=None)
+    serve_parser.add_argument('--embedding-model', default='intfloat/multilingual-e5-small')
+    serve_parser.add_argument('--embedding-model-inference', default='vllm', choices=['vllm', 'sentence-transformers'])
+    serve_parser.add_argument('--verbose', action='store_true')
+    serve_parser.set_defaults(func=serve)
+
+    prefetch_parser = subparsers.add_parser('prefetch', help="Download models and their base models into the artifact cache, for use offline")
+    prefetch_parser.add_argument('repo_ids', nargs='+', help="HF hub repos to download")
+    prefetch_parser.set_defaults(func=prefetch, verbose=False)
+
+    export_parser = subparsers.add_parser('export-merged', help="Merge a finetuned adapter into standalone weights, and record them in the adapter's metadata")
+    export_parser.add_argument('--task', required=True, help="Task of the finetuned model, e.g. 'stance-classification' or 'topic-extraction'")
+    model_group = export_parser.add_mutually_exclusive_group(required=True)
+    model_group.add_argument('--hf-model', default=None)
+    model_group.add_argument('--model-path', default=None)
+    export_parser.add_argument('--output-path', default=None)
+    export_parser.add_argument('--classification-method', default='head', choices=['head', 'generation'])
+    export_parser.add_argument('--generation-method', default='list', choices=['list', 'beam'])
+    export_parser.add_argument('--prompting-method', default='stancemining')
+    export_parser.add_argument('--hub-repo-id', default=None, help="Hub repo to upload the merged model to")
+    export_parser.add_argument('--update-hub-metadata', action='store_true', help="Record the merged model in the metadata of the --hf-model repo")
+    export_parser.add_argument('--verbose', action='store_true')
+    export_parser.set_defaults(func=export_merged)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
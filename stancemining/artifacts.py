@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import List, Optional
+
+import huggingface_hub
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'stancemining')
+
+# weights in formats the package never loads
+IGNORE_PATTERNS = ['*.onnx', '*.gguf', '*.h5', '*.msgpack', '*.ot', 'onnx/*', 'openvino/*', 'tf_model*', 'flax_model*']
+
+_manifest_lock = threading.Lock()
+
+def get_cache_dir() -> str:
+    return os.environ.get('STANCEMINING_CACHE', DEFAULT_CACHE_DIR)
+
+def get_manifest_path() -> str:
+    return os.environ.get('STANCEMINING_MANIFEST', os.path.join(get_cache_dir(), 'manifest.json'))
+
+def is_offline() -> bool:
+    """Whether hub downloads are disabled, by `STANCEMINING_OFFLINE` or `HF_HUB_OFFLINE`."""
+    value = os.environ.get('STANCEMINING_OFFLINE', os.environ.get('HF_HUB_OFFLINE', '0'))
+    return value.strip().lower() in ['1', 'true', 'yes', 'on']
+
+def load_manifest() -> dict:
+    manifest_path = get_manifest_path()
+    if not os.path.exists(manifest_path):
+        return {'repos': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def _update_manifest(repo_id: str, entry: dict):
+    with _manifest_lock:
+        manifest = load_manifest()
+        repo_entry = manifest['repos'].setdefault(repo_id, {})
+        files = {**repo_entry.get('files', {}), **entry.get('files', {})}
+        repo_entry.update(entry)
+        if files:
+            repo_entry['files'] = files
+        manifest_path = get_manifest_path()
+        os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+        # write to a temporary file first, so readers never see a partial manifest
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(manifest_path) or '.', delete=False, suffix='.tmp') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(f.name, manifest_path)
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_directory_digest(directory: str) -> str:
+    """Get the SHA-256 digest of a directory from the relative paths and digests of its files."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            digest.update(os.path.relpath(path, directory).replace(os.sep, '/').encode())
+            digest.update(_file_digest(path).encode())
+    return digest.hexdigest()
+
+def _move_into_cache(src: str, dest: str):
+    if os.path.exists(dest):
+        # identical content is already cached
+        shutil.rmtree(src)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(src, dest)
+
+def _offline_error(repo_id: str, what: str) -> FileNotFoundError:
+    return FileNotFoundError(
+        f"{what} of '{repo_id}' is not in the artifact cache at {get_cache_dir()} and downloads are disabled. "
+        f"Run `stancemining prefetch {repo_id}` on a connected machine and copy the cache over."
+    )
+
+def resolve_model(repo_id: str, revision: Optional[str] = None) -> str:
+    """Get a local directory holding a snapshot of a HF hub repo.
+
+    Snapshots recorded in the manifest are served from the content-addressed cache without any network calls.
+    Otherwise the repo is downloaded, stored under the digest of its contents, and recorded in the manifest, unless offline.
+    Local directories are returned as is.
+    """
+    if os.path.isdir(repo_id):
+        return repo_id
+
+    entry = load_manifest()['repos'].get(repo_id, {})
+    if 'snapshot' in entry and (revision is None or entry.get('revision') == revision):
+        snapshot_path = os.path.join(get_cache_dir(), 'snapshots', entry['snapshot'])
+        if os.path.isdir(snapshot_path):
+            return snapshot_path
+        logger.warning(f"Cached snapshot of '{repo_id}' is missing from {snapshot_path}")
+
+    if is_offline():
+        raise _offline_error(repo_id, "Snapshot")
+
+    revision = huggingface_hub.model_info(repo_id, revision=revision).sha
+    logger.info(f"Downloading '{repo_id}' at revision {revision}")
+    os.makedirs(get_cache_dir(), exist_ok=True)
+    download_dir = tempfile.mkdtemp(dir=get_cache_dir(), prefix='download-')
+    huggingface_hub.snapshot_download(repo_id=repo_id, revision=revision, local_dir=download_dir, ignore_patterns=IGNORE_PATTERNS)
+    # drop download metadata, so that the digest only covers repo files
+    shutil.rmtree(os.path.join(download_dir, '.cache'), ignore_errors=True)
+
+    digest = get_directory_digest(download_dir)
+    snapshot_path = os.path.join(get_cache_dir(), 'snapshots', digest)
+    _move_into_cache(download_dir, snapshot_path)
+    _update_manifest(repo_id, {'revision': revision, 'snapshot': digest})
+    return snapshot_path
+
+def resolve_file(repo_id: str, filename: str) -> str:
+    """Get a local path to a file in a HF hub repo, downloading only that file if the repo snapshot is not cached.
+
+    Local directories are read from directly.
+    """
+    if os.path.isdir(repo_id):
+        return os.path.join(repo_id, filename)
+
+    entry = load_manifest()['repos'].get(repo_id, {})
+    if 'snapshot' in entry:
+        file_path = os.path.join(get_cache_dir(), 'snapshots', entry['snapshot'], filename)
+        if os.path.exists(file_path):
+            return file_path
+    if filename in entry.get('files', {}):
+        file_path = os.path.join(get_cache_dir(), 'files', entry['files'][filename], os.path.basename(filename))
+        if os.path.exists(file_path):
+            return file_path
+
+    if is_offline():
+        raise _offline_error(repo_id, f"File '{filename}'")
+
+    os.makedirs(get_cache_dir(), exist_ok=True)
+    download_dir = tempfile.mkdtemp(dir=get_cache_dir(), prefix='download-')
+    download_path = huggingface_hub.hf_hub_download(repo_id=repo_id, filename=filename, local_dir=download_dir)
+    digest = _file_digest(download_path)
+    file_dir = os.path.join(get_cache_dir(), 'files', digest)
+    if not os.path.exists(file_dir):
+        os.makedirs(file_dir)
+        os.replace(download_path, os.path.join(file_dir, os.path.basename(filename)))
+    shutil.rmtree(download_dir)
+    _update_manifest(repo_id, {'files': {filename: digest}})
+    return os.path.join(file_dir, os.path.basename(filename))
+
+def prefetch(repo_ids: List[str]) -> List[str]:
+    """Download snapshots of HF hub repos, and of the base models of any adapters among them, into the artifact cache."""
+    paths = []
+    for repo_id in repo_ids:
+        path = resolve_model(repo_id)
+        paths.append(path)
+        adapter_config_path = os.path.join(path, 'adapter_config.json')
+        if os.path.exists(adapter_config_path):
+            with open(adapter_config_path, 'r') as f:
+                base_model_name = json.load(f)['base_model_name_or_path']
+            paths.append(resolve_model(base_model_name))
+    return paths
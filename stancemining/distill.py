@@ -0,0 +1,214 @@
+from dataclasses import dataclass
+import json
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import huggingface_hub
+import polars as pl
+import torch
+import wandb
+
+from stancemining import prompting, utils
+from stancemining.finetune import (
+    CLASSIFICATION_TASKS,
+    DataConfig,
+    DataProcessor,
+    LoraConfig,
+    ModelConfig,
+    ModelEvaluator,
+    ModelTrainer,
+    TrainingConfig,
+    export_merged_model,
+    get_model_save_path,
+    load_parent_prompt,
+    load_prompt,
+    setup_model_and_tokenizer,
+)
+from stancemining.llms import BaseLLM
+
+logger = logging.getLogger(__name__)
+
+DISTILLED_DATASET_NAME = 'distilled'
+
+@dataclass
+class DistillationConfig:
+    """Settings for distilling a prompting LLM into the small finetuned models.
+
+    Args:
+        student_model_name: Base model of the student adapters.
+        save_model_path: Directory the student adapters and labelled data are saved in.
+        num_docs: Number of corpus documents to label with the teacher.
+        val_fraction: Fraction of labelled documents held out for validation.
+        hub_repo_prefix: If set, adapters are pushed to `{hub_repo_prefix}-{task}` on the HF hub, and registered as `hf_model` configs.
+    """
+    student_model_name: str = 'HuggingFaceTB/SmolLM2-360M-Instruct'
+    save_model_path: str = './models/distilled/'
+    num_docs: int = 5000
+    val_fraction: float = 0.1
+    seed: int = 0
+    num_epochs: int = 2
+    learning_rate: float = 1e-4
+    batch_size: int = 1
+    grad_accum_steps: int = 8
+    lora_r: int = 8
+    lora_alpha: int = 16
+    lora_dropout: float = 0.1
+    attn_implementation: str = 'flash_attention_2'
+    prompting_method: str = 'stancemining'
+    classification_method: str = 'head'
+    generation_method: str = 'list'
+    wandb_mode: str = 'disabled'
+    hub_repo_prefix: Optional[str] = None
+
+def sample_docs(docs: List[str], num_docs: int, seed: int = 0) -> List[str]:
+    """Sample unique, non-empty documents from a corpus."""
+    doc_series = pl.Series('Text', docs, dtype=pl.String).drop_nulls().unique(maintain_order=True)
+    doc_series = doc_series.filter(doc_series.str.strip_chars() != '')
+    if len(doc_series) > num_docs:
+        doc_series = doc_series.sample(num_docs, seed=seed)
+    return doc_series.to_list()
+
+def label_corpus(teacher: BaseLLM, docs: List[str], verbose: bool = False) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """Label documents with the stance targets and stances given by a prompting LLM.
+
+    Returns:
+        Target extraction data with `Text` and `Target` list columns, and stance data with `Text`, `Target` and `Stance` columns,
+        in the formats `DataProcessor` trains on.
+    """
+    targets = prompting.ask_llm_zero_shot_stance_target(teacher, docs, {'num_samples': 3})
+    target_df = pl.DataFrame({'Text': docs, 'Target': targets}, schema={'Text': pl.String, 'Target': pl.List(pl.String)})
+    target_df = target_df.with_columns(utils._filter_stance_targets(target_df['Target']).alias('Target'))\
+        .filter(pl.col('Target').list.len() > 0)\
+        .with_columns(pl.lit(DISTILLED_DATASET_NAME).alias('Dataset'))
+
+    stance_df = target_df.explode('Target')
+    stances = prompting.ask_llm_zero_shot_stance(teacher, stance_df['Text'].to_list(), stance_df['Target'].to_list(), verbose=verbose)
+    stance_df = stance_df.with_columns(pl.Series('Stance', [s.lower() for s in stances], dtype=pl.String))
+
+    logger.info(f"Teacher labelled {len(target_df)} of {len(docs)} documents with {len(stance_df)} stance targets")
+    return target_df, stance_df
+
+def _split(df: pl.DataFrame, val_fraction: float, seed: int) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    # split by document, so that no document is in both splits
+    docs = df['Text'].unique().sort()
+    val_docs = docs.sample(max(1, int(len(docs) * val_fraction)), seed=seed)
+    val_mask = pl.col('Text').is_in(val_docs.implode())
+    return df.filter(~val_mask), df.filter(val_mask)
+
+def train_student(task: str, df: pl.DataFrame, config: DistillationConfig, model_kwargs: dict = {}) -> dict:
+    """Finetune a student adapter on teacher labels, and get its finetune config.
+
+    Returns:
+        dict: Finetune kwargs for `StanceMining`, with `model_path`, or `hf_model` if pushed to the hub.
+    """
+    output_type = config.classification_method if task in CLASSIFICATION_TASKS else config.generation_method
+    model_config = ModelConfig(
+        model_name=config.student_model_name,
+        task=task,
+        classification_method=config.classification_method,
+        generation_method=config.generation_method,
+        prompt=load_prompt(task, config.prompting_method, config.generation_method),
+        parent_prompt=load_parent_prompt(task, config.prompting_method),
+        attn_implementation=config.attn_implementation,
+        lora_config=LoraConfig(r=config.lora_r, lora_alpha=config.lora_alpha, lora_dropout=config.lora_dropout)
+    )
+    training_config = TrainingConfig(
+        num_epochs=config.num_epochs,
+        batch_size=config.batch_size,
+        grad_accum_steps=config.grad_accum_steps,
+        learning_rate=config.learning_rate
+    )
+    trainer = ModelTrainer(model_config, training_config)
+    processor = DataProcessor(model_config, DataConfig(dataset_name=DISTILLED_DATASET_NAME))
+    evaluator = ModelEvaluator(task)
+    model_save_path = get_model_save_path(task, config.save_model_path, config.student_model_name, DISTILLED_DATASET_NAME, output_type)
+
+    model_kwargs = {
+        'device_map': model_config.device_map,
+        'attn_implementation': model_config.attn_implementation,
+        'torch_dtype': model_config.torch_dtype,
+        **model_kwargs
+    }
+    model, tokenizer = setup_model_and_tokenizer(model_config, model_kwargs=model_kwargs, model_name=model_config.model_name)
+    trainer.set_model_and_tokenizer(model, tokenizer)
+
+    train_df, val_df = _split(df, config.val_fraction, config.seed)
+    train_dataset = processor.process_data(train_df, model_config.classification_method, model_config.generation_method)
+    val_dataset = processor.process_data(val_df, model_config.classification_method, model_config.generation_method, train=False)
+
+    trainer.prepare_for_training()
+    wandb.init(project=f"{task}-distillation", config=vars(config), mode=config.wandb_mode)
+    try:
+        trainer.train(train_dataset, val_dataset, model_save_path, evaluator)
+    finally:
+        wandb.finish()
+
+    del trainer, model
+    torch.cuda.empty_cache()
+
+    metadata = {
+        'prompt': model_config.prompt,
+        'distillation': {'student_model_name': config.student_model_name, 'num_train': len(train_df), 'num_val': len(val_df)},
+    }
+    if model_config.parent_prompt is not None:
+        metadata['parent_prompt'] = model_config.parent_prompt
+    if task in CLASSIFICATION_TASKS:
+        metadata['classification_method'] = model_config.classification_method
+    else:
+        metadata['generation_method'] = model_config.generation_method
+    with open(os.path.join(model_save_path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    finetune_kwargs = {'prompting_method': config.prompting_method}
+    if task in CLASSIFICATION_TASKS:
+        finetune_kwargs['classification_method'] = model_config.classification_method
+    else:
+        finetune_kwargs['generation_method'] = model_config.generation_method
+
+    if task in CLASSIFICATION_TASKS and model_config.classification_method == 'head':
+        # vllm's classify engine can't load adapters, so the merged model is the one to ship
+        model_save_path = export_merged_model(task, {**finetune_kwargs, 'model_path': model_save_path}, model_kwargs=model_kwargs)
+
+    if config.hub_repo_prefix is not None:
+        repo_id = f"{config.hub_repo_prefix}-{task}"
+        huggingface_hub.create_repo(repo_id, exist_ok=True)
+        huggingface_hub.upload_folder(repo_id=repo_id, folder_path=model_save_path)
+        finetune_kwargs['hf_model'] = repo_id
+    else:
+        finetune_kwargs['model_path'] = model_save_path
+
+    return finetune_kwargs
+
+def distill(teacher: BaseLLM, docs: List[str], config: DistillationConfig = DistillationConfig(), model_kwargs: dict = {}, verbose: bool = False) -> Tuple[dict, dict]:
+    """Label a sample of a corpus with a prompting LLM, and finetune the small target extraction and stance detection models on those labels.
+
+    Labelled data is saved to `config.save_model_path`, and the teacher is unloaded before training.
+
+    Args:
+        teacher: Prompting LLM to label documents with.
+        docs: Corpus to sample documents from.
+        config: Distillation settings.
+        model_kwargs: Keyword arguments for loading the student model.
+
+    Returns:
+        Finetune kwargs for the target extraction and stance detection students, to pass to `StanceMining` as
+        `target_extraction_finetune_kwargs` and `stance_detection_finetune_kwargs`.
+    """
+    os.makedirs(config.save_model_path, exist_ok=True)
+    sampled_docs = sample_docs(docs, config.num_docs, seed=config.seed)
+    target_df, stance_df = label_corpus(teacher, sampled_docs, verbose=verbose)
+    target_df.write_parquet(os.path.join(config.save_model_path, 'target_extraction_labels.parquet'))
+    stance_df.write_parquet(os.path.join(config.save_model_path, 'stance_labels.parquet'))
+    if hasattr(teacher, 'unload_model'):
+        teacher.unload_model()
+
+    target_extraction_finetune_kwargs = train_student('topic-extraction', target_df, config, model_kwargs=model_kwargs)
+    stance_detection_finetune_kwargs = train_student('stance-classification', stance_df, config, model_kwargs=model_kwargs)
+
+    with open(os.path.join(config.save_model_path, 'distilled_models.json'), 'w') as f:
+        json.dump({
+            'target_extraction_finetune_kwargs': target_extraction_finetune_kwargs,
+            'stance_detection_finetune_kwargs': stance_detection_finetune_kwargs,
+        }, f, indent=2)
+    return target_extraction_finetune_kwargs, stance_detection_finetune_kwargs
@@ -9,7 +9,6 @@ from gpytorch.constraints import Interval, Positive
 from gpytorch.likelihoods.likelihood_list import _get_tuple_args_, LikelihoodList
 from gpytorch.mlls import VariationalELBO, MarginalLogLikelihood
 from gpytorch.utils.generic import length_safe_zip
-import huggingface_hub
 from linear_operator.utils.errors import NotPSDError
 import numba
 import numpy as np
@@ -22,6 +21,7 @@ import torch
 from torch.utils.data import TensorDataset, DataLoader
 from tqdm import tqdm
 
+from stancemining import artifacts
 from stancemining.finetune import STANCE_LABELS_2_ID
 from stancemining.main import logger
 
@@ -870,7 +870,7 @@ def _get_classifier_profiles(
         confusion_matrix=None
     ):
     if confusion_matrix is None:
-        file_path = huggingface_hub.hf_hub_download(repo_id=model_name, filename='metadata.json')
+        file_path = artifacts.resolve_file(model_name, 'metadata.json')
         with open(file_path, 'r') as f:
             metadata = json.load(f)
 
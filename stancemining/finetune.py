@@ -1,11 +1,14 @@
 from collections.abc import Iterable
 from dataclasses import dataclass, field
+import functools
 import gc
 import json
+import logging
 import multiprocessing
 import os
 import pathlib
 import re
+import string
 from typing import Optional, Dict, List, Any, Union
 
 import accelerate
@@ -23,12 +26,18 @@ import tqdm
 import transformers
 import wandb
 
+import stancemining.artifacts
 import stancemining.datasets
 import stancemining.metrics
 
+logger = logging.getLogger(__name__)
+
 CLASSIFICATION_TASKS = ['stance-classification', 'argument-classification', 'claim-entailment-2way', 'claim-entailment-3way', 'claim-entailment-4way', 'claim-entailment-5way', 'claim-entailment-7way']
 GENERATION_TASKS = ['topic-extraction', 'claim-extraction']
 
+# first line of a parent chain whose most distant parents were dropped to fit the prompt budget
+OMITTED_PARENTS_FORMAT = "[… {} earlier posts omitted]"
+
 def load_split_data(dataset_name: str, split: str, task: str, generation_method: str) -> pl.DataFrame:
     return stancemining.datasets.load_dataset(
         dataset_name, 
@@ -173,6 +182,7 @@ def stance_example_to_prompt(examples, i, prompt_template: str, parent_prompt_te
         context = examples['context'][i]
     else:
         context = None
+    num_omitted = examples['omittedparents'][i] if 'omittedparents' in examples else 0
     kwargs = {
         'target': target,
         'text': text,
@@ -180,9 +190,13 @@ def stance_example_to_prompt(examples, i, prompt_template: str, parent_prompt_te
     if context:
         kwargs['context'] = context
         prompt_template = context_prompt_template
-    elif parenttexts and len(parenttexts) > 0:
+    elif (parenttexts and len(parenttexts) > 0) or num_omitted:
         parent_chain = []
-        for i, p_text in enumerate(parenttexts):
+        # dropped parents are marked even when none are kept
+        if num_omitted:
+            parent_chain.append(OMITTED_PARENTS_FORMAT.format(num_omitted))
+        # kept parents keep their position in the full thread
+        for i, p_text in enumerate(parenttexts or [], start=num_omitted):
             if i == 0:
                 parent_chain.append(f"1. [Original Post]: '{p_text}'")
             else:
@@ -222,7 +236,9 @@ def stance_target_examples_to_prompt(prompt_template: str, examples):
         prompts.append(prompt)
     return prompts
 
-def to_message_format(text, label=None, system_message="You are a helpful assistant."):
+DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant."
+
+def to_message_format(text, label=None, system_message=DEFAULT_SYSTEM_MESSAGE):
     messages = [
         {"role": "system", "content": system_message},
         {"role": "user", "content": text},
@@ -231,6 +247,33 @@ def to_message_format(text, label=None, system_message="You are a helpful assist
         messages.append({"role": "assistant", "content": label})
     return messages
 
+def template_to_expr(template: str, fields: Dict[str, pl.Expr]) -> pl.Expr:
+    """Compile a `str.format` template into a polars string expression.
+
+    Args:
+        template: Template with plain `{field}` placeholders, format specs and conversions are not supported.
+        fields: Expression to substitute for each field name.
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+        if literal:
+            parts.append(pl.lit(literal))
+        if field_name is not None:
+            assert not format_spec and not conversion, f"Unsupported placeholder in template: {{{field_name}}}"
+            if field_name not in fields:
+                raise KeyError(field_name)
+            parts.append(fields[field_name].cast(pl.String))
+    if not parts:
+        return pl.lit('')
+    return pl.concat_str(parts)
+
+def messages_expr(text: pl.Expr, system_message=DEFAULT_SYSTEM_MESSAGE) -> pl.Expr:
+    """Polars equivalent of `to_message_format`, giving a list of role/content structs per row."""
+    return pl.concat_list([
+        pl.struct(role=pl.lit('system'), content=pl.lit(system_message)),
+        pl.struct(role=pl.lit('user'), content=text),
+    ])
+
 def activate_neftune(model, accelerator, neftune_noise_alpha):
     r"""
     Activates the neftune as presented in this code: https://github.com/neelsjain/NEFTune and paper:
@@ -500,10 +543,16 @@ class DataProcessor:
         self.model_config = model_config
         self.data_config = data_config
         
-    def process_data(self, df: pd.DataFrame, classification_method: str, generation_method: str, train: bool = True, tokenize=True, truncate_beyond=None) -> datasets.Dataset:
-        """Process dataframe into a format suitable for model input"""
+    def process_data(self, df: pd.DataFrame, classification_method: str, generation_method: str, train: bool = True, tokenize=True, max_prompt_tokens=None) -> datasets.Dataset:
+        """Process dataframe into a format suitable for model input.
+
+        If `max_prompt_tokens` is set, parent texts are truncated so that stance prompts fit within that many tokens of the model config's tokenizer.
+        """
+        self.truncation_report = None
         if self.model_config.task in CLASSIFICATION_TASKS:
             df = self._process_stance_classification(df, classification_method)
+            if max_prompt_tokens is not None and 'parenttexts' in df.columns:
+                df = self._truncate_parent_texts(df, max_prompt_tokens)
         elif self.model_config.task in GENERATION_TASKS:
             df = self._process_topic_extraction(df, generation_method)
         else:
@@ -532,6 +581,81 @@ class DataProcessor:
             **loader_kwargs
         )
     
+    def render_messages(self, df: pl.DataFrame, classification_method: str, generation_method: str, max_prompt_tokens=None) -> pl.DataFrame:
+        """Render inference prompts as chat messages with polars string expressions.
+
+        Equivalent to `process_data(..., train=False, tokenize=False)` followed by `to_message_format`, 
+        but renders column-wise instead of through `datasets.Dataset.map` and per-row Python callbacks.
+        Returns the processed dataframe with an added `messages` column.
+        """
+        self.truncation_report = None
+        if self.model_config.task in CLASSIFICATION_TASKS:
+            df = self._process_stance_classification(df, classification_method)
+            if max_prompt_tokens is not None and 'parenttexts' in df.columns:
+                df = self._truncate_parent_texts(df, max_prompt_tokens)
+            df, text = self._stance_prompt_expr(df)
+        elif self.model_config.task in GENERATION_TASKS:
+            df = self._process_topic_extraction(df, generation_method)
+            text = template_to_expr(self.model_config.prompt, {'text': pl.col('text')})
+        else:
+            raise ValueError(f"Unknown task: {self.model_config.task}")
+
+        df = df.with_columns(messages_expr(text).alias('messages'))
+        if 'parent_chain' in df.columns:
+            df = df.drop('parent_chain')
+        return df
+
+    def _stance_prompt_expr(self, df: pl.DataFrame):
+        """Get the prompt expression for stance rows, choosing the context, parent or plain template per row like `stance_example_to_prompt`."""
+        for template in [self.model_config.prompt, self.model_config.parent_prompt, self.model_config.context_prompt]:
+            assert template is None or isinstance(template, str), "Only string prompt templates can be rendered with polars"
+        fields = {
+            'text': pl.col('text'),
+            'target': pl.col('topic'),
+        }
+        text = template_to_expr(self.model_config.prompt, fields)
+
+        if 'parenttexts' in df.columns:
+            df = df.with_row_index('row_idx')
+            parent_chain_df = df.select(['row_idx', 'parenttexts'] + (['omittedparents'] if 'omittedparents' in df.columns else []))\
+                .explode('parenttexts')\
+                .drop_nulls('parenttexts')
+            if 'omittedparents' not in parent_chain_df.columns:
+                parent_chain_df = parent_chain_df.with_columns(pl.lit(0, dtype=pl.Int64).alias('omittedparents'))
+            # kept parents keep their position in the full thread
+            parent_chain_df = parent_chain_df\
+                .with_columns((pl.int_range(pl.len()).over('row_idx') + pl.col('omittedparents')).alias('parent_idx'))\
+                .with_columns(
+                    pl.when(pl.col('parent_idx') == 0)
+                        .then(pl.format("1. [Original Post]: '{}'", pl.col('parenttexts')))
+                        .otherwise(pl.format("{}. [Reply to {}]: '{}'", pl.col('parent_idx') + 1, pl.col('parent_idx'), pl.col('parenttexts')))
+                        .alias('line')
+                )\
+                .group_by('row_idx', maintain_order=True)\
+                .agg(pl.col('line').str.join('\n').alias('parent_chain'))
+            df = df.join(parent_chain_df, on='row_idx', how='left', maintain_order='left').drop('row_idx')
+            if 'omittedparents' in df.columns:
+                # dropped parents are marked even when none are kept
+                df = df.with_columns(
+                    pl.when(pl.col('omittedparents') > 0)
+                        .then(pl.concat_str([pl.format(OMITTED_PARENTS_FORMAT, pl.col('omittedparents')), pl.col('parent_chain')], separator='\n', ignore_nulls=True))
+                        .otherwise(pl.col('parent_chain'))
+                        .alias('parent_chain')
+                )
+            if df['parent_chain'].is_not_null().any():
+                assert self.model_config.parent_prompt is not None, "Parent prompt must be set to render prompts with parent texts"
+                parent_text = template_to_expr(self.model_config.parent_prompt, {**fields, 'parent_chain': pl.col('parent_chain')})
+                text = pl.when(pl.col('parent_chain').is_not_null()).then(parent_text).otherwise(text)
+
+        if 'context' in df.columns:
+            has_context = pl.col('context').is_not_null() & (pl.col('context') != '')
+            if df.select(has_context.any()).item():
+                assert self.model_config.context_prompt is not None, "Context prompt must be set to render prompts with context"
+                context_text = template_to_expr(self.model_config.context_prompt, {**fields, 'context': pl.col('context')})
+                text = pl.when(has_context).then(context_text).otherwise(text)
+
+        return df, text
+
     def _process_stance_classification(self, df: pl.DataFrame, classification_method: str) -> pl.DataFrame:
         cols = ['text', 'topic']
         df = df.rename({
@@ -555,6 +679,87 @@ class DataProcessor:
             cols.append('context')
         return df.select(cols)
     
+    def _truncate_parent_texts(self, df: pl.DataFrame, max_prompt_tokens: int) -> pl.DataFrame:
+        """Truncate parent texts so that prompts fit within a token budget.
+
+        The most distant parent texts are dropped first, and the document text and target are always kept intact.
+        The number of dropped parent texts is stored in an `omittedparents` column, which prompts mark in place of the dropped parents.
+        If the nearest parent text alone does not fit, it is cut to the remaining budget.
+        A summary of what was cut is stored in `self.truncation_report`.
+        """
+        tokenizer = self.model_config.tokenizer
+        assert tokenizer is not None, "Model config must have a tokenizer to truncate prompts by tokens"
+        assert isinstance(self.model_config.parent_prompt, str), "Parent prompt must be a string to truncate prompts by tokens"
+
+        def num_tokens(texts):
+            return pl.Series([len(ids) for ids in tokenizer(texts, add_special_tokens=False)['input_ids']], dtype=pl.Int64)
+
+        # tokens used by the chat template, prompt instructions and the parent chain numbering
+        empty_prompt = self.model_config.parent_prompt.format(text='', target='', parent_chain='')
+        overhead_tokens = len(tokenizer.apply_chat_template(to_message_format(empty_prompt), add_generation_prompt=True, tokenize=True))
+        line_tokens = len(tokenizer.encode("10. [Reply to 9]: ''\n", add_special_tokens=False))
+        omitted_tokens = len(tokenizer.encode(OMITTED_PARENTS_FORMAT.format(99) + "\n", add_special_tokens=False))
+
+        df = df.with_row_index('row_idx')
+        parent_df = df.select(['row_idx', 'parenttexts']).explode('parenttexts').drop_nulls('parenttexts')
+        if len(parent_df) == 0:
+            self.truncation_report = {'num_prompts_truncated': 0, 'num_parent_texts_dropped': 0, 'num_parent_tokens_cut': 0}
+            return df.drop('row_idx').with_columns(pl.lit(0, dtype=pl.Int64).alias('omittedparents'))
+
+        budget_df = df.select([
+            pl.col('row_idx'),
+            (max_prompt_tokens - overhead_tokens - num_tokens(df['text'].to_list()) - num_tokens(df['topic'].to_list())).alias('budget')
+        ])
+        parent_token_ids = tokenizer(parent_df['parenttexts'].to_list(), add_special_tokens=False)['input_ids']
+        parent_df = parent_df.with_columns(pl.Series('num_tokens', [len(ids) for ids in parent_token_ids], dtype=pl.Int64))\
+            .with_row_index('parent_row')\
+            .with_columns(pl.int_range(pl.len()).over('row_idx').alias('parent_idx'))\
+            .join(budget_df, on='row_idx', how='left', maintain_order='left')\
+            .with_columns((pl.col('num_tokens') + line_tokens).cum_sum(reverse=True).over('row_idx').alias('kept_tokens'))\
+            .with_columns(
+                # distant parents of threads over budget are dropped, so leave room to mark them
+                pl.when((pl.len().over('row_idx') > 1) & (pl.col('kept_tokens').max().over('row_idx') > pl.col('budget')))
+                    .then(pl.col('budget') - omitted_tokens)
+                    .otherwise(pl.col('budget'))
+                    .alias('budget')
+            )\
+            .with_columns([
+                (pl.col('kept_tokens') <= pl.col('budget')).alias('keep'),
+                ((pl.col('parent_idx') == pl.col('parent_idx').max().over('row_idx')) & (pl.col('kept_tokens') > pl.col('budget')) & (pl.col('budget') > line_tokens)).alias('cut')
+            ])
+
+        cut_df = parent_df.filter(pl.col('cut'))
+        dropped_df = parent_df.filter(~pl.col('keep') & ~pl.col('cut'))
+        cut_texts = [
+            tokenizer.decode(parent_token_ids[parent_row][:budget - line_tokens])
+            for parent_row, budget in cut_df.select(['parent_row', 'budget']).rows()
+        ]
+        cut_df = cut_df.with_columns(pl.Series('parenttexts', cut_texts, dtype=pl.String))
+
+        self.truncation_report = {
+            'num_prompts_truncated': parent_df.filter(~pl.col('keep'))['row_idx'].n_unique(),
+            'num_parent_texts_dropped': len(dropped_df),
+            'num_parent_tokens_cut': int(dropped_df['num_tokens'].sum() 
+                                         + (cut_df['num_tokens'] - (cut_df['budget'] - line_tokens)).sum())
+        }
+        if self.truncation_report['num_prompts_truncated'] > 0:
+            logger.info(
+                f"Truncated parent texts of {self.truncation_report['num_prompts_truncated']} prompts to fit {max_prompt_tokens} tokens, "
+                f"dropping {self.truncation_report['num_parent_texts_dropped']} parent texts and {self.truncation_report['num_parent_tokens_cut']} tokens"
+            )
+
+        parent_df = pl.concat([parent_df.filter(pl.col('keep')), cut_df], how='vertical_relaxed')\
+            .sort(['row_idx', 'parent_idx'])\
+            .group_by('row_idx', maintain_order=True)\
+            .agg(pl.col('parenttexts'))
+        omitted_df = dropped_df.group_by('row_idx')\
+            .agg(pl.len().cast(pl.Int64).alias('omittedparents'))
+        return df.drop('parenttexts')\
+            .join(parent_df, on='row_idx', how='left', maintain_order='left')\
+            .join(omitted_df, on='row_idx', how='left', maintain_order='left')\
+            .with_columns(pl.col('parenttexts').fill_null([]), pl.col('omittedparents').fill_null(0))\
+            .drop('row_idx')
+
     def _process_topic_extraction(self, df: pl.DataFrame, generation_method: str) -> pl.DataFrame:
         if 'Text' in df.columns and 'text' not in df.columns:
             df = df.rename({"Text": "text"})
@@ -1039,7 +1244,7 @@ def setup_model_and_tokenizer(model_config: ModelConfig, model_kwargs={}, model_
 
     if model_config.task in CLASSIFICATION_TASKS:
         if model_config.classification_method == 'head':
-            if model_save_path and not full_saved_model:
+            if model_save_path and not full_saved_model and is_adapter(model_save_path):
                 create_fn = peft.AutoPeftModelForSequenceClassification.from_pretrained
             else:
                 create_fn = transformers.AutoModelForSequenceClassification.from_pretrained
@@ -1049,7 +1254,7 @@ def setup_model_and_tokenizer(model_config: ModelConfig, model_kwargs={}, model_
                 **model_kwargs
             )
         elif model_config.classification_method == 'generation':
-            if model_save_path:
+            if model_save_path and is_adapter(model_save_path):
                 create_fn = peft.AutoPeftModelForCausalLM.from_pretrained
             else:
                 create_fn = transformers.AutoModelForCausalLM.from_pretrained
@@ -1071,7 +1276,7 @@ def setup_model_and_tokenizer(model_config: ModelConfig, model_kwargs={}, model_
             model.generation_config.pad_token_id = tokenizer.pad_token_id
 
     elif model_config.task in GENERATION_TASKS:
-        if model_save_path:
+        if model_save_path and is_adapter(model_save_path):
             create_fn = peft.AutoPeftModelForCausalLM.from_pretrained
         else:
             create_fn = transformers.AutoModelForCausalLM.from_pretrained
@@ -1089,7 +1294,149 @@ def setup_model_and_tokenizer(model_config: ModelConfig, model_kwargs={}, model_
         
     return model, tokenizer
 
-def get_prediction(inputs, task, model, tokenizer, classification_method, generation_method, generate_kwargs={}):
+def parse_list_completions(completions):
+    return [re.findall('"(.*?)"', c) for c in completions] 
+
+QUOTED_LIST_MAX_ITEMS = 10
+
+def get_quoted_list_regex(max_items=QUOTED_LIST_MAX_ITEMS, max_item_chars=200):
+    """Get a regex matching the quoted, comma-separated list format, e.g. `"target1", "target2"`, or an empty list."""
+    item = f'"[^"\\n]{{1,{max_item_chars}}}"'
+    return f'({item}(, {item}){{0,{max_items - 1}}})?'
+
+# character level states of the quoted list format
+_LIST_START, _ITEM_START, _IN_ITEM, _AFTER_ITEM, _AFTER_COMMA, _AFTER_SPACE, _LIST_DONE = range(7)
+_LIST_STATE_TRANSITIONS = {
+    _LIST_START: lambda c: _ITEM_START if c == '"' else -1,
+    _ITEM_START: lambda c: _IN_ITEM if c not in '"\n' else -1,
+    _IN_ITEM: lambda c: _AFTER_ITEM if c == '"' else (-1 if c == '\n' else _IN_ITEM),
+    _AFTER_ITEM: lambda c: _AFTER_COMMA if c == ',' else -1,
+    _AFTER_COMMA: lambda c: _AFTER_SPACE if c == ' ' else -1,
+    _AFTER_SPACE: lambda c: _ITEM_START if c == '"' else -1,
+    _LIST_DONE: lambda c: -1,
+}
+_quoted_list_transition_cache = {}
+
+@functools.cache
+def _get_token_list_transitions(token: str) -> tuple:
+    """Get the state reached from each state by the characters of a decoded token, or -1 if they break the list format, and the number of list items they close."""
+    transitions = []
+    for state in range(len(_LIST_STATE_TRANSITIONS)):
+        current, closed = state, 0
+        for c in token:
+            current = _LIST_STATE_TRANSITIONS[current](c)
+            if current == -1:
+                closed = 0
+                break
+            closed += int(current == _AFTER_ITEM)
+        transitions.append((current, closed))
+    return tuple(transitions)
+
+def _get_quoted_list_transitions(tokenizer, eos_token_ids):
+    """Get the state reached from each state by each token, and the number of list items each token closes.
+
+    Transitions are cached per tokenizer name or path, and per decoded token, so the list grammar is walked once for each distinct token string.
+    """
+    cache_key = (tokenizer.name_or_path, len(tokenizer), tuple(eos_token_ids))
+    if cache_key in _quoted_list_transition_cache:
+        return _quoted_list_transition_cache[cache_key]
+
+    num_states = len(_LIST_STATE_TRANSITIONS)
+    tokens = tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
+    # (vocab, state, 2) array of next states and closed items
+    transitions = np.array([_get_token_list_transitions(token) for token in tokens], dtype=np.int64).reshape(len(tokenizer), num_states, 2)
+    next_states = np.ascontiguousarray(transitions[:, :, 0].T)
+    num_closed = np.ascontiguousarray(transitions[:, :, 1].T)
+    # special and empty tokens never continue the list
+    blocked_ids = list(tokenizer.all_special_ids) + [token_id for token_id, token in enumerate(tokens) if len(token) == 0]
+    next_states[:, blocked_ids] = -1
+    num_closed[:, blocked_ids] = 0
+    # the list can end when empty or after an item, and stays finished while the batch is padded
+    for token_id in eos_token_ids:
+        next_states[[_LIST_START, _AFTER_ITEM, _LIST_DONE], token_id] = _LIST_DONE
+
+    _quoted_list_transition_cache[cache_key] = (torch.from_numpy(next_states), torch.from_numpy(num_closed))
+    return _quoted_list_transition_cache[cache_key]
+
+class QuotedListLogitsProcessor(transformers.LogitsProcessor):
+    """Constrain generation to the quoted, comma-separated list format of the list generation method.
+
+    The end of sequence token is only allowed once the list is empty or an item is closed,
+    and is the only option once `max_items` items have been generated.
+    State is recomputed from the generated tokens at each step, so beam reordering is handled.
+    """
+    def __init__(self, tokenizer, prompt_length, eos_token_ids, max_items=QUOTED_LIST_MAX_ITEMS):
+        self.next_states, self.num_closed = _get_quoted_list_transitions(tokenizer, eos_token_ids)
+        self.prompt_length = prompt_length
+        self.max_items = max_items
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.next_states.device != scores.device or self.next_states.shape[1] < scores.shape[1]:
+            # model vocab can be padded beyond the tokenizer vocab
+            padding = scores.shape[1] - self.next_states.shape[1]
+            self.next_states = torch.nn.functional.pad(self.next_states, (0, max(padding, 0)), value=-1).to(scores.device)
+            self.num_closed = torch.nn.functional.pad(self.num_closed, (0, max(padding, 0)), value=0).to(scores.device)
+        
+        states = torch.full((input_ids.shape[0],), _LIST_START, dtype=torch.long, device=scores.device)
+        num_items = torch.zeros_like(states)
+        for i in range(self.prompt_length, input_ids.shape[1]):
+            num_items += self.num_closed[states, input_ids[:, i]]
+            states = self.next_states[states, input_ids[:, i]]
+
+        next_states = self.next_states[states, :scores.shape[1]]
+        total_items = num_items[:, None] + self.num_closed[states, :scores.shape[1]]
+        can_end = (next_states == _AFTER_ITEM) | (next_states == _LIST_DONE)
+        allowed = (next_states >= 0) & ((total_items < self.max_items) | ((total_items == self.max_items) & can_end))
+        return scores.masked_fill(~allowed, -float('inf'))
+
+def get_label_token_ids(tokenizer, labels, prompt_text=None):
+    """Get the token ids of each label.
+
+    Without `prompt_text`, labels are tokenized as the start of an assistant response, as in training.
+    With a rendered `prompt_text`, labels are tokenized together with the prompt as its continuation, 
+    so that tokens merged across the boundary match what the model would generate.
+    """
+    if prompt_text is None:
+        return [tokenizer.encode(label, add_special_tokens=False) for label in labels]
+    prompt_ids = tokenizer.encode(prompt_text, add_special_tokens=False)
+    label_token_ids = []
+    for label in labels:
+        # chat templates strip trailing whitespace from continued messages
+        continuation = label if prompt_text[-1].isspace() else f" {label}"
+        token_ids = tokenizer.encode(prompt_text + continuation, add_special_tokens=False)
+        if token_ids[:len(prompt_ids)] == prompt_ids:
+            token_ids = token_ids[len(prompt_ids):]
+        else:
+            token_ids = tokenizer.encode(continuation, add_special_tokens=False)
+        label_token_ids.append(token_ids)
+    return label_token_ids
+
+def score_label_logits(model, inputs, label_token_ids):
+    """Get label probabilities for a batch of left padded prompts without decoding.
+
+    Labels are scored from the next token logits of their first token in a single forward pass.
+    If labels share a first token, each label's full token sequence is scored instead.
+    """
+    first_token_ids = [ids[0] for ids in label_token_ids]
+    if len(set(first_token_ids)) < len(first_token_ids):
+        return _score_label_sequences(model, inputs, label_token_ids)
+    logits = model(**inputs, logits_to_keep=1).logits[:, -1, :]
+    return torch.softmax(logits[:, first_token_ids].float(), dim=-1)
+
+def _score_label_sequences(model, inputs, label_token_ids):
+    batch_size = inputs['input_ids'].shape[0]
+    label_log_probs = []
+    for token_ids in label_token_ids:
+        label_ids = torch.tensor(token_ids, device=inputs['input_ids'].device).unsqueeze(0).expand(batch_size, -1)
+        input_ids = torch.cat([inputs['input_ids'], label_ids], dim=1)
+        attention_mask = torch.cat([inputs['attention_mask'], torch.ones_like(label_ids)], dim=1)
+        # keep logits from the last prompt token onwards, which predict the label tokens
+        logits = model(input_ids=input_ids, attention_mask=attention_mask, logits_to_keep=len(token_ids) + 1).logits[:, :-1]
+        token_log_probs = torch.log_softmax(logits.float(), dim=-1).gather(-1, label_ids.unsqueeze(-1)).squeeze(-1)
+        label_log_probs.append(token_log_probs.sum(dim=-1))
+    return torch.softmax(torch.stack(label_log_probs, dim=-1), dim=-1)
+
+def get_prediction(inputs, task, model, tokenizer, classification_method, generation_method, generate_kwargs={}, scoring_method='generate', guided_decoding=False):
     """Get model predictions"""
     if task in CLASSIFICATION_TASKS:
         if classification_method == 'head':
@@ -1111,6 +1458,13 @@ def get_prediction(inputs, task, model, tokenizer, classification_method, genera
                     "attention_mask": inputs["attention_mask"],
                 }
             prompt = {k: v.to(model.device) for k, v in prompt.items()}
+            if scoring_method == 'logits':
+                _, labels2id = get_labels_2_id(task)
+                labels = sorted(labels2id, key=labels2id.get)
+                probs = score_label_logits(model, prompt, get_label_token_ids(tokenizer, labels))
+                return [labels[i] for i in torch.argmax(probs, dim=-1).cpu().tolist()]
+            elif scoring_method != 'generate':
+                raise ValueError(f"Unknown scoring method: {scoring_method}")
             if 'max_new_tokens' not in generate_kwargs:
                 generate_kwargs['max_new_tokens'] = 1
             outputs = model.generate(**prompt, **generate_kwargs)
@@ -1144,6 +1498,11 @@ def get_prediction(inputs, task, model, tokenizer, classification_method, genera
         if 'stop_strings' not in generate_kwargs:
             generate_kwargs['stop_strings'] = ['\n', '<|endoftext|>', '<|im_end|>']
             generate_kwargs['tokenizer'] = tokenizer
+        if guided_decoding and generation_method == 'list':
+            eos_token_ids = model.generation_config.eos_token_id
+            eos_token_ids = eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids]
+            logits_processor = QuotedListLogitsProcessor(tokenizer, prompt['input_ids'].shape[1], eos_token_ids)
+            generate_kwargs = {**generate_kwargs, 'logits_processor': transformers.LogitsProcessorList([logits_processor])}
         outputs = model.generate(**prompt, **generate_kwargs)
         completions = [tokenizer.decode(
             output[prompt['input_ids'].shape[1]:],
@@ -1163,41 +1522,194 @@ def get_prediction(inputs, task, model, tokenizer, classification_method, genera
         raise ValueError("Task not found")
             
 
-def get_predictions(task, df, config, model_kwargs={}, generate_kwargs={}):
-    
+def get_prediction_probs(inputs, task, model, tokenizer, classification_method):
+    """Get label probabilities of a classification model, with labels in `labels2id` order."""
+    assert task in CLASSIFICATION_TASKS, "Label probabilities are only available for classification tasks"
+    inputs = {k: inputs[k].to(model.device) for k in ['input_ids', 'attention_mask']}
+    if classification_method == 'head':
+        return torch.softmax(model(**inputs).logits.float(), dim=-1)
+    elif classification_method == 'generation':
+        _, labels2id = get_labels_2_id(task)
+        labels = sorted(labels2id, key=labels2id.get)
+        return score_label_logits(model, inputs, get_label_token_ids(tokenizer, labels))
+    else:
+        raise ValueError(f"Unknown classification method: {classification_method}")
+
+def load_finetuned_prompts(task, config):
+    """Get the save path and prompts for a finetuned model config.
+
+    Models on the HF hub store their prompts in `metadata.json`, local models use the prompts bundled with the package.
+    Hub models are resolved to a local snapshot in the artifact cache, see `stancemining.artifacts.resolve_model`.
+    If the model's `metadata.json` records a merged export, see `export_merged_model`, its path is returned instead, 
+    unless `config['use_merged']` is False.
+    """
     output_type = config['classification_method'] if task in CLASSIFICATION_TASKS else config['generation_method']
     if 'hf_model' in config:
-        model_save_path = config['hf_model']
-        file_path = huggingface_hub.hf_hub_download(repo_id=model_save_path, filename='metadata.json')
-        with open(file_path, 'r') as f:
+        model_save_path = stancemining.artifacts.resolve_model(config['hf_model'])
+        with open(os.path.join(model_save_path, 'metadata.json'), 'r') as f:
             metadata = json.load(f)
         prompt = metadata['prompt']
         parent_prompt = metadata['parent_prompt'] if 'parent_prompt' in metadata else None
     else:
-        model_save_path = config['model_path']
+        if 'data_name' in config:
+            model_save_path = get_model_save_path(task, config['save_model_path'], config['model_name'], config['data_name'], output_type)
+        else:
+            model_save_path = config['model_path']
         prompt = load_prompt(task, config['prompting_method'], generation_method=config['generation_method'] if 'generation_method' in config else None)
         parent_prompt = load_parent_prompt(task, prompting_method=config['prompting_method'])
+        metadata_path = os.path.join(model_save_path, 'metadata.json')
+        metadata = {}
+        if os.path.exists(metadata_path):
+            with open(metadata_path, 'r') as f:
+                metadata = json.load(f)
+
+    if 'merged_model' in metadata and config.get('use_merged', True):
+        model_save_path = stancemining.artifacts.resolve_model(metadata['merged_model'])
+    return model_save_path, prompt, parent_prompt
+
+def is_adapter(model_save_path: str) -> bool:
+    """Whether a saved model is a peft adapter, rather than standalone weights."""
+    return os.path.exists(os.path.join(model_save_path, 'adapter_config.json'))
+
+def export_merged_model(task, config, output_path=None, model_kwargs={}, hub_repo_id=None, update_hub_metadata=False) -> str:
+    """Merge a finetuned adapter, and its classification head, into standalone weights that load without peft or LoRA kernels.
+
+    The merged model is recorded as `merged_model` in the adapter's `metadata.json`, so that `load_finetuned_prompts` prefers it.
+    For hub adapters, the updated metadata is only uploaded if `update_hub_metadata` is set.
+
+    Args:
+        task: Task of the finetuned model.
+        config: Finetuned model config, as passed to `get_predictions`.
+        output_path: Directory to save the merged model to. Defaults to the adapter path, or hub repo name, with a `-merged` suffix.
+        model_kwargs: Keyword arguments for loading the adapter.
+        hub_repo_id: If set, the merged model is uploaded to this hub repo, and recorded by its repo id.
+
+    Returns:
+        str: Path or hub repo id of the merged model.
+    """
+    model_save_path, prompt, parent_prompt = load_finetuned_prompts(task, {**config, 'use_merged': False})
+    assert is_adapter(model_save_path), f"{model_save_path} is not an adapter, so has nothing to merge"
+    if output_path is None:
+        output_path = f"{config['hf_model'].split('/')[-1] if 'hf_model' in config else model_save_path.rstrip('/')}-merged"
 
-    if task in ['stance-classification', 'claim-entailment-3-way']:
-        num_labels = 3
-    elif task == 'argument-classification':
-        num_labels = 2
-    elif task in ['claim-entailment-7-way']:
-        num_labels = 7
+    model_config = ModelConfig(
+        model_name=None,
+        task=task,
+        prompt=prompt,
+        parent_prompt=parent_prompt,
+        classification_method=config['classification_method'] if task in CLASSIFICATION_TASKS else None,
+        generation_method=config['generation_method'] if task in GENERATION_TASKS else None,
+    )
+    model_kwargs = {'torch_dtype': model_config.torch_dtype, **model_kwargs}
+    model, tokenizer = setup_model_and_tokenizer(model_config, model_kwargs=model_kwargs, model_save_path=model_save_path)
+    # the classification head is a trained module of the adapter, so is merged into the base model's head
+    model = model.merge_and_unload()
+    model.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+    del model
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    metadata_path = os.path.join(model_save_path, 'metadata.json')
+    metadata = {'prompt': prompt}
+    if parent_prompt is not None:
+        metadata['parent_prompt'] = parent_prompt
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+    merged_metadata = {k: v for k, v in metadata.items() if k != 'merged_model'}
+    merged_metadata['merged_from'] = config.get('hf_model', model_save_path)
+    with open(os.path.join(output_path, 'metadata.json'), 'w') as f:
+        json.dump(merged_metadata, f)
+
+    merged_model = os.path.abspath(output_path)
+    if hub_repo_id is not None:
+        huggingface_hub.create_repo(hub_repo_id, exist_ok=True)
+        huggingface_hub.upload_folder(repo_id=hub_repo_id, folder_path=output_path)
+        merged_model = hub_repo_id
+
+    metadata['merged_model'] = merged_model
+    if 'hf_model' in config:
+        if update_hub_metadata:
+            huggingface_hub.upload_file(
+                path_or_fileobj=json.dumps(metadata).encode(),
+                path_in_repo='metadata.json',
+                repo_id=config['hf_model'],
+                commit_message=f"Record merged model {merged_model}"
+            )
+        else:
+            logger.info(f"Pass hf_model='{merged_model}' to use the merged model, or set update_hub_metadata to record it in {config['hf_model']}")
     else:
-        num_labels = None
+        with open(metadata_path, 'w') as f:
+            json.dump(metadata, f)
+    logger.info(f"Saved merged model to {output_path}")
+    return merged_model
+
+class TransformersSession:
+    """Keeps finetuned models loaded across calls to `get_predictions`.
+
+    Causal LM adapters trained on the same base model are registered on a single peft model
+    and switched with `set_adapter`, so the base weights are only loaded once.
+    Classification head models and merged models have their own weights and are cached by path.
+    """
+    def __init__(self):
+        self.models = {}
+        self.tokenizers = {}
+
+    def get_model_and_tokenizer(self, model_config: ModelConfig, model_save_path: str, model_kwargs={}):
+        if (model_config.task in CLASSIFICATION_TASKS and model_config.classification_method == 'head') or not is_adapter(model_save_path):
+            if model_save_path not in self.models:
+                self.models[model_save_path], self.tokenizers[model_save_path] = setup_model_and_tokenizer(
+                    model_config, 
+                    model_kwargs=model_kwargs, 
+                    model_save_path=model_save_path
+                )
+            return self.models[model_save_path], self.tokenizers[model_save_path]
+
+        adapter_config = peft.PeftConfig.from_pretrained(model_save_path)
+        base_model_name = stancemining.artifacts.resolve_model(adapter_config.base_model_name_or_path)
+        # module names cannot contain dots
+        adapter_name = re.sub(r'\W', '_', model_save_path)
+        if base_model_name not in self.models:
+            base_model = transformers.AutoModelForCausalLM.from_pretrained(base_model_name, **model_kwargs)
+            self.models[base_model_name] = peft.PeftModel.from_pretrained(base_model, model_save_path, adapter_name=adapter_name)
+        model = self.models[base_model_name]
+        if adapter_name not in model.peft_config:
+            model.load_adapter(model_save_path, adapter_name=adapter_name)
+        model.set_adapter(adapter_name)
+
+        if model_save_path not in self.tokenizers:
+            tokenizer = transformers.AutoTokenizer.from_pretrained(model_save_path)
+            tokenizer.padding_side = 'left'
+            tokenizer.pad_token = tokenizer.eos_token
+            self.tokenizers[model_save_path] = tokenizer
+        tokenizer = self.tokenizers[model_save_path]
+        model.generation_config.pad_token_id = tokenizer.pad_token_id
+        return model, tokenizer
+
+    def unload(self):
+        self.models = {}
+        self.tokenizers = {}
+        gc.collect()
+        torch.cuda.empty_cache()
+
+def get_predictions(task, df, config, model_kwargs={}, generate_kwargs={}, session: Optional[TransformersSession] = None, return_probs=False):
+    """Get predictions from a finetuned model.
+
+    If `return_probs` is set, classification predictions are returned along with an array of label probabilities, 
+    with labels in `labels2id` order.
+    """
+    model_save_path, prompt, parent_prompt = load_finetuned_prompts(task, config)
 
     # Setup configurations
     model_config = ModelConfig(
         model_name=None,
         task=task,
-        num_labels=num_labels,
         device_map=model_kwargs['device_map'],
         prompt=prompt,
         parent_prompt=parent_prompt,
         classification_method=config['classification_method'] if task in CLASSIFICATION_TASKS else None,
         generation_method=config['generation_method'] if task in GENERATION_TASKS else None,
-        output_type=output_type,
     )
     
     data_config = DataConfig(
@@ -1205,10 +1717,13 @@ def get_predictions(task, df, config, model_kwargs={}, generate_kwargs={}):
     )
     
     # Initialize components
-    model, tokenizer = setup_model_and_tokenizer(model_config.task, model_config.classification_method, model_config.num_labels, model_kwargs=model_kwargs, model_save_path=model_save_path)
+    if session is not None:
+        model, tokenizer = session.get_model_and_tokenizer(model_config, model_save_path, model_kwargs=model_kwargs)
+    else:
+        model, tokenizer = setup_model_and_tokenizer(model_config, model_kwargs=model_kwargs, model_save_path=model_save_path)
     model_config.model, model_config.tokenizer = model, tokenizer
     processor = DataProcessor(model_config, data_config)
-    test_dataset = processor.process_data(df, model_config.classification_method, model_config.generation_method, train=False)
+    test_dataset = processor.process_data(df, model_config.classification_method, model_config.generation_method, train=False, max_prompt_tokens=config.get('max_prompt_tokens', 2048))
     
     # optimize for inference
     # model.generation_config.cache_implementation = 'static'
@@ -1226,16 +1741,28 @@ def get_predictions(task, df, config, model_kwargs={}, generate_kwargs={}):
 
     predictions = []
     test_loader = processor.get_loader(test_dataset, loader_kwargs={"batch_size": config.get('batch_size', 1)})
+    if return_probs:
+        all_probs = []
+        for inputs in tqdm.tqdm(test_loader, desc="Evaluating"):
+            with torch.no_grad():
+                all_probs.append(get_prediction_probs(inputs, task, model, tokenizer, model_config.classification_method).cpu().numpy())
+        probs = np.concatenate(all_probs) if all_probs else np.zeros((0, len(model_config.labels2id)))
+        id2labels = {v: k for k, v in model_config.labels2id.items()}
+        return [id2labels[int(i)] for i in np.argmax(probs, axis=1)], probs
+
     for inputs in tqdm.tqdm(test_loader, desc="Evaluating"):
-        predictions.extend(get_prediction(
-            inputs, 
-            task, 
-            model, 
-            tokenizer, 
-            model_config.classification_method,
-            model_config.generation_method,
-            generate_kwargs=generate_kwargs
-        ))
+        with torch.no_grad():
+            predictions.extend(get_prediction(
+                inputs, 
+                task, 
+                model, 
+                tokenizer, 
+                model_config.classification_method,
+                model_config.generation_method,
+                generate_kwargs=generate_kwargs,
+                scoring_method=config.get('scoring_method', 'logits'),
+                guided_decoding=config.get('guided_decoding', True)
+            ))
 
     if task in CLASSIFICATION_TASKS:
         if model_config.classification_method == 'head':
@@ -1,31 +1,35 @@
+import asyncio
+import gc
+import importlib.util
+import itertools
 import json
 import logging
 import os
 import re
+import threading
 
-import huggingface_hub
 import numpy as np
 import torch
 import tqdm
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
 
+from stancemining import artifacts
 from stancemining.finetune import (
     CLASSIFICATION_TASKS,
     GENERATION_TASKS,
     DataConfig, 
     ModelConfig, 
     DataProcessor, 
-    get_model_save_path, 
-    load_prompt, 
-    load_parent_prompt,
-    to_message_format
+    get_label_token_ids,
+    get_quoted_list_regex,
+    is_adapter,
+    load_finetuned_prompts,
+    parse_list_completions,
+    score_label_logits
 )
 
 logger = logging.getLogger(__name__)
 
-def parse_list_completions(completions):
-    return [re.findall('"(.*?)"', c) for c in completions] 
-
 def parse_answer_from_thinking(completion):
     return completion.split('</think>')[-1].strip()
 
@@ -48,6 +52,80 @@ def parse_category_completions(completions, task):
     predictions = [p.group(0) if p else default for p in predictions]
     return predictions
 
+def token_logprobs_to_label_probs(all_token_logprobs, label_token_ids):
+    """Get label probabilities from a `{token_id: logprob}` dict of first token logprobs per prompt.
+
+    Labels missing from the returned logprobs get no probability.
+
+    Raises:
+        ValueError: If no label is among the returned logprobs of a prompt, which happens when logprobs are taken
+            before `allowed_token_ids` restricts the vocabulary, as with vLLM's default raw logprobs.
+    """
+    first_token_ids = [token_ids[0] for token_ids in label_token_ids]
+    label_logprobs = np.full((len(all_token_logprobs), len(first_token_ids)), -np.inf)
+    for i, token_logprobs in enumerate(all_token_logprobs):
+        for j, token_id in enumerate(first_token_ids):
+            if token_id in token_logprobs:
+                label_logprobs[i, j] = token_logprobs[token_id]
+    num_unscored = int(np.isneginf(label_logprobs).all(axis=1).sum())
+    if num_unscored > 0:
+        raise ValueError(
+            f"No label token was among the returned logprobs of {num_unscored} of {len(label_logprobs)} prompts, "
+            "so logprobs were likely taken before restricting to label tokens. Serve vLLM models with logprobs_mode='processed_logprobs'"
+        )
+    label_probs = np.exp(label_logprobs - label_logprobs.max(axis=1, keepdims=True))
+    return label_probs / label_probs.sum(axis=1, keepdims=True)
+
+def logprobs_to_label_probs(outputs, label_token_ids):
+    """Get label probabilities from the first token logprobs of vLLM outputs."""
+    all_token_logprobs = [
+        {token_id: logprob.logprob for token_id, logprob in output.outputs[0].logprobs[0].items()}
+        for output in outputs
+    ]
+    return token_logprobs_to_label_probs(all_token_logprobs, label_token_ids)
+
+def chat_logprobs_to_label_probs(responses, label_token_ids):
+    """Get label probabilities from the first token logprobs of OpenAI-compatible chat completion responses.
+
+    Responses must be requested with `return_tokens_as_token_ids`, so that tokens are returned as `token_id:<id>`.
+    vLLM servers return logprobs from before `allowed_token_ids` is applied unless started with `--logprobs-mode processed_logprobs`,
+    in which case label tokens can be missing from the top logprobs.
+    """
+    all_token_logprobs = [
+        {int(t['token'].removeprefix('token_id:')): t['logprob'] for t in response['choices'][0]['logprobs']['content'][0]['top_logprobs']}
+        for response in responses
+    ]
+    return token_logprobs_to_label_probs(all_token_logprobs, label_token_ids)
+
+def get_vllm_label_sampling_params(label_token_ids):
+    """Get sampling params that score labels from a single decoding step.
+
+    Logprobs are only restricted to the label tokens on engines loaded with `logprobs_mode='processed_logprobs'`, see `load_vllm_model`.
+
+    Raises:
+        NotImplementedError: If labels share a first token and cannot be told apart from one step.
+    """
+    import vllm
+    first_token_ids = [token_ids[0] for token_ids in label_token_ids]
+    if len(set(first_token_ids)) < len(first_token_ids):
+        raise NotImplementedError("Labels sharing a first token cannot be scored from a single decoding step with vLLM")
+    return vllm.SamplingParams(
+        temperature=0.0,
+        max_tokens=1,
+        logprobs=len(first_token_ids),
+        allowed_token_ids=first_token_ids
+    )
+
+
+def iter_chunks(items, chunk_size):
+    """Yield consecutive lists of at most `chunk_size` items from any iterable, without materialising it."""
+    assert chunk_size > 0, "chunk_size must be positive"
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 def prompts_to_conversations(prompts, system_prompt_allowed=True):
     conversations = []
@@ -56,6 +134,8 @@ def prompts_to_conversations(prompts, system_prompt_allowed=True):
             conversation = [
                 {'role': 'user', 'content': prompt}
             ]
+        elif isinstance(prompt, list) and isinstance(prompt[0], dict):
+            conversation = prompt
         elif isinstance(prompt, list):
             conversation = []
             if system_prompt_allowed:
@@ -75,6 +155,14 @@ class BaseLLM:
 
     def generate(self, prompt, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False):
         raise NotImplementedError
+
+    def score_labels(self, prompts, labels, add_generation_prompt=True, continue_final_message=False):
+        """Get the probability of each label as the continuation of each prompt, without decoding.
+
+        Returns:
+            np.ndarray: Array of shape (len(prompts), len(labels)) of label probabilities.
+        """
+        raise NotImplementedError
     
     
 class Transformers(BaseLLM):
@@ -98,7 +186,16 @@ class Transformers(BaseLLM):
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model.generation_config.pad_token_id = self.tokenizer.pad_token_id
     
-    def generate(self, prompts, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False):
+    def generate(self, prompts, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False, sampling_method='beam'):
+        """Generate completions for each prompt.
+
+        Args:
+            sampling_method: How to get multiple completions when `num_samples > 1`.
+                'beam' runs diverse group beam search, 
+                'sample' draws parallel samples from a single prefill of the prompt,
+                'topk' greedily continues each of the `num_samples` most likely first tokens from a single prefill of the prompt.
+        """
+        assert sampling_method in ['beam', 'sample', 'topk'], f"Unknown sampling method: {sampling_method}"
         conversations = prompts_to_conversations(prompts)
         all_outputs = []
         if self.verbose:
@@ -109,21 +206,85 @@ class Transformers(BaseLLM):
         for conversation in iterator:
             inputs = self.tokenizer.apply_chat_template(conversation, return_dict=True, return_tensors='pt', add_generation_prompt=add_generation_prompt, continue_final_message=continue_final_message)
             inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-            generate_kwargs = {}
-            if num_samples > 1:
-                generate_kwargs['num_beams'] = num_samples * 5
-                generate_kwargs['num_return_sequences'] = num_samples
-                generate_kwargs['num_beam_groups'] = num_samples
-                generate_kwargs['diversity_penalty'] = 0.5
-                generate_kwargs['no_repeat_ngram_size'] = 2
-                generate_kwargs['do_sample'] = False
-
-            outputs = self.model.generate(**inputs, max_new_tokens=max_new_tokens, **generate_kwargs)
+            if num_samples > 1 and sampling_method == 'sample':
+                outputs = self._sample_n_best(inputs, num_samples, max_new_tokens)
+            elif num_samples > 1 and sampling_method == 'topk':
+                outputs = self._topk_n_best(inputs, num_samples, max_new_tokens)
+            else:
+                generate_kwargs = {}
+                if num_samples > 1:
+                    generate_kwargs['num_beams'] = num_samples * 5
+                    generate_kwargs['num_return_sequences'] = num_samples
+                    generate_kwargs['num_beam_groups'] = num_samples
+                    generate_kwargs['diversity_penalty'] = 0.5
+                    generate_kwargs['no_repeat_ngram_size'] = 2
+                    generate_kwargs['do_sample'] = False
+
+                outputs = self.model.generate(**inputs, max_new_tokens=max_new_tokens, **generate_kwargs)
             outputs = [self.tokenizer.decode(output[inputs['input_ids'].shape[1]:], skip_special_tokens=True) for output in outputs]
             all_outputs.append(outputs)
         
         return all_outputs
 
+    def _prefill(self, input_ids, attention_mask):
+        """Run the prompt through the model once, returning its KV cache and the logits of the last position."""
+        prompt_cache = DynamicCache()
+        with torch.no_grad():
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=prompt_cache, use_cache=True, logits_to_keep=1)
+        return outputs.past_key_values, outputs.logits[:, -1, :]
+
+    def _sample_n_best(self, inputs, num_samples, max_new_tokens, temperature=0.7, top_p=0.95):
+        # prefill all but the last prompt token once, generate then only runs the last token and the samples
+        prompt_cache, _ = self._prefill(inputs['input_ids'][:, :-1], inputs['attention_mask'][:, :-1])
+        prompt_cache.batch_repeat_interleave(num_samples)
+        return self.model.generate(
+            input_ids=inputs['input_ids'].repeat(num_samples, 1),
+            attention_mask=inputs['attention_mask'].repeat(num_samples, 1),
+            past_key_values=prompt_cache,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=temperature,
+            top_p=top_p,
+        )
+
+    def _topk_n_best(self, inputs, num_samples, max_new_tokens):
+        # branch on the most likely first tokens, so completions are distinct, and continue each greedily
+        prompt_cache, logits = self._prefill(inputs['input_ids'], inputs['attention_mask'])
+        first_token_ids = torch.topk(logits[0], num_samples).indices.unsqueeze(1)
+        if max_new_tokens <= 1:
+            return torch.cat([inputs['input_ids'].repeat(num_samples, 1), first_token_ids], dim=1)
+        prompt_cache.batch_repeat_interleave(num_samples)
+        input_ids = torch.cat([inputs['input_ids'].repeat(num_samples, 1), first_token_ids], dim=1)
+        attention_mask = torch.cat([inputs['attention_mask'].repeat(num_samples, 1), torch.ones_like(first_token_ids)], dim=1)
+        outputs = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=prompt_cache,
+            max_new_tokens=max_new_tokens - 1,
+            do_sample=False,
+        )
+        # branches that start with an end of sequence token are empty completions
+        eos_token_ids = self.model.generation_config.eos_token_id
+        eos_token_ids = [eos_token_ids] if isinstance(eos_token_ids, int) else (eos_token_ids or [])
+        ended = torch.isin(first_token_ids[:, 0], torch.tensor(eos_token_ids, device=first_token_ids.device))
+        outputs[ended, input_ids.shape[1]:] = self.tokenizer.pad_token_id
+        return outputs
+
+    def score_labels(self, prompts, labels, add_generation_prompt=True, continue_final_message=False, batch_size=8):
+        conversations = prompts_to_conversations(prompts)
+        template_kwargs = {'add_generation_prompt': add_generation_prompt, 'continue_final_message': continue_final_message}
+        prompt_text = self.tokenizer.apply_chat_template(conversations[0], tokenize=False, **template_kwargs)
+        label_token_ids = get_label_token_ids(self.tokenizer, labels, prompt_text=prompt_text)
+
+        all_probs = []
+        for i in tqdm.tqdm(range(0, len(conversations), batch_size), disable=not self.verbose):
+            inputs = self.tokenizer.apply_chat_template(conversations[i:i+batch_size], return_dict=True, return_tensors='pt', padding=True, **template_kwargs)
+            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+            with torch.no_grad():
+                probs = score_label_logits(self.model, inputs, label_token_ids)
+            all_probs.append(probs.cpu().numpy())
+        return np.concatenate(all_probs)
+
     def unload_model(self):
         self.model = None
         self.tokenizer = None
@@ -132,6 +293,9 @@ class Transformers(BaseLLM):
 def load_vllm_model(model_name, model_kwargs, sampling_param_kwargs):
     os.environ['VLLM_WORKER_MULTIPROC_METHOD'] = 'spawn'
     import vllm
+    if model_kwargs.get('task', 'generate') == 'generate':
+        # return logprobs after allowed_token_ids is applied, so that label scoring gets the logprobs of every label token
+        model_kwargs.setdefault('logprobs_mode', 'processed_logprobs')
     model = None
     while model is None:
         try:
@@ -139,6 +303,13 @@ def load_vllm_model(model_name, model_kwargs, sampling_param_kwargs):
                 model=model_name,
                 **model_kwargs
             )
+        except TypeError as ex:
+            # older vLLM versions have no logprobs_mode
+            if 'logprobs_mode' in str(ex):
+                logger.warning("Installed vLLM version does not support logprobs_mode, label scores may miss label tokens")
+                model_kwargs.pop('logprobs_mode')
+            else:
+                raise
         except (NotImplementedError, ValueError) as ex:
             # this sometimes works without the env var, not sure why
             if str(ex) == 'VLLM_USE_V1=1 is not supported with --task classify.':
@@ -165,35 +336,67 @@ def load_vllm_model(model_name, model_kwargs, sampling_param_kwargs):
     return model, sampling_params
 
 class VLLM(BaseLLM):
-    def __init__(self, model_name, model_kwargs, verbose=False):
+    def __init__(self, model_name, model_kwargs, verbose=False, chunk_size=10000):
         super().__init__(model_name)
         self.model_kwargs = model_kwargs
         self.verbose = verbose
+        # number of prompts rendered and submitted to the engine at once
+        self.chunk_size = chunk_size
 
         sampling_param_kwargs = {
             'temperature': 0.0,
             'stop': ['\n', '<|endoftext|>', '<|im_end|>']
         }
 
-        self.model, self.sampling_params = load_vllm_model(model_name, model_kwargs, sampling_param_kwargs)
+        self.model, self.sampling_params = load_vllm_model(model_name, dict(model_kwargs), sampling_param_kwargs)
 
-    def generate(self, prompts, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False):
-        conversations = prompts_to_conversations(prompts)
-        
+    def iter_generate(self, prompts, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False):
+        """Yield completions for chunks of `prompts` in input order.
+
+        `prompts` can be any iterable, e.g. a generator, and is consumed `self.chunk_size` prompts at a time.
+        """
         self.sampling_params.max_tokens = max_new_tokens
         self.sampling_params.n = num_samples
 
-        outputs = self.model.chat(
-            messages=conversations, 
-            sampling_params=self.sampling_params, 
-            use_tqdm=self.verbose, 
-            add_generation_prompt=add_generation_prompt,
-            continue_final_message=continue_final_message
-        )
-        all_outputs = [o.outputs[0].text for o in outputs]
-        
+        for prompt_chunk in iter_chunks(prompts, self.chunk_size):
+            outputs = self.model.chat(
+                messages=prompts_to_conversations(prompt_chunk), 
+                sampling_params=self.sampling_params, 
+                use_tqdm=self.verbose, 
+                add_generation_prompt=add_generation_prompt,
+                continue_final_message=continue_final_message
+            )
+            yield [o.outputs[0].text for o in outputs]
+
+    def generate(self, prompts, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False):
+        all_outputs = []
+        for outputs in self.iter_generate(prompts, max_new_tokens=max_new_tokens, num_samples=num_samples, add_generation_prompt=add_generation_prompt, continue_final_message=continue_final_message):
+            all_outputs.extend(outputs)
         return all_outputs
 
+    def score_labels(self, prompts, labels, add_generation_prompt=True, continue_final_message=False):
+        tokenizer = self.model.get_tokenizer()
+        all_probs = []
+        label_token_ids = None
+        for prompt_chunk in iter_chunks(prompts, self.chunk_size):
+            conversations = prompts_to_conversations(prompt_chunk)
+            if label_token_ids is None:
+                prompt_text = tokenizer.apply_chat_template(conversations[0], tokenize=False, add_generation_prompt=add_generation_prompt, continue_final_message=continue_final_message)
+                label_token_ids = get_label_token_ids(tokenizer, labels, prompt_text=prompt_text)
+                sampling_params = get_vllm_label_sampling_params(label_token_ids)
+
+            outputs = self.model.chat(
+                messages=conversations, 
+                sampling_params=sampling_params, 
+                use_tqdm=self.verbose, 
+                add_generation_prompt=add_generation_prompt,
+                continue_final_message=continue_final_message
+            )
+            all_probs.append(logprobs_to_label_probs(outputs, label_token_ids))
+        if not all_probs:
+            return np.zeros((0, len(labels)))
+        return np.concatenate(all_probs, axis=0)
+
     def unload_model(self):
         self.model = None
         torch.cuda.empty_cache()
@@ -230,6 +433,173 @@ class Anthropic(BaseLLM):
 
         return all_outputs
 
+OPENAI_RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+class OpenAICompatibleClient:
+    """Client for an OpenAI-compatible inference server, such as `vllm serve`.
+
+    Requests are sent concurrently from a background event loop over a pooled keep-alive connection,
+    with at most `max_concurrency` requests in flight. Connection errors and retryable status codes
+    are retried up to `max_retries` times with exponential backoff.
+
+    Args:
+        base_url (str): Root URL of the server, e.g. 'http://localhost:8000'.
+        api_key (str): Optional API key sent as a bearer token.
+        max_concurrency (int): Maximum number of concurrent requests.
+        max_retries (int): Maximum number of retries per request.
+        timeout (float): Request timeout in seconds.
+        retry_backoff (float): Seconds to wait before the first retry, doubled on each further retry.
+    """
+    def __init__(self, base_url, api_key=None, max_concurrency=32, max_retries=3, timeout=600.0, retry_backoff=1.0):
+        if importlib.util.find_spec('httpx') is None:
+            raise ImportError("httpx is required for OpenAI-compatible inference, install it with `pip install httpx`")
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.retry_backoff = retry_backoff
+
+        # the async client and its connection pool live on one loop, so that connections are reused across calls
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._run(self._setup())
+
+    async def _setup(self):
+        import httpx
+        headers = {'Authorization': f"Bearer {self.api_key}"} if self.api_key else {}
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _post(self, path, payload):
+        import httpx
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    response = await self._client.post(path, json=payload)
+                if response.status_code not in OPENAI_RETRY_STATUS_CODES or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response.json()
+                logger.warning(f"Request to {path} returned status {response.status_code}, retrying")
+            except httpx.TransportError as ex:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Request to {path} failed with {ex!r}, retrying")
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+    async def _post_all(self, path, payloads):
+        return await asyncio.gather(*[self._post(path, payload) for payload in payloads])
+
+    def post(self, path, payloads):
+        """Send each payload to `path` concurrently, returning the JSON responses in input order."""
+        return self._run(self._post_all(path, list(payloads)))
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        self._run(self._client.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+def get_chat_payload(model, messages, max_tokens, temperature=0.0, n=1, add_generation_prompt=True, continue_final_message=False, **kwargs):
+    """Get a chat completions request body, using the vLLM extensions for continuing a final message."""
+    payload = {
+        'model': model,
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'n': n,
+        'add_generation_prompt': add_generation_prompt,
+        'continue_final_message': continue_final_message,
+    }
+    payload.update(kwargs)
+    return payload
+
+def get_chat_label_scoring_kwargs(label_token_ids):
+    """Get chat completion request fields that score labels from a single decoding step.
+
+    Raises:
+        NotImplementedError: If labels share a first token and cannot be told apart from one step.
+    """
+    first_token_ids = [token_ids[0] for token_ids in label_token_ids]
+    if len(set(first_token_ids)) < len(first_token_ids):
+        raise NotImplementedError("Labels sharing a first token cannot be scored from a single decoding step with an OpenAI-compatible server")
+    return {
+        'max_tokens': 1,
+        'temperature': 0.0,
+        'logprobs': True,
+        'top_logprobs': len(first_token_ids),
+        'allowed_token_ids': first_token_ids,
+        'return_tokens_as_token_ids': True,
+    }
+
+OPENAI_CLIENT_KWARGS = ['base_url', 'api_key', 'max_concurrency', 'max_retries', 'timeout', 'retry_backoff']
+
+class OpenAICompatible(BaseLLM):
+    """LLM served by an OpenAI-compatible server, such as `vllm serve`.
+
+    `model_kwargs` must include `base_url`, and can include the other `OpenAICompatibleClient` arguments.
+    `model_name` is sent as the model id, so LoRA adapters registered with the server can be selected by their name.
+    Label scoring needs the model's tokenizer, loaded from `model_kwargs['tokenizer']` or `model_name`, 
+    and a vLLM server started with `--logprobs-mode processed_logprobs`, so that the logprobs of every label are returned.
+    """
+    def __init__(self, model_name, model_kwargs, verbose=False, chunk_size=1000):
+        super().__init__(model_name)
+        assert 'base_url' in model_kwargs, "Base URL of the OpenAI-compatible server must be provided in model_kwargs"
+        self.model_kwargs = model_kwargs
+        self.verbose = verbose
+        self.chunk_size = chunk_size
+        self.client = OpenAICompatibleClient(**{k: v for k, v in model_kwargs.items() if k in OPENAI_CLIENT_KWARGS})
+        self.tokenizer = None
+
+    def _chat(self, payloads):
+        responses = []
+        for payload_chunk in tqdm.tqdm(iter_chunks(payloads, self.chunk_size), disable=not self.verbose):
+            responses.extend(self.client.post('/v1/chat/completions', payload_chunk))
+        return responses
+
+    def generate(self, prompts, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False):
+        payloads = (
+            get_chat_payload(
+                self.model_name, 
+                conversation, 
+                max_new_tokens, 
+                # greedy samples would all be the same
+                temperature=0.0 if num_samples == 1 else 0.7,
+                n=num_samples, 
+                add_generation_prompt=add_generation_prompt, 
+                continue_final_message=continue_final_message
+            )
+            for conversation in prompts_to_conversations(prompts)
+        )
+        return [[choice['message']['content'] for choice in response['choices']] for response in self._chat(payloads)]
+
+    def score_labels(self, prompts, labels, add_generation_prompt=True, continue_final_message=False):
+        conversations = prompts_to_conversations(prompts)
+        if self.tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_kwargs.get('tokenizer', self.model_name))
+        prompt_text = self.tokenizer.apply_chat_template(conversations[0], tokenize=False, add_generation_prompt=add_generation_prompt, continue_final_message=continue_final_message)
+        label_token_ids = get_label_token_ids(self.tokenizer, labels, prompt_text=prompt_text)
+        scoring_kwargs = get_chat_label_scoring_kwargs(label_token_ids)
+        payloads = (
+            get_chat_payload(self.model_name, conversation, add_generation_prompt=add_generation_prompt, continue_final_message=continue_final_message, **scoring_kwargs)
+            for conversation in conversations
+        )
+        return chat_logprobs_to_label_probs(self._chat(payloads), label_token_ids)
+
+    def unload_model(self):
+        self.client.close()
+
 def get_max_new_tokens(task, model_config):
     if task in CLASSIFICATION_TASKS and model_config.classification_method == 'generation':
         if task == 'stance-detection':
@@ -246,25 +616,77 @@ def get_max_new_tokens(task, model_config):
         max_new_tokens = None
     return max_new_tokens
 
-def get_vllm_predictions(task, df, config, verbose=False, model_kwargs={}, generate_kwargs={}):
-    import vllm
-    import vllm.lora.request
-    
-    output_type = config['classification_method'] if task in CLASSIFICATION_TASKS else config['generation_method']
-    if 'hf_model' in config:
-        model_save_path = config['hf_model']
-        file_path = huggingface_hub.hf_hub_download(repo_id=model_save_path, filename='metadata.json')
-        with open(file_path, 'r') as f:
-            metadata = json.load(f)
-        prompt = metadata['prompt']
-        parent_prompt = metadata['parent_prompt'] if 'parent_prompt' in metadata else None
-    else:
-        if 'data_name' in config:
-            model_save_path = get_model_save_path(task, config['save_model_path'], config['model_name'], config['data_name'], output_type)
+class VLLMSession:
+    """Keeps vLLM engines and their LoRA adapters loaded across calls to `get_vllm_predictions`.
+
+    One engine is kept resident per engine task, so with the default models, the 'generate' engine serving the target extraction adapter 
+    and the 'classify' engine serving the stance head stay loaded side by side, and switching between extraction and stance detection reloads nothing.
+    Adapters on the same base model and task share their engine and are selected per request with a `LoRARequest`, 
+    e.g. extraction and stance adapters when stance is classified by generation.
+    Requesting a different base model for a task replaces that task's engine.
+
+    Args:
+        num_engines: Number of engines expected to be resident at once.
+        gpu_memory_utilization: Fraction of GPU memory reserved by all engines together, split evenly between `num_engines` engines
+            unless `gpu_memory_utilization` is set in an engine's model kwargs.
+    """
+    def __init__(self, num_engines=2, gpu_memory_utilization=0.8):
+        assert num_engines > 0, "num_engines must be positive"
+        self.num_engines = num_engines
+        self.gpu_memory_utilization = gpu_memory_utilization
+        # engine task to (model name, engine)
+        self.engines = {}
+        self.lora_ids = {}
+
+    def get_llm(self, model_name, model_kwargs, sampling_param_kwargs):
+        import vllm
+        task = model_kwargs.get('task')
+        if task in self.engines and self.engines[task][0] != model_name:
+            self.unload(task)
+        if task not in self.engines:
+            # the caller's kwargs are reused across calls, so are not modified
+            model_kwargs = dict(model_kwargs)
+            if model_kwargs.get('enable_lora', False) and 'max_loras' not in model_kwargs:
+                # keep extraction and stance adapters resident at the same time
+                model_kwargs['max_loras'] = 2
+            if 'gpu_memory_utilization' not in model_kwargs:
+                model_kwargs['gpu_memory_utilization'] = self.gpu_memory_utilization / self.num_engines
+            llm, _ = load_vllm_model(model_name, model_kwargs, sampling_param_kwargs)
+            self.engines[task] = (model_name, llm)
+        return self.engines[task][1], vllm.SamplingParams(**sampling_param_kwargs)
+
+    def get_lora_request(self, lora_name, adapter_path):
+        import vllm.lora.request
+        if adapter_path not in self.lora_ids:
+            self.lora_ids[adapter_path] = len(self.lora_ids) + 1
+        return vllm.lora.request.LoRARequest(lora_name, self.lora_ids[adapter_path], adapter_path)
+
+    def unload(self, task=None):
+        """Unload the engine of `task`, or all engines."""
+        if task is None:
+            self.engines = {}
+            self.lora_ids = {}
         else:
-            model_save_path = config['model_path']
-        prompt=load_prompt(task, config['prompting_method'], generation_method=config['generation_method'] if 'generation_method' in config else None)
-        parent_prompt=load_parent_prompt(task, prompting_method=config['prompting_method'])
+            self.engines.pop(task, None)
+        gc.collect()
+        torch.cuda.empty_cache()
+
+def iter_vllm_predictions(task, df, config, verbose=False, model_kwargs={}, generate_kwargs={}, session=None, chunk_size=None, return_probs=False):
+    """Yield predictions for consecutive row chunks of `df`, in input order.
+
+    Prompts are rendered and submitted one chunk at a time, so host memory is bounded by `chunk_size` 
+    (default `config['chunk_size']`, or 100,000 rows) rather than by the length of `df`.
+    If `return_probs` is set, classification chunks are yielded as `(predictions, probs)`, with label probabilities in `labels2id` order.
+    """
+    if session is None:
+        session = VLLMSession()
+    model_kwargs = dict(model_kwargs)
+    assert not return_probs or task in CLASSIFICATION_TASKS, "Label probabilities are only available for classification tasks"
+    if chunk_size is None:
+        chunk_size = config.get('chunk_size', 100000)
+    assert chunk_size > 0, "chunk_size must be positive"
+
+    model_save_path, prompt, parent_prompt = load_finetuned_prompts(task, config)
     
     # Setup configurations
     model_config = ModelConfig(
@@ -281,30 +703,35 @@ def get_vllm_predictions(task, df, config, verbose=False, model_kwargs={}, gener
     )
     
     # Initialize components
+    import transformers
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_save_path)
+    model_config.tokenizer = tokenizer
     processor = DataProcessor(model_config, data_config)
-    test_dataset = processor.process_data(df, model_config.classification_method, model_config.generation_method, train=False, tokenize=False, truncate_beyond=10000)
-    prompts = test_dataset['text']
-    prompts = [to_message_format(p) for p in prompts]
 
     if model_config.generation_method == 'beam':
         raise NotImplementedError("Beam search is not supported with VLLM yet.")
 
     chat_template_kwargs = {}
+    use_lora = False
     if task in GENERATION_TASKS or (task in CLASSIFICATION_TASKS and model_config.classification_method == 'generation'):
         model_kwargs['task'] = 'generate'
         model_kwargs['generation_config'] = 'auto'
-        model_kwargs['enable_lora'] = True
         chat_template_kwargs['enable_thinking'] = False
-
-        if 'hf_model' in config:
-            file_path = huggingface_hub.hf_hub_download(repo_id=model_save_path, filename='adapter_config.json')
-            with open(file_path, 'r') as f:
+        use_lora = is_adapter(model_save_path)
+
+        if not use_lora:
+            # merged models are served directly, without LoRA kernels
+            model_name = model_save_path
+        elif 'hf_model' in config:
+            # hub models are already resolved to a local snapshot
+            with open(os.path.join(model_save_path, 'adapter_config.json'), 'r') as f:
                 adapter_config = json.load(f)
-            adapter_path = huggingface_hub.snapshot_download(repo_id=model_save_path)
-            model_name = adapter_config['base_model_name_or_path']
+            adapter_path = model_save_path
+            model_name = artifacts.resolve_model(adapter_config['base_model_name_or_path'])
         else:
             adapter_path = model_save_path
             model_name = config['base_model_name']
+        model_kwargs['enable_lora'] = use_lora
 
     elif task in CLASSIFICATION_TASKS and model_config.classification_method == 'head':
         model_kwargs['task'] = 'classify'
@@ -313,25 +740,8 @@ def get_vllm_predictions(task, df, config, verbose=False, model_kwargs={}, gener
     else:
         raise ValueError()
     
-    if 'hf_model' in config:
-        tokenizer_file_path = huggingface_hub.hf_hub_download(repo_id=model_save_path, filename='tokenizer_config.json')
-    else:
-        tokenizer_file_path = os.path.join(model_save_path, 'tokenizer_config.json')
-    with open(tokenizer_file_path, 'r') as f:
+    with open(os.path.join(model_save_path, 'tokenizer_config.json'), 'r') as f:
         tokenizer_config = json.load(f)
-    if task in CLASSIFICATION_TASKS and model_config.classification_method == 'head':
-        import transformers
-        tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
-        prompts = tokenizer.apply_chat_template(
-            prompts, 
-            add_generation_prompt=True,
-            truncation=True,
-            max_length=2048,
-            padding='max_length',
-            return_token_type_ids=False, 
-            enable_thinking=False,
-            tokenize=False
-        )
 
     # turn off verbose logging
     os.environ['VLLM_CONFIGURE_LOGGING'] = '0'
@@ -340,6 +750,8 @@ def get_vllm_predictions(task, df, config, verbose=False, model_kwargs={}, gener
 
     
 
+    max_new_tokens = get_max_new_tokens(task, model_config)
+
     # greedy decoding
     sampling_param_kwargs = {
         'temperature': 0.0,
@@ -348,26 +760,210 @@ def get_vllm_predictions(task, df, config, verbose=False, model_kwargs={}, gener
         'repetition_penalty': 1.2
     }
 
-    llm, sampling_params = load_vllm_model(model_name, model_kwargs, sampling_param_kwargs)
+    if task in GENERATION_TASKS and model_config.generation_method == 'list' and config.get('guided_decoding', True):
+        # constrain output to the quoted list format, so generation stops once the list is closed
+        try:
+            from vllm.sampling_params import GuidedDecodingParams
+            sampling_param_kwargs['guided_decoding'] = GuidedDecodingParams(regex=get_quoted_list_regex())
+        except ImportError:
+            logger.warning("Installed vLLM version does not support guided decoding, generating unconstrained lists")
 
-    if task in GENERATION_TASKS:
-        lora_request = vllm.lora.request.LoRARequest(
-            f"{task}_adapter",
-            1,
-            adapter_path
-        )
+    llm, sampling_params = session.get_llm(model_name, model_kwargs, sampling_param_kwargs)
 
-    if task in GENERATION_TASKS or (task in CLASSIFICATION_TASKS and model_config.classification_method == 'generation'):
-        outputs = llm.chat(messages=prompts, sampling_params=sampling_params, use_tqdm=verbose, lora_request=lora_request, chat_template_kwargs=chat_template_kwargs, **generate_kwargs)
-        predictions = [o.outputs[0].text for o in outputs]
-        predictions = parse_list_completions(predictions)
+    lora_request = None
+    if use_lora:
+        lora_request = session.get_lora_request(f"{task}_adapter", adapter_path)
+
+    if task in CLASSIFICATION_TASKS and model_config.classification_method == 'generation':
+        labels = sorted(model_config.labels2id, key=model_config.labels2id.get)
+        label_token_ids = get_label_token_ids(llm.get_tokenizer(), labels)
+        scoring_method = config.get('scoring_method', 'logits')
+        if scoring_method == 'logits':
+            try:
+                sampling_params = get_vllm_label_sampling_params(label_token_ids)
+            except NotImplementedError:
+                logger.warning("Labels share a first token, falling back to generating labels")
+                scoring_method = 'generate'
     elif task in CLASSIFICATION_TASKS and model_config.classification_method == 'head':
-        outputs = llm.classify(prompts, use_tqdm=verbose, **generate_kwargs)
-        probs = [o.outputs.probs for o in outputs]
-        predictions = [np.argmax(p) for p in probs]
+        from vllm.inputs import TokensPrompt
         id2labels = {v: k for k, v in model_config.labels2id.items()}
-        predictions = [id2labels[p] for p in predictions]
-    else:
-        raise ValueError()
 
-    return predictions
\ No newline at end of file
+    for start in range(0, len(df), chunk_size):
+        chunk_df = df[start:start + chunk_size]
+        prompts = processor.render_messages(chunk_df, model_config.classification_method, model_config.generation_method, max_prompt_tokens=config.get('max_prompt_tokens', 2048))['messages'].to_list()
+
+        if task in CLASSIFICATION_TASKS and model_config.classification_method == 'generation':
+            outputs = llm.chat(messages=prompts, sampling_params=sampling_params, use_tqdm=verbose, lora_request=lora_request, chat_template_kwargs=chat_template_kwargs, **generate_kwargs)
+            if scoring_method == 'logits':
+                probs = logprobs_to_label_probs(outputs, label_token_ids)
+                predictions = [labels[p] for p in np.argmax(probs, axis=1)]
+            else:
+                completions = [o.outputs[0].text.strip().lower() for o in outputs]
+                # match longest labels first so that e.g. 'leaning refuting' is not read as 'refuting'
+                match_labels = sorted(labels, key=len, reverse=True)
+                predictions = [next((l for l in match_labels if l in c), labels[0]) for c in completions]
+                # generated labels have no confidence, so are treated as certain
+                probs = np.eye(len(labels))[[labels.index(p) for p in predictions]]
+        elif task in GENERATION_TASKS:
+            outputs = llm.chat(messages=prompts, sampling_params=sampling_params, use_tqdm=verbose, lora_request=lora_request, chat_template_kwargs=chat_template_kwargs, **generate_kwargs)
+            predictions = [o.outputs[0].text for o in outputs]
+            predictions = parse_list_completions(predictions)
+        elif task in CLASSIFICATION_TASKS and model_config.classification_method == 'head':
+            # tokenize once without padding, pad tokens would otherwise be processed as real tokens by the engine
+            prompt_token_ids = tokenizer.apply_chat_template(
+                prompts, 
+                add_generation_prompt=True,
+                truncation=True,
+                max_length=2048,
+                enable_thinking=False,
+                tokenize=True
+            )
+            prompts = [TokensPrompt(prompt_token_ids=token_ids) for token_ids in prompt_token_ids]
+            del prompt_token_ids
+            outputs = llm.classify(prompts, use_tqdm=verbose, **generate_kwargs)
+            probs = np.array([o.outputs.probs for o in outputs])
+            predictions = [id2labels[int(p)] for p in np.argmax(probs, axis=1)]
+        else:
+            raise ValueError()
+
+        # drop request outputs before rendering the next chunk
+        del outputs, prompts
+        if return_probs:
+            yield predictions, probs
+        else:
+            yield predictions
+
+def get_vllm_predictions(task, df, config, verbose=False, model_kwargs={}, generate_kwargs={}, session=None, chunk_size=None, return_probs=False):
+    predictions = []
+    probs = []
+    for chunk in iter_vllm_predictions(task, df, config, verbose=verbose, model_kwargs=model_kwargs, generate_kwargs=generate_kwargs, session=session, chunk_size=chunk_size, return_probs=return_probs):
+        if return_probs:
+            chunk_predictions, chunk_probs = chunk
+            probs.append(chunk_probs)
+        else:
+            chunk_predictions = chunk
+        predictions.extend(chunk_predictions)
+    if return_probs:
+        return predictions, np.concatenate(probs) if probs else np.zeros((0, 0))
+    return predictions
+
+class OpenAICompatibleSession:
+    """Keeps pooled clients to OpenAI-compatible servers open across calls to `get_openai_compatible_predictions`."""
+    def __init__(self):
+        self.clients = {}
+
+    def get_client(self, model_kwargs):
+        client_kwargs = {k: v for k, v in model_kwargs.items() if k in OPENAI_CLIENT_KWARGS}
+        assert 'base_url' in client_kwargs, "Base URL of the OpenAI-compatible server must be provided in model_kwargs"
+        key = tuple(sorted(client_kwargs.items()))
+        if key not in self.clients:
+            self.clients[key] = OpenAICompatibleClient(**client_kwargs)
+        return self.clients[key]
+
+    def unload(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+
+def get_openai_compatible_predictions(task, df, config, verbose=False, model_kwargs={}, generate_kwargs={}, session=None, return_probs=False):
+    """Get predictions from a finetuned model hosted by an OpenAI-compatible server.
+
+    Generation adapters should be registered with the server as LoRA modules, and head classifiers served 
+    with the classify task. Both are requested by `config['served_model_name']`, which defaults to the hub id or path of the model.
+    `model_kwargs` hold the `OpenAICompatibleClient` arguments, and must include `base_url`.
+    Scoring generated labels by logits needs a vLLM server started with `--logprobs-mode processed_logprobs`.
+    If `return_probs` is set, classification returns `(predictions, probs)`, with label probabilities in `labels2id` order.
+    """
+    assert not return_probs or task in CLASSIFICATION_TASKS, "Label probabilities are only available for classification tasks"
+    owns_session = session is None
+    if owns_session:
+        session = OpenAICompatibleSession()
+    try:
+        client = session.get_client(model_kwargs)
+
+        model_save_path, prompt, parent_prompt = load_finetuned_prompts(task, config)
+        served_model_name = config.get('served_model_name', config.get('hf_model', model_save_path))
+
+        model_config = ModelConfig(
+            model_name=None,
+            task=task,
+            prompt=prompt,
+            parent_prompt=parent_prompt,
+            classification_method=config['classification_method'] if task in CLASSIFICATION_TASKS else None,
+            generation_method=config['generation_method'] if task in GENERATION_TASKS else None,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model_save_path)
+        model_config.tokenizer = tokenizer
+        processor = DataProcessor(model_config, DataConfig(dataset_name=None))
+
+        if model_config.generation_method == 'beam':
+            raise NotImplementedError("Beam search is not supported with OpenAI-compatible servers.")
+
+        chat_kwargs = {
+            'chat_template_kwargs': {'enable_thinking': False},
+            'repetition_penalty': 1.2,
+        }
+        if task in GENERATION_TASKS:
+            chat_kwargs['stop'] = ['\n', '<|endoftext|>', '<|im_end|>']
+            if model_config.generation_method == 'list' and config.get('guided_decoding', True):
+                chat_kwargs['guided_regex'] = get_quoted_list_regex()
+        chat_kwargs.update(generate_kwargs)
+        max_new_tokens = get_max_new_tokens(task, model_config)
+
+        if task in CLASSIFICATION_TASKS and model_config.classification_method == 'generation':
+            labels = sorted(model_config.labels2id, key=model_config.labels2id.get)
+            label_token_ids = get_label_token_ids(tokenizer, labels)
+            scoring_method = config.get('scoring_method', 'logits')
+            if scoring_method == 'logits':
+                try:
+                    scoring_kwargs = get_chat_label_scoring_kwargs(label_token_ids)
+                except NotImplementedError:
+                    logger.warning("Labels share a first token, falling back to generating labels")
+                    scoring_method = 'generate'
+        elif task in CLASSIFICATION_TASKS and model_config.classification_method == 'head':
+            id2labels = {v: k for k, v in model_config.labels2id.items()}
+        elif task not in GENERATION_TASKS:
+            raise ValueError()
+
+        chunk_size = config.get('chunk_size', 100000)
+        predictions = []
+        all_probs = []
+        for start in tqdm.tqdm(range(0, len(df), chunk_size), disable=not verbose):
+            chunk_df = df[start:start + chunk_size]
+            messages = processor.render_messages(chunk_df, model_config.classification_method, model_config.generation_method, max_prompt_tokens=config.get('max_prompt_tokens', 2048))['messages'].to_list()
+
+            if task in CLASSIFICATION_TASKS and model_config.classification_method == 'head':
+                texts = tokenizer.apply_chat_template(messages, add_generation_prompt=True, enable_thinking=False, tokenize=False)
+                payloads = [
+                    {'model': served_model_name, 'input': text_batch, 'truncate_prompt_tokens': 2048}
+                    for text_batch in iter_chunks(texts, 64)
+                ]
+                responses = client.post('/classify', payloads)
+                probs = np.array([d['probs'] for r in responses for d in r['data']])
+                predictions.extend(id2labels[int(p)] for p in np.argmax(probs, axis=1))
+                all_probs.append(probs)
+            elif task in CLASSIFICATION_TASKS and scoring_method == 'logits':
+                payloads = [get_chat_payload(served_model_name, m, **{**chat_kwargs, **scoring_kwargs}) for m in messages]
+                probs = chat_logprobs_to_label_probs(client.post('/v1/chat/completions', payloads), label_token_ids)
+                predictions.extend(labels[p] for p in np.argmax(probs, axis=1))
+                all_probs.append(probs)
+            elif task in CLASSIFICATION_TASKS:
+                payloads = [get_chat_payload(served_model_name, m, max_new_tokens, **chat_kwargs) for m in messages]
+                completions = [r['choices'][0]['message']['content'].strip().lower() for r in client.post('/v1/chat/completions', payloads)]
+                # match longest labels first so that e.g. 'leaning refuting' is not read as 'refuting'
+                match_labels = sorted(labels, key=len, reverse=True)
+                chunk_predictions = [next((l for l in match_labels if l in c), labels[0]) for c in completions]
+                predictions.extend(chunk_predictions)
+                # generated labels have no confidence, so are treated as certain
+                all_probs.append(np.eye(len(labels))[[labels.index(p) for p in chunk_predictions]])
+            else:
+                payloads = [get_chat_payload(served_model_name, m, max_new_tokens, **chat_kwargs) for m in messages]
+                completions = [r['choices'][0]['message']['content'] for r in client.post('/v1/chat/completions', payloads)]
+                predictions.extend(parse_list_completions(completions))
+    finally:
+        if owns_session:
+            session.unload()
+
+    if return_probs:
+        return predictions, np.concatenate(all_probs) if all_probs else np.zeros((0, 0))
+    return predictions
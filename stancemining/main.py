@@ -1,5 +1,8 @@
 import functools
 import logging
+import os
+import tempfile
+import time
 from typing import List, Union
 
 import numpy as np
@@ -8,7 +11,7 @@ from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 import torch
 
-from stancemining import llms, finetune, prompting, utils
+from stancemining import artifacts, llms, finetune, prompting, utils
 
 logger = logging.getLogger('StanceMining')
 
@@ -18,7 +21,7 @@ class StanceMining:
     Args:
         stance_target_type (str): Type of stance target to extract, either 'noun-phrases' or 'claims'.
         llm_method (str): Method to use for LLM inference, either 'prompting' or 'finetuned'.
-        model_inference (str): Inference method for the LLM, either 'vllm' or 'transformers'.
+        model_inference (str): Inference method for the LLM, either 'vllm', 'transformers', 'anthropic' or 'openai-compatible'. For 'openai-compatible', model kwargs must include the server's `base_url`.
         model_name (str): Name of the base LLM model, which will be used for target cluster naming, and, if llm_method is 'prompting', for stance target extraction and detection.
         model_kwargs (dict): Additional keyword arguments for the LLM model.
         tokenizer_kwargs (dict): Additional keyword arguments for the tokenizer.
@@ -35,6 +38,27 @@ class StanceMining:
         topic_model (str): Topic model to use for clustering targets, either 'bertopic' or 'toponymy'.
         cosine_similarity_threshold (float): Cosine similarity threshold for deduplicating targets. Defaults to 0.8.
         verbose (bool): Whether to enable verbose logging. Defaults to False.
+        server_url (str): URL of a `stancemining serve` process. If set, target extraction, stance detection and embedding are run by the server instead of loading models in this process.
+        document_triage (Union[str, utils.DocumentTriageClassifier]): If set, documents unlikely to carry a stance are skipped before target extraction, and given no targets.
+            'rules' skips documents with too few letters once links and mentions are removed, and a fitted `utils.DocumentTriageClassifier` additionally skips documents it predicts to have no targets.
+        window_tokens (int): If set, documents longer than this many tokens are split into overlapping windows. Targets are extracted per window and merged per document, 
+            and the stance on each target is classified in the windows mentioning it, or all windows if none do.
+        window_overlap_tokens (int): Number of tokens shared by consecutive windows. Defaults to 64.
+        window_tokenizer (str): Tokenizer used to count window tokens. Defaults to the target extraction model's tokenizer.
+        dedup_num_workers (int): Number of processes to shard exact similar target search across when deduplicating all targets, or None for all cores. 
+            Setting it opts into exact search, which finds every pair within the distance threshold in time quadratic in the number of targets, 
+            and shards search the same pairs as exact search in one process, so the number of workers does not change the clusters. Defaults to 1, which uses approximate search.
+        embedding_dtype (str): 'float16' or 'int8' to cache embeddings scalar quantized with a scale per vector, and to run exact similar target search 
+            and document target filtering over the quantized embeddings. Defaults to 'float32'.
+        measure_quantization_recall (bool): If set with a quantized `embedding_dtype`, the recall of quantized similar target search against float32 is measured on a sample of targets 
+            when deduplicating all targets, and stored in `self.quantization_report`. This embeds and searches the sample twice, so defaults to False.
+        embedding_reduction (Union[str, utils.EmbeddingReducer]): If set, embeddings are reduced in dimension before similar target filtering, deduplication and topic modelling. 
+            'pca' fits a projection once per run, 'matryoshka' truncates embeddings of models trained for it, and a fitted `utils.EmbeddingReducer` is used as is.
+            Use `utils.calibrate_embedding_reduction` to choose a dimension.
+        embedding_reduction_dims (int): Number of dimensions to reduce embeddings to. Defaults to 128.
+        embedding_file_min_texts (int): Number of uncached texts from which embeddings are written in length-sorted batches to a temporary memory-mapped file, 
+            see `utils.Embedder.encode_to_file`, rather than all held in memory by the embedding model. Defaults to 100,000.
+        stance_cascade_threshold (float): If set, finetuned stance predictions with a top label probability below this threshold are re-classified by prompting `model_name`. Only supported for noun-phrase targets.
     """
 
     def __init__(
@@ -59,6 +83,18 @@ class StanceMining:
             cosine_similarity_threshold=0.8,
             verbose=False,
             use_embedding_cache=True,
+            server_url=None,
+            stance_cascade_threshold=None,
+            document_triage=None,
+            window_tokens=None,
+            window_overlap_tokens=64,
+            window_tokenizer=None,
+            dedup_num_workers=1,
+            embedding_dtype='float32',
+            measure_quantization_recall=False,
+            embedding_reduction=None,
+            embedding_reduction_dims=128,
+            embedding_file_min_texts=100000,
         ):
         """Initialize the StanceMining class.
         """
@@ -66,9 +102,15 @@ class StanceMining:
         assert llm_method in ['prompting', 'finetuned'], f"LLM method must be either 'prompting' or 'finetuned', not '{llm_method}'"
         self.stance_target_type = stance_target_type
         self.llm_method = llm_method
-        assert model_inference in ['vllm', 'transformers', 'anthropic'], f"Model inference method must be either 'vllm', 'transformers' or 'anthropic', not '{model_inference}'"
+        assert model_inference in ['vllm', 'transformers', 'anthropic', 'openai-compatible'], f"Model inference method must be either 'vllm', 'transformers', 'anthropic' or 'openai-compatible', not '{model_inference}'"
         self.model_inference = model_inference
         self.model_name = model_name
+        # copy kwargs, which are filled in below, so that defaults and caller dicts aren't shared between instances
+        model_kwargs = dict(model_kwargs or {})
+        stance_detection_finetune_kwargs = dict(stance_detection_finetune_kwargs or {})
+        stance_detection_model_kwargs = dict(stance_detection_model_kwargs or {})
+        target_extraction_finetune_kwargs = dict(target_extraction_finetune_kwargs or {})
+        target_extraction_model_kwargs = dict(target_extraction_model_kwargs or {})
         self.model_kwargs = model_kwargs
         if 'device_map' not in self.model_kwargs and self.model_inference == 'transformers':
             self.model_kwargs['device_map'] = 'auto'
@@ -77,6 +119,13 @@ class StanceMining:
 
         self.tokenizer_kwargs = tokenizer_kwargs
 
+        if self.model_inference == 'openai-compatible':
+            # finetuned models are served by the same server unless configured otherwise
+            for kwargs in [stance_detection_model_kwargs, target_extraction_model_kwargs]:
+                for k in llms.OPENAI_CLIENT_KWARGS:
+                    if k in self.model_kwargs and k not in kwargs:
+                        kwargs[k] = self.model_kwargs[k]
+
         if stance_detection_model is None:
             stance_detection_model = 'bendavidsteel/SmolLM2-360M-Instruct-stance-detection'
 
@@ -123,15 +172,62 @@ class StanceMining:
         self.embedding_model = embedding_model
         assert embedding_model_inference in ['vllm', 'sentence-transformers'], f"Embedding model inference method must be either 'vllm' or 'sentence-transformers', not '{embedding_model_inference}'"
         self.embedding_model_inference = embedding_model_inference
-        self.embedding_cache_df = pl.DataFrame({'text': [], 'embedding': []}, schema={'text': pl.String, 'embedding': pl.Array(pl.Float32, 384)})
+        assert embedding_dtype in utils.EMBEDDING_DTYPES, f"Embedding dtype must be one of {utils.EMBEDDING_DTYPES}, not '{embedding_dtype}'"
+        self.embedding_dtype = embedding_dtype
+        self.measure_quantization_recall = measure_quantization_recall
+        self.quantization_report = None
+
+        assert embedding_reduction in [None, 'pca', 'matryoshka'] or isinstance(embedding_reduction, utils.EmbeddingReducer), \
+            f"Embedding reduction must be None, 'pca', 'matryoshka' or an EmbeddingReducer, not '{embedding_reduction}'"
+        self.embedding_reduction = embedding_reduction
+        self.embedding_reduction_dims = embedding_reduction_dims
+        self._embedding_reducer = self._get_embedding_reducer()
+        self.embedding_file_min_texts = embedding_file_min_texts
+        if self.embedding_dtype == 'float32':
+            self.embedding_cache_df = pl.DataFrame({'text': [], 'embedding': []}, schema={'text': pl.String, 'embedding': pl.Array(pl.Float32, 384)})
+        else:
+            # float16 codes are held as their int16 bit patterns, see `utils._codes_to_storage`
+            code_dtype = pl.Int16 if self.embedding_dtype == 'float16' else pl.Int8
+            self.embedding_cache_df = pl.DataFrame(
+                {'text': [], 'embedding': [], 'embedding_scale': []}, 
+                schema={'text': pl.String, 'embedding': pl.Array(code_dtype, 384), 'embedding_scale': pl.Float32}
+            )
 
         self.cosine_similarity_threshold = cosine_similarity_threshold
+        self.dedup_num_workers = dedup_num_workers
 
         assert topic_model in ['bertopic', 'toponymy'], f"Topic model must be either 'bertopic' or 'toponymy', not '{topic_model}'"
         self.topic_model = topic_model
 
         self.use_embedding_cache = use_embedding_cache
 
+        self._predictor_session = None
+
+        if stance_cascade_threshold is not None:
+            assert llm_method == 'finetuned', "Stance cascade escalates finetuned predictions, so requires llm_method='finetuned'"
+            assert stance_target_type == 'noun-phrases', "Stance cascade is only supported for noun-phrase targets, as the prompting and finetuned claim labels differ"
+            assert 0 < stance_cascade_threshold <= 1, "stance_cascade_threshold must be in (0, 1]"
+        self.stance_cascade_threshold = stance_cascade_threshold
+        self.stance_cascade_report = None
+
+        assert document_triage is None or document_triage == 'rules' or isinstance(document_triage, utils.DocumentTriageClassifier), \
+            f"Document triage must be None, 'rules' or a DocumentTriageClassifier, not '{document_triage}'"
+        self.document_triage = document_triage
+        self.triage_report = None
+
+        if window_tokens is not None:
+            assert 0 <= window_overlap_tokens < window_tokens, "window_overlap_tokens must be smaller than window_tokens"
+        self.window_tokens = window_tokens
+        self.window_overlap_tokens = window_overlap_tokens
+        self.window_tokenizer = window_tokenizer
+        self._window_tokenizer = None
+
+        if server_url is not None:
+            from stancemining.serve import StanceMiningClient
+            self._server_client = StanceMiningClient(server_url)
+        else:
+            self._server_client = None
+
     def _generate_higher_level_targets(self, document_df: pl.DataFrame, embed_model, topic_model_kwargs, max_layers):
         logger.info("Fitting topic model")
         # get unique targets where most common targets are first
@@ -220,7 +316,8 @@ class StanceMining:
                 If `generate_targets` is True, this should be an empty list.
             topic_model_kwargs (dict): Additional keyword arguments for the topic model.
             embedding_cache (pl.DataFrame): Optional cache of embeddings to use for the documents.
-                Should be a polars DataFrame with 'text' and 'embedding' columns.
+                Should be a polars DataFrame with 'text' and 'embedding' columns. With a quantized `embedding_dtype`, float embeddings are quantized,
+                and a cache of quantized codes should also have an 'embedding_scale' column.
             max_layers (int): Maximum number of hierarchical topic model layers to use when generating higher-level targets. Defaults to 2.
 
         Returns:
@@ -238,7 +335,11 @@ class StanceMining:
             assert 'embedding' in embedding_cache.columns, "embedding_cache must have an 'embedding' column"
             assert isinstance(embedding_cache.schema['embedding'], pl.Array), "embedding_cache column 'embedding' must be an array of floats"
             assert isinstance(embedding_cache.schema['text'], pl.String), "embedding_cache column 'text' must be a string"
+            if self.embedding_dtype != 'float32' and 'embedding_scale' not in embedding_cache.columns:
+                embedding_cache = pl.DataFrame([embedding_cache['text'], *self._get_embedding_cache_columns(embedding_cache['embedding'].to_numpy())])
             self.embedding_cache_df = embedding_cache
+
+        self._embedding_reducer = self._get_embedding_reducer()
         
         if isinstance(docs, list):
             document_df = pl.DataFrame({text_column: docs}).with_row_index(name='ID')
@@ -248,43 +349,53 @@ class StanceMining:
             if 'ID' not in document_df.columns:
                 document_df = document_df.with_row_index(name='ID')
         
-        logger.info("Loading embedding model...")
-        embed_model = None
-        if 'Targets' not in document_df.columns:
-            if generate_targets:
-                logger.info("Getting base targets")
-                embed_model = self._get_embedding_model()
-                document_df = self.get_base_targets(docs, embedding_model=embed_model, text_column=text_column, parent_text_column=parent_text_column)
+        if self.llm_method == 'finetuned' and self._server_client is None:
+            # reuse loaded models and adapters across target extraction and stance detection
+            self._predictor_session = self._get_predictor_session(extract_targets=generate_targets and 'Targets' not in document_df.columns, get_stance=get_stance)
+
+        try:
+            logger.info("Loading embedding model...")
+            embed_model = None
+            if 'Targets' not in document_df.columns:
+                if generate_targets:
+                    logger.info("Getting base targets")
+                    embed_model = self._get_embedding_model()
+                    document_df = self.get_base_targets(docs, embedding_model=embed_model, text_column=text_column, parent_text_column=parent_text_column)
         
-            if targets and not generate_targets:
-                logger.info("Using provided targets")
-                document_df = document_df.with_columns(pl.lit(targets).alias('Targets'))
-            elif targets and generate_targets:
-                logger.info("Adding provided targets to generated targets")
-                document_df = document_df.with_columns(
-                    pl.col('Targets').list.concat(pl.lit(targets))
-                )
-        else:
-            assert isinstance(document_df.schema['Targets'], pl.List), "Targets column must be a list of strings"
-            logger.info("Using existing targets in DataFrame")
+                if targets and not generate_targets:
+                    logger.info("Using provided targets")
+                    document_df = document_df.with_columns(pl.lit(targets).alias('Targets'))
+                elif targets and generate_targets:
+                    logger.info("Adding provided targets to generated targets")
+                    document_df = document_df.with_columns(
+                        pl.col('Targets').list.concat(pl.lit(targets))
+                    )
+            else:
+                assert isinstance(document_df.schema['Targets'], pl.List), "Targets column must be a list of strings"
+                logger.info("Using existing targets in DataFrame")
         
-        # cluster initial stance targets
-        logger.debug("Exploding targets to get unique targets")
-        if generate_higher_level_targets:
-            if embed_model is None:
-                embed_model = self._get_embedding_model()
-            document_df, cluster_df = self._generate_higher_level_targets(document_df, embed_model, topic_model_kwargs, max_layers)
-
-        if generate_targets and deduplicate_all_targets:
-            logger.info("Removing similar stance targets")
-            # remove targets that are too similar
-            if embed_model is None:
-                embed_model = self._get_embedding_model()
-            document_df = self._filter_all_similar_targets(document_df, embed_model)
-
-        if get_stance:
-            logger.info("Getting stance classifications for targets")
-            document_df = self.get_stance(document_df, text_column=text_column, parent_text_column=parent_text_column)
+            # cluster initial stance targets
+            logger.debug("Exploding targets to get unique targets")
+            if generate_higher_level_targets:
+                if embed_model is None:
+                    embed_model = self._get_embedding_model()
+                document_df, cluster_df = self._generate_higher_level_targets(document_df, embed_model, topic_model_kwargs, max_layers)
+
+            if generate_targets and deduplicate_all_targets:
+                logger.info("Removing similar stance targets")
+                # remove targets that are too similar
+                if embed_model is None:
+                    embed_model = self._get_embedding_model()
+                document_df = self._filter_all_similar_targets(document_df, embed_model)
+
+            if get_stance:
+                logger.info("Getting stance classifications for targets")
+                document_df = self.get_stance(document_df, text_column=text_column, parent_text_column=parent_text_column)
+        finally:
+            # free loaded models even if a step fails, so the instance can be reused
+            if self._predictor_session is not None:
+                self._predictor_session.unload()
+                self._predictor_session = None
 
         logger.info("Getting target info")
         self.target_info = document_df.explode('Targets')\
@@ -304,9 +415,32 @@ class StanceMining:
 
         logger.info("Done")
         return document_df
+
+    def _get_predictor_session(self, extract_targets=True, get_stance=True):
+        """Get a session keeping finetuned models loaded across target extraction and stance detection.
+
+        vLLM sessions keep one engine per engine task. Target extraction always runs on a 'generate' engine, 
+        and stance detection shares it only if stance is classified by generation, as the default stance head runs on its own 'classify' engine.
+        GPU memory is split between the engines of the operations that will run.
+        """
+        if self.model_inference == 'vllm':
+            engine_tasks = set()
+            if extract_targets:
+                engine_tasks.add('generate')
+            if get_stance:
+                engine_tasks.add('classify' if self.stance_detection_finetune_kwargs['classification_method'] == 'head' else 'generate')
+            return llms.VLLMSession(num_engines=max(len(engine_tasks), 1))
+        elif self.model_inference == 'transformers':
+            return finetune.TransformersSession()
+        elif self.model_inference == 'openai-compatible':
+            return llms.OpenAICompatibleSession()
+        else:
+            raise ValueError(f"Cannot run finetuned LLM with model_inference method: {self.model_inference}")
     
 
     def _get_embedding_model(self):
+        if self._server_client is not None:
+            return self._server_client
         if self.embedding_model_inference == 'vllm':
             try:
                 model = utils.VLLMEmbedder(model=self.embedding_model, kwargs={'gpu_memory_utilization': 0.1})
@@ -319,32 +453,78 @@ class StanceMining:
             raise ValueError(f"Embedding model inference method '{self.embedding_model_inference}' not implemented")
         return model
 
+    def _get_embedding_reducer(self):
+        if self.embedding_reduction is None or isinstance(self.embedding_reduction, utils.EmbeddingReducer):
+            return self.embedding_reduction
+        # a new reducer per run, fitted to the first embeddings it reduces
+        return utils.EmbeddingReducer(method=self.embedding_reduction, n_components=self.embedding_reduction_dims)
+
+    def _get_embedding_cache_columns(self, embeddings: np.ndarray, batch_size: int = 100000) -> List[pl.Series]:
+        if self.embedding_dtype == 'float32':
+            if isinstance(embeddings, np.memmap):
+                # copied out of the memory-mapped file, which is removed once cached
+                embeddings = np.array(embeddings)
+            return [utils.EmbeddingBuffer(embeddings).to_polars('embedding')]
+        # quantized in batches, so embeddings read from a memory-mapped file are never all in memory as float32
+        codes, scales = None, np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), batch_size):
+            quantized_embeddings = utils.quantize_embeddings(embeddings[start:start + batch_size], self.embedding_dtype)
+            if codes is None:
+                codes = np.empty((len(embeddings), embeddings.shape[1]), dtype=quantized_embeddings.codes.dtype)
+            codes[start:start + batch_size] = quantized_embeddings.codes
+            scales[start:start + batch_size] = quantized_embeddings.scales
+        return [
+            utils.EmbeddingBuffer(utils._codes_to_storage(codes), dtype=None).to_polars('embedding'),
+            pl.Series(name='embedding_scale', values=scales),
+        ]
+
+    def _get_cached_embedding_df(self, docs: Union[List[str], pl.Series], model) -> pl.DataFrame:
+        """Get the embedding cache rows of documents in order, embedding and caching documents missing from the cache."""
+        if isinstance(docs, pl.Series):
+            document_df = docs.rename('text').to_frame()
+        else:
+            document_df = pl.DataFrame({'text': docs})
+        missing_docs = document_df.unique('text').join(self.embedding_cache_df, on='text', how='anti')
+        if len(missing_docs) > 0:
+            logger.debug(f"Computing embeddings for {len(missing_docs)} missing documents")
+            if isinstance(model, utils.Embedder) and len(missing_docs) >= self.embedding_file_min_texts:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    new_embeddings = model.encode_to_file(missing_docs['text'], os.path.join(tmp_dir, 'embeddings.npy'), show_progress_bar=self.verbose)
+                    cache_columns = self._get_embedding_cache_columns(new_embeddings)
+                    del new_embeddings
+            else:
+                new_embeddings = model.encode(missing_docs['text'].to_list(), show_progress_bar=self.verbose)
+                cache_columns = self._get_embedding_cache_columns(new_embeddings)
+            # cache embeddings
+            logger.debug("Updating embedding cache")
+            missing_docs = missing_docs.with_columns(cache_columns)
+            self.embedding_cache_df = pl.concat([self.embedding_cache_df, missing_docs], how='diagonal_relaxed')
+        # gather from the cache once, so document embeddings are only materialized once
+        return document_df.join(self.embedding_cache_df, on='text', how='left', maintain_order='left')
+
+    def _get_quantized_embeddings(self, docs: Union[List[str], pl.Series], model=None) -> utils.QuantizedEmbeddings:
+        """Get embeddings quantized to `self.embedding_dtype`, which are cached in their quantized form."""
+        if model is None:
+            model = self._get_embedding_model()
+        if not self.use_embedding_cache:
+            embeddings = model.encode(docs, show_progress_bar=self.verbose)
+            return utils.quantize_embeddings(embeddings, self.embedding_dtype)
+
+        document_df = self._get_cached_embedding_df(docs, model)
+        codes = utils.EmbeddingBuffer.from_polars(document_df['embedding'], dtype=None).numpy()
+        return utils.QuantizedEmbeddings(utils._codes_from_storage(codes, self.embedding_dtype), document_df['embedding_scale'].to_numpy())
+
     def _get_embeddings(self, docs: Union[List[str], pl.Series], model=None) -> np.ndarray:
         if model is None:
             model = self._get_embedding_model()
+        if self.embedding_dtype != 'float32':
+            return self._get_quantized_embeddings(docs, model=model).dequantize()
         if self.use_embedding_cache:
-            # check for cached embeddings
-            if isinstance(docs, pl.Series):
-                document_df = docs.rename('text').to_frame()
-            else:
-                document_df = pl.DataFrame({'text': docs})
-            document_df = document_df.join(self.embedding_cache_df, on='text', how='left', maintain_order='left')
-            missing_docs = document_df.unique('text').filter(pl.col('embedding').is_null())
-            if len(missing_docs) > 0:
-                logger.debug(f"Computing embeddings for {len(missing_docs)} missing documents")
-                new_embeddings = model.encode(missing_docs['text'].to_list(), show_progress_bar=self.verbose).astype(np.float32)
-                
-                missing_docs = missing_docs.with_columns(pl.Series(name='embedding', values=new_embeddings))
-                # cache embeddings
-                logger.debug("Updating embedding cache")
-                self.embedding_cache_df = pl.concat([self.embedding_cache_df, missing_docs], how='diagonal_relaxed')
-                # add new embeddings to document_df
-                document_df = document_df.join(missing_docs, on='text', how='left', maintain_order='left')\
-                    .with_columns(pl.coalesce(['embedding', 'embedding_right']))\
-                    .drop('embedding_right')
-            embeddings = document_df['embedding'].to_numpy()
+            document_df = self._get_cached_embedding_df(docs, model)
+            # a view of the gathered embedding column, rather than a copy
+            embeddings = utils.EmbeddingBuffer.from_polars(document_df['embedding']).numpy()
         else:
-            embeddings = model.encode(docs, show_progress_bar=self.verbose).astype(np.float32)
+            embeddings = utils.EmbeddingBuffer(model.encode(docs, show_progress_bar=self.verbose)).numpy()
 
         return embeddings
 
@@ -361,35 +541,43 @@ class StanceMining:
 
     def _ask_llm_stance_target(self, docs: List[str]):
         num_samples = 3
+        if self._server_client is not None:
+            return self._server_client.extract_targets(docs)
         if self.llm_method == 'prompting':
             llm = self._get_llm()
-            targets = prompting.ask_llm_zero_shot_stance_target(llm, docs, {'num_samples': num_samples})
+            # generated targets are lowercased and normalized as they are parsed, see `prompting.parse_generated_targets`
+            return prompting.ask_llm_zero_shot_stance_target(llm, docs, {'num_samples': num_samples})
         elif self.llm_method == 'finetuned':
             df = pl.DataFrame({'Text': docs})
 
-            # TODO add guided decoding to generate list
-
             task_type = 'topic-extraction' if self.stance_target_type == 'noun-phrases' else 'claim-extraction'
 
             if self.model_inference == 'transformers':
-                results = finetune.get_predictions(task_type, df, self.target_extraction_finetune_kwargs, model_kwargs=self.target_extraction_model_kwargs, generate_kwargs=self.target_extraction_generation_kwargs)
+                results = finetune.get_predictions(task_type, df, self.target_extraction_finetune_kwargs, model_kwargs=self.target_extraction_model_kwargs, generate_kwargs=self.target_extraction_generation_kwargs, session=self._predictor_session)
             elif self.model_inference == 'vllm':
-                results = llms.get_vllm_predictions(task_type, df, self.target_extraction_finetune_kwargs, verbose=self.verbose, model_kwargs=self.target_extraction_model_kwargs, generate_kwargs=self.target_extraction_generation_kwargs)
+                # targets are normalized chunk by chunk, so completions for all documents are never held at once
+                targets = []
+                for results in llms.iter_vllm_predictions(task_type, df, self.target_extraction_finetune_kwargs, verbose=self.verbose, model_kwargs=self.target_extraction_model_kwargs, generate_kwargs=self.target_extraction_generation_kwargs, session=self._predictor_session):
+                    targets.extend(self._results_to_targets(results))
+                return targets
+            elif self.model_inference == 'openai-compatible':
+                results = llms.get_openai_compatible_predictions(task_type, df, self.target_extraction_finetune_kwargs, verbose=self.verbose, model_kwargs=self.target_extraction_model_kwargs, generate_kwargs=self.target_extraction_generation_kwargs, session=self._predictor_session)
             else:
                 raise ValueError(f"Cannot run finetuned LLM with model_inference method: {self.model_inference}")
-
-            if isinstance(results[0], str):
-                targets = [[r] for r in results]
-            else:
-                targets = results
+            return self._results_to_targets(results)
         else:
             raise ValueError(f"Unrecognised self.llm_method value: {self.llm_method}")
-        target_df = pl.DataFrame({'Targets': targets})
-        target_df = target_df.with_columns(utils._filter_stance_targets(target_df['Targets']))
-        return target_df['Targets'].to_list()
+
+    def _results_to_targets(self, results) -> List[List[str]]:
+        if len(results) > 0 and isinstance(results[0], str):
+            results = [[r] for r in results]
+        # the one normalization pass of parsed list completions, later steps rely on targets being normalized here
+        return utils._filter_stance_targets(pl.Series('Targets', results, dtype=pl.List(pl.String))).to_list()
 
     def _ask_llm_stance(self, docs, stance_targets, parent_docs=None):
         task = 'stance-classification' if self.stance_target_type == 'noun-phrases' else 'claim-entailment-7way'
+        if self._server_client is not None:
+            return self._server_client.classify_stance(docs, stance_targets, parent_docs=parent_docs)
         if self.llm_method == 'prompting':
             llm = self._get_llm()
             assert parent_docs is None, "Parent documents not supported for prompting stance detection"
@@ -399,15 +587,79 @@ class StanceMining:
             if isinstance(data.schema['ParentTexts'], pl.String):
                 # convert to list
                 data = data.with_columns(pl.col('ParentTexts').cast(pl.List(pl.String)))
-            if self.model_inference == 'transformers':
-                results = finetune.get_predictions(task, data, self.stance_detection_finetune_kwargs, model_kwargs=self.stance_detection_model_kwargs)
-            elif self.model_inference == 'vllm':
-                results = llms.get_vllm_predictions(task, data, self.stance_detection_finetune_kwargs, verbose=self.verbose, model_kwargs=self.stance_detection_model_kwargs, generate_kwargs=self.stance_detection_generation_kwargs)
-            else:
-                raise ValueError(f"Cannot run finetuned LLM with model_inference method: {self.model_inference}")
+            if self.stance_cascade_threshold is not None:
+                return self._ask_llm_stance_cascade(task, data)
+            if self.model_inference == 'vllm':
+                # stances are consumed chunk by chunk, rather than collecting the predictions of every pair first
+                results = []
+                for chunk in llms.iter_vllm_predictions(task, data, self.stance_detection_finetune_kwargs, verbose=self.verbose, model_kwargs=self.stance_detection_model_kwargs, generate_kwargs=self.stance_detection_generation_kwargs, session=self._predictor_session):
+                    results.extend(r.upper() for r in chunk)
+                return results
+            results = self._get_finetuned_stance(task, data)
             results = [r.upper() for r in results]
             return results
 
+    def _get_finetuned_stance(self, task, data, return_probs=False):
+        if self.model_inference == 'transformers':
+            return finetune.get_predictions(task, data, self.stance_detection_finetune_kwargs, model_kwargs=self.stance_detection_model_kwargs, session=self._predictor_session, return_probs=return_probs)
+        elif self.model_inference == 'vllm':
+            return llms.get_vllm_predictions(task, data, self.stance_detection_finetune_kwargs, verbose=self.verbose, model_kwargs=self.stance_detection_model_kwargs, generate_kwargs=self.stance_detection_generation_kwargs, session=self._predictor_session, return_probs=return_probs)
+        elif self.model_inference == 'openai-compatible':
+            return llms.get_openai_compatible_predictions(task, data, self.stance_detection_finetune_kwargs, verbose=self.verbose, model_kwargs=self.stance_detection_model_kwargs, generate_kwargs=self.stance_detection_generation_kwargs, session=self._predictor_session, return_probs=return_probs)
+        else:
+            raise ValueError(f"Cannot run finetuned LLM with model_inference method: {self.model_inference}")
+
+    def _ask_llm_stance_cascade(self, task, data):
+        """Classify stances with the finetuned model, and re-classify low confidence pairs by prompting the base LLM.
+
+        Escalated pairs are classified without their parent documents. Escalation statistics, and the model, pairs and seconds of each tier, 
+        are stored in `self.stance_cascade_report`.
+        """
+        start_time = time.time()
+        results, probs = self._get_finetuned_stance(task, data, return_probs=True)
+        results = [r.upper() for r in results]
+        fast_path_seconds = time.time() - start_time
+
+        escalate_idxs = np.nonzero(probs.max(axis=1) < self.stance_cascade_threshold)[0] if len(results) > 0 else np.array([], dtype=int)
+        start_time = time.time()
+        if len(escalate_idxs) > 0:
+            # free the finetuned models before loading the base LLM
+            if self._predictor_session is not None:
+                self._predictor_session.unload()
+                self._predictor_session = None
+            escalate_df = data[escalate_idxs]
+            llm = self._get_llm()
+            escalated_results = prompting.ask_llm_zero_shot_stance(llm, escalate_df['Text'].to_list(), escalate_df['Target'].to_list(), stance_target_type=self.stance_target_type, verbose=self.verbose)
+            llm.unload_model()
+            for idx, result in zip(escalate_idxs, escalated_results):
+                results[idx] = result
+        escalation_seconds = time.time() - start_time
+
+        finetuned_model = self.stance_detection_finetune_kwargs.get('model_path', self.stance_detection_finetune_kwargs.get('hf_model'))
+        tiers = [
+            ('finetuned', finetuned_model, len(results), fast_path_seconds),
+            ('prompting', self.model_name, len(escalate_idxs), escalation_seconds),
+        ]
+        self.stance_cascade_report = {
+            'threshold': self.stance_cascade_threshold,
+            'num_pairs': len(results),
+            'num_escalated': len(escalate_idxs),
+            'escalation_rate': len(escalate_idxs) / len(results) if len(results) > 0 else 0.0,
+            'fast_path_seconds': fast_path_seconds,
+            'escalation_seconds': escalation_seconds,
+            'tiers': {
+                tier: {
+                    'model': model,
+                    'num_pairs': num_pairs,
+                    'seconds': seconds,
+                    'seconds_per_pair': seconds / num_pairs if num_pairs > 0 else 0.0,
+                }
+                for tier, model, num_pairs, seconds in tiers
+            },
+        }
+        logger.info(f"Escalated {len(escalate_idxs)} of {len(results)} stance pairs below confidence {self.stance_cascade_threshold} to {self.model_name}")
+        return results
+
     def _filter_document_similar_targets(self, phrases_list: pl.Series, embedding_model=None, similarity_threshold: float = 0.8) -> pl.Series:
         """Filter similar phrases.
         
@@ -437,13 +689,21 @@ class StanceMining:
         target_df = df.explode('Targets')
         
         # Get embeddings for all phrases at once
-        all_embeddings = self._get_embeddings(target_df['Targets'], model=embedding_model)
+        if self._embedding_reducer is not None:
+            all_embeddings = self._embedding_reducer.reduce(self._get_embeddings(target_df['Targets'], model=embedding_model))
+            if self.embedding_dtype != 'float32':
+                all_embeddings = utils._codes_to_storage(utils.quantize_embeddings(all_embeddings, self.embedding_dtype).codes)
+        elif self.embedding_dtype == 'float32':
+            all_embeddings = self._get_embeddings(target_df['Targets'], model=embedding_model)
+        else:
+            # cosine similarity doesn't depend on per-vector scales, so only the quantized codes are needed
+            all_embeddings = utils._codes_to_storage(self._get_quantized_embeddings(target_df['Targets'], model=embedding_model).codes)
         
-        target_df = target_df.with_columns(pl.Series(name='embeddings', values=all_embeddings))
+        target_df = target_df.with_columns(utils.EmbeddingBuffer(all_embeddings, dtype=None).to_polars('embeddings'))
         target_df = target_df.select(['index', pl.struct(['Targets', 'embeddings']).alias('target_embeds')])
         df = target_df.group_by('index').agg(pl.col('target_embeds')).with_columns(pl.col('target_embeds').list.len().alias('target_len'))
 
-        filter_phrases = functools.partial(utils._filter_phrases, similarity_threshold=self.cosine_similarity_threshold)
+        filter_phrases = functools.partial(utils._filter_phrases, similarity_threshold=self.cosine_similarity_threshold, embedding_dtype=self.embedding_dtype)
 
         df = df.with_columns(
             pl.when(pl.col('target_len') > 1)
@@ -479,17 +739,44 @@ class StanceMining:
             max_distance = 0.2
         elif self.stance_target_type == 'claims':
             max_distance = 0.1
+        if self.measure_quantization_recall and self.embedding_dtype != 'float32':
+            self._measure_quantized_recall(target_df['Target'], embedding_model, max_distance)
         batch_size = 2500000
-        if len(target_df) <= batch_size:
-            target_mapper = utils._get_similar_target_mapper(target_df, embedding_model=embedding_model, max_distance=max_distance)
+        if self.dedup_num_workers != 1:
+            # the same exact search as with one worker, with row blocks sharded across processes and merged through global connected components
+            target_mapper = utils._get_similar_target_mapper(
+                target_df, embedding_model=embedding_model, max_distance=max_distance, method='exact', num_workers=self.dedup_num_workers, 
+                embedding_dtype=self.embedding_dtype, embedding_reducer=self._embedding_reducer
+            )
+        elif len(target_df) <= batch_size:
+            target_mapper = utils._get_similar_target_mapper(
+                target_df, embedding_model=embedding_model, max_distance=max_distance, embedding_dtype=self.embedding_dtype, embedding_reducer=self._embedding_reducer
+            )
         else:
-            target_mapper = utils._get_similar_target_mapper_batch(target_df, embedding_model=embedding_model, max_embedding_distance=max_distance, batch_size=batch_size)
+            target_mapper = utils._get_similar_target_mapper_batch(
+                target_df, embedding_model=embedding_model, max_embedding_distance=max_distance, batch_size=batch_size, embedding_reducer=self._embedding_reducer
+            )
         logger.debug("Replacing small count targets with larger count similar targets")
         documents_df = documents_df.with_columns(
             pl.col('Targets').list.eval(pl.element().replace(target_mapper)).list.unique()
         )
         return documents_df
 
+    def _measure_quantized_recall(self, targets: pl.Series, embedding_model, max_distance: float, sample_size: int = 10000):
+        """Measure the recall of similar target search over quantized embeddings against float32, on a sample of targets, storing it in `self.quantization_report`."""
+        if embedding_model is None:
+            embedding_model = self._get_embedding_model()
+        sample_targets = targets.sample(min(len(targets), sample_size), seed=0)
+        # embedded afresh, as the cache only holds quantized embeddings
+        embeddings = embedding_model.encode(sample_targets.to_list(), show_progress_bar=self.verbose)
+        if self._embedding_reducer is not None:
+            embeddings = self._embedding_reducer.reduce(embeddings)
+        self.quantization_report = utils.measure_quantized_recall(embeddings, max_distance=max_distance, embedding_dtype=self.embedding_dtype, sample_size=sample_size)
+        logger.info(
+            f"{self.embedding_dtype} similar target search found {self.quantization_report['recall']:.1%} of float32 pairs "
+            f"at {self.quantization_report['precision']:.1%} precision, with {self.quantization_report['quantized_bytes'] / self.quantization_report['bytes']:.0%} of the memory"
+        )
+
     def _topic_model(self, targets, embedding_model, kwargs, max_layers):
         if self.topic_model == 'toponymy':
             results = self._toponymy_topic_model(targets, embedding_model, kwargs, max_layers)
@@ -553,6 +840,8 @@ class StanceMining:
         batch_size = 2500000
         if len(targets) <= batch_size:
             embeddings = self._get_embeddings(targets, model=embedding_model)
+            if self._embedding_reducer is not None:
+                embeddings = self._embedding_reducer.reduce(embeddings)
 
             # Reduce dimensionality and fit UMAP model
             umap_embeddings = topic_model._reduce_dimensionality(embeddings)
@@ -563,6 +852,8 @@ class StanceMining:
             for i in tqdm(range(0, len(targets), batch_size), desc="Computing embeddings for targets in batches"):
                 batch_texts = targets[i:i+batch_size]
                 batch_embeddings = self._get_embeddings(batch_texts, model=embedding_model)
+                if self._embedding_reducer is not None:
+                    batch_embeddings = self._embedding_reducer.reduce(batch_embeddings)
 
                 if i == 0:
                     batch_umap_embeddings = umap_model.fit_transform(batch_embeddings)
@@ -778,25 +1069,114 @@ class StanceMining:
             if 'ID' not in documents_df.columns:
                 documents_df = documents_df.with_row_index(name='ID')
 
-        stance_targets = self._ask_llm_stance_target(documents_df[text_column])
+        if self.document_triage is not None:
+            keep = self._triage_documents(documents_df[text_column], embedding_model)
+            stance_targets = [[] for _ in range(len(documents_df))]
+            keep_idxs = np.nonzero(keep)[0]
+            if len(keep_idxs) > 0:
+                for idx, targets in zip(keep_idxs, self._extract_document_targets(documents_df[text_column].gather(keep_idxs))):
+                    stance_targets[idx] = targets
+        else:
+            stance_targets = self._extract_document_targets(documents_df[text_column])
+        # targets are already normalized and filtered as they are extracted, see `_ask_llm_stance_target`
         documents_df = documents_df.with_columns(pl.Series(name='Targets', values=stance_targets, dtype=pl.List(pl.String)))
 
-        # remove bad targets
-        target_df = documents_df.explode('Targets').rename({'Targets': 'Target'})
-        target_df = utils.remove_bad_targets(target_df)
-        documents_df = documents_df.drop('Targets')\
-            .join(
-                target_df.select(['ID', 'Target']).group_by('ID').agg(pl.col('Target')).rename({'Target': 'Targets'}),
-                on='ID',
-                how='left'
-            )\
-            .with_columns(pl.col('Targets').fill_null([]))  # fill nulls with empty list
-
         documents_df = documents_df.with_columns(self._filter_document_similar_targets(documents_df['Targets'], embedding_model=embedding_model))
         
         return documents_df
 
 
+    def _get_text_windows(self, docs: pl.Series) -> pl.DataFrame:
+        if self._window_tokenizer is None:
+            import transformers
+            tokenizer_name = self.window_tokenizer
+            if tokenizer_name is None and self.llm_method == 'finetuned':
+                tokenizer_name = self.target_extraction_finetune_kwargs.get('model_path', self.target_extraction_finetune_kwargs.get('hf_model'))
+                tokenizer_name = artifacts.resolve_model(tokenizer_name)
+            elif tokenizer_name is None:
+                tokenizer_name = self.model_name
+            self._window_tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_name)
+        return utils.get_text_windows(docs.to_list(), self._window_tokenizer, self.window_tokens, self.window_overlap_tokens)
+
+    def _extract_document_targets(self, docs: pl.Series) -> List[List[str]]:
+        """Extract targets from documents, mapping over windows of long documents and merging the window targets."""
+        if self.window_tokens is None:
+            return self._ask_llm_stance_target(docs)
+
+        window_df = self._get_text_windows(docs)
+        logger.info(f"Extracting targets from {len(window_df)} windows of {len(docs)} documents")
+        window_df = window_df.with_columns(pl.Series(name='Targets', values=self._ask_llm_stance_target(window_df['text']), dtype=pl.List(pl.String)))
+        # merge window targets, in order of first mention
+        doc_targets = window_df.explode('Targets')\
+            .drop_nulls('Targets')\
+            .unique(['index', 'Targets'], keep='first', maintain_order=True)\
+            .group_by('index', maintain_order=True)\
+            .agg(pl.col('Targets'))
+        doc_targets = pl.DataFrame({'index': pl.arange(0, len(docs), eager=True, dtype=pl.UInt32)})\
+            .join(doc_targets, on='index', how='left', maintain_order='left')\
+            .with_columns(pl.col('Targets').fill_null([]))
+        return doc_targets['Targets'].to_list()
+
+    def _ask_llm_windowed_stance(self, docs: pl.Series, stance_targets: pl.Series, parent_docs=None) -> List[str]:
+        """Classify stances in the windows of long documents, merging window stances per document and target.
+
+        Each unique document is windowed once, however many targets it has.
+        The most common non-neutral window stance is used, with ties going to the stance found in the earliest window, or the first window's stance if all windows are neutral.
+        """
+        docs = docs.fill_null('')
+        doc_df = docs.rename('text').to_frame().unique(maintain_order=True).with_row_index('doc_index')
+        window_df = self._get_text_windows(doc_df['text']).rename({'index': 'doc_index'})
+        pair_df = pl.DataFrame({'index': pl.arange(0, len(docs), eager=True, dtype=pl.UInt32), 'Target': stance_targets, 'text': docs})\
+            .join(doc_df, on='text', how='left', maintain_order='left')\
+            .drop('text')
+        if parent_docs is not None:
+            pair_df = pair_df.with_columns(pl.Series('ParentTexts', parent_docs))
+        pair_df = pair_df.join(window_df, on='doc_index', how='left', maintain_order='left')\
+            .with_columns(pl.col('text').str.to_lowercase().str.contains(pl.col('Target').str.to_lowercase(), literal=True).alias('mentions'))\
+            .with_columns(pl.col('mentions').any().over('index').alias('any_mentions'))\
+            .filter(pl.col('mentions') | ~pl.col('any_mentions'))
+        logger.info(f"Classifying stance in {len(pair_df)} window target pairs of {len(docs)} document target pairs, from {len(doc_df)} unique documents")
+
+        window_parent_docs = pair_df['ParentTexts'] if parent_docs is not None else None
+        pair_df = pair_df.with_columns(pl.Series('stance', self._ask_llm_stance(pair_df['text'], pair_df['Target'], parent_docs=window_parent_docs), dtype=pl.String))
+        neutral_stances = ['NEUTRAL', 'DISCUSSING', 'IRRELEVANT']
+        stance_df = pair_df.filter(~pl.col('stance').is_in(neutral_stances))\
+            .group_by('index', 'stance')\
+            .agg(pl.len().alias('count'), pl.col('window').min())\
+            .sort(['index', 'count', 'window'], descending=[False, True, False])\
+            .unique('index', keep='first')\
+            .select('index', 'stance')
+        first_stance_df = pair_df.group_by('index')\
+            .agg(pl.col('stance').sort_by('window').first().alias('first_stance'))
+        return pl.DataFrame({'index': pl.arange(0, len(docs), eager=True, dtype=pl.UInt32)})\
+            .join(stance_df, on='index', how='left', maintain_order='left')\
+            .join(first_stance_df, on='index', how='left', maintain_order='left')\
+            .select(pl.coalesce('stance', 'first_stance'))['stance'].to_list()
+
+    def _triage_documents(self, docs: pl.Series, embedding_model) -> np.ndarray:
+        """Get a mask of documents to extract targets from, storing skip counts in `self.triage_report`."""
+        keep = docs.rename('text').to_frame().select(utils.get_rule_triage_expr('text'))['text'].to_numpy().copy()
+        num_skipped_rules = int((~keep).sum())
+
+        num_skipped_classifier = 0
+        if isinstance(self.document_triage, utils.DocumentTriageClassifier) and keep.any():
+            keep_idxs = np.nonzero(keep)[0]
+            embeddings = self._get_embeddings(docs.gather(keep_idxs), model=embedding_model)
+            classifier_keep = self.document_triage.predict_keep(embeddings)
+            keep[keep_idxs[~classifier_keep]] = False
+            num_skipped_classifier = int((~classifier_keep).sum())
+
+        num_skipped = num_skipped_rules + num_skipped_classifier
+        self.triage_report = {
+            'num_docs': len(docs),
+            'num_skipped_rules': num_skipped_rules,
+            'num_skipped_classifier': num_skipped_classifier,
+            'num_skipped': num_skipped,
+            'skip_rate': num_skipped / len(docs) if len(docs) > 0 else 0.0,
+        }
+        logger.info(f"Triage skipped {num_skipped} of {len(docs)} documents before target extraction")
+        return keep
+
     def get_stance(
             self, 
             document_df: pl.DataFrame, 
@@ -820,7 +1200,10 @@ class StanceMining:
 
         target_df = document_df.explode('Targets').drop_nulls('Targets').rename({'Targets': 'Target'})
         parent_docs = target_df[parent_text_column] if parent_text_column in target_df.columns else None
-        target_stance = self._ask_llm_stance(target_df[text_column], target_df['Target'], parent_docs=parent_docs)
+        if self.window_tokens is not None:
+            target_stance = self._ask_llm_windowed_stance(target_df[text_column], target_df['Target'], parent_docs=parent_docs)
+        else:
+            target_stance = self._ask_llm_stance(target_df[text_column], target_df['Target'], parent_docs=parent_docs)
         target_df = target_df.with_columns(pl.Series(name='stance', values=target_stance))
         
         document_df = document_df.drop('Targets')\
@@ -852,6 +1235,8 @@ class StanceMining:
             return llms.VLLM(self.model_name, self.model_kwargs, verbose=self.verbose)
         elif self.model_inference == 'anthropic':
             return llms.Anthropic(self.model_name, self.model_kwargs)
+        elif self.model_inference == 'openai-compatible':
+            return llms.OpenAICompatible(self.model_name, self.model_kwargs, verbose=self.verbose)
         else:
             raise ValueError(f"LLM library '{self.model_inference}' not implemented")
         
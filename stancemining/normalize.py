@@ -0,0 +1,78 @@
+import functools
+import importlib.resources
+import re
+from typing import FrozenSet, List, Union
+
+import polars as pl
+
+STOPWORD_LANGUAGES = ['english', 'french']
+
+# generation boilerplate removed from targets, earlier phrases take priority over the shorter phrases they contain
+BOILERPLATE_PHRASES = [
+    'the primary stance target of the piece of text is',
+    'the primary stance target of this text is',
+    'the primary stance target in the given text is',
+    'the primary stance target of the text is',
+    'the primary stance target is the noun phrase',
+    'the primary stance target of the given text is',
+    'the primary stance target is',
+    'stance target: 1.',
+    'stance target:',
+    'stance target',
+    'target1',
+    'target2',
+]
+
+# surrounding characters left behind by generation and boilerplate removal
+STRIP_CHARS = ' \t\r\n"\':'
+
+EXCLUDE_TARGETS = ['url', 'rt', 'rt @', '@rt', 'none']
+
+# targets starting with a retweet marker, and targets made only of emojis
+EXCLUDE_PATTERN = r'(?i)^@?rt\b(\s+@?\w+)?|^[\U0001F000-\U0001FFFF\u2600-\u26FF\u2700-\u27BF]+$'
+
+@functools.cache
+def get_stopwords() -> FrozenSet[str]:
+    """Get the stopwords bundled with the package, read once per process."""
+    stopwords = set()
+    for language in STOPWORD_LANGUAGES:
+        text = importlib.resources.files('stancemining').joinpath('data', 'stopwords', f'{language}.txt').read_text(encoding='utf-8')
+        stopwords.update(word for word in text.splitlines() if word)
+    return frozenset(stopwords)
+
+@functools.cache
+def _get_excluded_targets() -> List[str]:
+    return sorted(get_stopwords().union(EXCLUDE_TARGETS))
+
+@functools.cache
+def _get_boilerplate_pattern() -> str:
+    # list numbering and all boilerplate phrases in one case insensitive alternation, so they are removed in a single scan
+    return '(?i)^\\s*\\d+\\.\\s+|' + '|'.join(re.escape(phrase) for phrase in BOILERPLATE_PHRASES)
+
+def get_normalize_expr(expr: pl.Expr, lowercase: bool = True) -> pl.Expr:
+    """Get an expression removing list numbering, boilerplate phrases and surrounding quotes and colons from string targets."""
+    if lowercase:
+        expr = expr.str.to_lowercase()
+    return expr.str.replace_all(_get_boilerplate_pattern(), '').str.strip_chars(STRIP_CHARS)
+
+def get_exclude_expr(expr: pl.Expr) -> pl.Expr:
+    """Get an expression that is true for normalized targets that are empty, stopwords, retweet markers or only emojis."""
+    return expr.is_null()\
+        .or_(expr == '')\
+        .or_(expr.str.to_lowercase().is_in(_get_excluded_targets()))\
+        .or_(expr.str.contains(EXCLUDE_PATTERN))
+
+def normalize_targets(targets: Union[pl.Series, List[str]], lowercase: bool = True) -> pl.Series:
+    """Normalize targets and drop excluded ones, in one pass over the column.
+
+    Args:
+        targets: String targets, or lists of targets per document, which are also deduplicated.
+        lowercase: Whether to lowercase targets.
+    """
+    if not isinstance(targets, pl.Series):
+        targets = pl.Series('Target', targets, dtype=pl.String)
+    if isinstance(targets.dtype, pl.List):
+        normalized = get_normalize_expr(pl.element(), lowercase=lowercase)
+        return targets.list.eval(normalized.filter(~get_exclude_expr(normalized))).list.unique(maintain_order=True)
+    normalized = get_normalize_expr(pl.first(), lowercase=lowercase)
+    return targets.to_frame().select(normalized.filter(~get_exclude_expr(normalized))).to_series()
@@ -1,6 +1,8 @@
+import numpy as np
 import tqdm
 
-from .llms import BaseLLM, get_max_new_tokens, parse_category_completions
+from . import normalize
+from .llms import BaseLLM
 
 NOUN_PHRASE_AGGREGATE_PROMPT = [
     "You are an expert at analyzing and categorizing topics.",
@@ -678,9 +680,8 @@ Stance: """
 ]
 
 def parse_generated_targets(outputs):
-    outputs = [o.replace('stance', '').strip() for o in outputs if o != 'none' and o is not None and o != '']
-    outputs = list(set(outputs))
-    return outputs
+    # remove boilerplate, none responses and duplicates
+    return normalize.normalize_targets(outputs, lowercase=False).unique(maintain_order=True).to_list()
 
 def ask_llm_zero_shot_stance_target(generator: BaseLLM, docs, generate_kwargs):
     
@@ -815,15 +816,15 @@ def ask_llm_zero_shot_stance(generator: BaseLLM, docs, stance_targets, stance_ta
     prompts = []
     if stance_target_type == 'noun-phrases':
         prompt_template = NOUN_PHRASE_STANCE_DETECTION
+        labels = ['FAVOR', 'AGAINST', 'NEUTRAL']
     else:
         prompt_template = CLAIM_STANCE_DETECTION_4_LABELS
+        labels = ['Supporting', 'Refuting', 'Discussing', 'Irrelevant']
     for doc, stance_target in zip(docs, stance_targets):
         # Stance Classification Prompt
-        prompt = [p.format(doc=doc, stance_target=stance_target) for p in prompt_template]
+        prompt = [{'role': p['role'], 'content': p['content'].format(text=doc, target=stance_target)} for p in prompt_template]
         prompts.append(prompt)
 
-    max_new_tokens = get_max_new_tokens()
-
     if prompts[0][-1]['role'] == 'assistant':
         add_generation_prompt = False
         continue_final_message = True
@@ -831,14 +832,30 @@ def ask_llm_zero_shot_stance(generator: BaseLLM, docs, stance_targets, stance_ta
         add_generation_prompt = True
         continue_final_message = False
 
+    try:
+        # read the label probabilities from the next token logits instead of decoding
+        probs = generator.score_labels(
+            prompts, 
+            labels, 
+            add_generation_prompt=add_generation_prompt, 
+            continue_final_message=continue_final_message
+        )
+        return [labels[i].upper() for i in np.argmax(probs, axis=1)]
+    except NotImplementedError:
+        pass
+
     outputs = generator.generate(
         prompts, 
-        max_new_tokens=max_new_tokens, 
+        max_new_tokens=3, 
         num_samples=1, 
         add_generation_prompt=add_generation_prompt, 
         continue_final_message=continue_final_message
     )
-    all_outputs = parse_category_completions(outputs)
+    all_outputs = []
+    for output in outputs:
+        output = output if isinstance(output, str) else output[0]
+        label = next((l for l in labels if l.lower() in output.lower()), labels[-1])
+        all_outputs.append(label.upper())
     return all_outputs
 
 
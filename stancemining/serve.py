@@ -0,0 +1,260 @@
+import concurrent.futures
+import http.server
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import List, Optional
+
+import numpy as np
+
+from stancemining import utils
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """Coalesces items submitted by concurrent requests into batches for a single batch function.
+
+    A batch is run once it holds at least `max_batch_size` items, or once the first request in it has waited `max_wait_ms`.
+    Batches run on a worker thread while holding `lock`, so that batchers sharing a lock never run models at the same time.
+
+    Args:
+        batch_fn: Function mapping a list of items to a list of results of the same length.
+        max_batch_size (int): Number of items at which a batch is run without waiting.
+        max_wait_ms (float): Latency deadline for the first request in a batch, in milliseconds.
+        lock: Lock held while running a batch.
+    """
+    def __init__(self, batch_fn, max_batch_size=256, max_wait_ms=20, lock=None):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.lock = lock if lock is not None else threading.Lock()
+        self.num_batches = 0
+        self.num_items = 0
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, items: list) -> list:
+        """Add items to the next batch, and block until their results are ready."""
+        assert not self._stopped, "Batcher has been stopped"
+        if len(items) == 0:
+            return []
+        future = concurrent.futures.Future()
+        self._queue.put((items, future))
+        return future.result()
+
+    def stop(self):
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            batch_size = len(request[0])
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            stop = False
+            while batch_size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                batch_size += len(request[0])
+            self._run_batch(batch)
+            if stop:
+                return
+
+    def _run_batch(self, batch):
+        items = [item for request_items, _ in batch for item in request_items]
+        try:
+            with self.lock:
+                results = self.batch_fn(items)
+            assert len(results) == len(items), f"Batch function returned {len(results)} results for {len(items)} items"
+        except Exception as ex:
+            for _, future in batch:
+                future.set_exception(ex)
+            return
+        self.num_batches += 1
+        self.num_items += len(items)
+        start = 0
+        for request_items, future in batch:
+            future.set_result(results[start:start + len(request_items)])
+            start += len(request_items)
+
+class StanceMiningServer:
+    """Serves target extraction, stance classification and embedding from models kept loaded in one process.
+
+    Requests to each operation are coalesced into micro-batches, see `MicroBatcher`.
+    Only one batch runs at a time, as all models share the GPU.
+
+    Args:
+        model: `StanceMining` instance to serve, with `llm_method='finetuned'`.
+        host (str): Host to bind to.
+        port (int): Port to bind to.
+        max_batch_size (int): Number of items at which a batch is run without waiting.
+        max_wait_ms (float): Latency deadline for the first request in a batch, in milliseconds.
+    """
+    def __init__(self, model, host='127.0.0.1', port=8765, max_batch_size=256, max_wait_ms=20):
+        assert model.llm_method == 'finetuned', "Only finetuned models can be served, prompting loads its LLM on each call"
+        self.model = model
+        logger.info("Loading models")
+        self.model._predictor_session = self.model._get_predictor_session()
+        self.embedding_model = self.model._get_embedding_model()
+
+        lock = threading.Lock()
+        batcher_kwargs = {'max_batch_size': max_batch_size, 'max_wait_ms': max_wait_ms, 'lock': lock}
+        self.batchers = {
+            'extract-targets': MicroBatcher(self._extract_targets, **batcher_kwargs),
+            'classify-stance': MicroBatcher(self._classify_stance, **batcher_kwargs),
+            'embed': MicroBatcher(self._embed, **batcher_kwargs),
+        }
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self._get_handler())
+
+    def _extract_targets(self, docs):
+        return self.model._ask_llm_stance_target(docs)
+
+    def _classify_stance(self, items):
+        docs, targets, parent_docs = (list(values) for values in zip(*items))
+        if all(p is None for p in parent_docs):
+            parent_docs = None
+        return self.model._ask_llm_stance(docs, targets, parent_docs=parent_docs)
+
+    def _embed(self, texts):
+        return self.embedding_model.encode(texts).astype(np.float32)
+
+    def handle(self, operation: str, body: dict) -> dict:
+        """Run an operation on a request body, returning the response body."""
+        if operation == 'extract-targets':
+            return {'targets': self.batchers[operation].submit(body['docs'])}
+        elif operation == 'classify-stance':
+            parent_docs = body.get('parent_docs') or [None] * len(body['docs'])
+            assert len(body['docs']) == len(body['targets']) == len(parent_docs), "docs, targets and parent_docs must be the same length"
+            return {'stances': self.batchers[operation].submit(list(zip(body['docs'], body['targets'], parent_docs)))}
+        elif operation == 'embed':
+            embeddings = self.batchers[operation].submit(body['texts'])
+            return {'embeddings': np.asarray(embeddings).tolist()}
+        else:
+            raise KeyError(operation)
+
+    def stats(self) -> dict:
+        return {
+            operation: {'num_batches': batcher.num_batches, 'num_items': batcher.num_items}
+            for operation, batcher in self.batchers.items()
+        }
+
+    def _get_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path == '/health':
+                    self._send(200, {'status': 'ok', 'stats': server.stats()})
+                else:
+                    self._send(404, {'error': f"Unknown path: {self.path}"})
+
+            def do_POST(self):
+                operation = self.path.strip('/')
+                if operation not in server.batchers:
+                    self._send(404, {'error': f"Unknown operation: {operation}"})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                except (TypeError, ValueError) as ex:
+                    self._send(400, {'error': f"Invalid request body: {ex}"})
+                    return
+                try:
+                    response = server.handle(operation, body)
+                except (KeyError, AssertionError) as ex:
+                    self._send(400, {'error': f"Invalid request: {ex!r}"})
+                    return
+                except Exception as ex:
+                    logger.exception(f"Failed to run {operation}")
+                    self._send(500, {'error': repr(ex)})
+                    return
+                self._send(200, response)
+
+            def _send(self, status, body):
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+    def serve_forever(self):
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"Serving on http://{host}:{port}")
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.httpd.server_close()
+        for batcher in self.batchers.values():
+            batcher.stop()
+        if self.model._predictor_session is not None:
+            self.model._predictor_session.unload()
+            self.model._predictor_session = None
+
+def _to_list(values):
+    # polars and pandas series are sent as their python values
+    if values is None:
+        return None
+    return values.to_list() if hasattr(values, 'to_list') else list(values)
+
+class StanceMiningClient(utils.Embedder):
+    """Client for a `stancemining serve` process, also usable as the embedding model of `StanceMining`.
+
+    Args:
+        url (str): Root URL of the server, e.g. 'http://127.0.0.1:8765'.
+        timeout (float): Request timeout in seconds.
+    """
+    def __init__(self, url: str, timeout: float = 3600.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _post(self, operation: str, body: dict) -> dict:
+        request = urllib.request.Request(
+            f"{self.url}/{operation}",
+            data=json.dumps(body).encode(),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as ex:
+            raise RuntimeError(f"stancemining server failed to run {operation}: {ex.read().decode()}") from ex
+
+    def extract_targets(self, docs: List[str]) -> List[List[str]]:
+        return self._post('extract-targets', {'docs': _to_list(docs)})['targets']
+
+    def classify_stance(self, docs: List[str], targets: List[str], parent_docs: Optional[List[List[str]]] = None) -> List[str]:
+        return self._post('classify-stance', {'docs': _to_list(docs), 'targets': _to_list(targets), 'parent_docs': _to_list(parent_docs)})['stances']
+
+    def encode(self, texts: List[str], show_progress_bar: bool = None) -> np.ndarray:
+        embeddings = self._post('embed', {'texts': _to_list(texts)})['embeddings']
+        return np.asarray(embeddings, dtype=np.float32)
@@ -3,9 +3,9 @@ import logging
 import math
 import os
 import subprocess
+import time
 from typing import List, Union
 
-from nltk.corpus import stopwords
 import numpy as np
 import polars as pl
 import sklearn.preprocessing
@@ -13,11 +13,86 @@ from tqdm import tqdm
 import torch
 import vllm
 
+from stancemining import normalize
+
 logger = logging.getLogger('StanceMining.utils')
 
 class Embedder:
+    can_encode_token_ids = False
+
     def encode(self, texts: List[str], show_progress_bar: bool = None) -> np.ndarray:
         raise NotImplementedError("Embedder is an abstract base class")
+
+    def get_tokenizer(self):
+        """Get the tokenizer of the embedding model, if it has one, for sorting texts by length."""
+        return None
+
+    def encode_token_ids(self, token_ids: List[List[int]], show_progress_bar: bool = None) -> np.ndarray:
+        """Embed texts already tokenized by `get_tokenizer`, with special tokens added, for embedders that set `can_encode_token_ids`."""
+        raise NotImplementedError(f"{type(self).__name__} cannot embed token ids")
+
+    def _tokenize(self, texts: pl.Series, batch_size: int = 100000):
+        """Get the lengths of texts, and if the embedder can embed token ids, their token ids flattened into one array, with offsets.
+
+        Without a tokenizer, lengths are counted in characters.
+        """
+        tokenizer = self.get_tokenizer()
+        if tokenizer is None:
+            return texts.str.len_chars().to_numpy(), None
+        keep_ids = self.can_encode_token_ids
+        lengths = np.empty(len(texts), dtype=np.int64)
+        all_ids = []
+        for start in range(0, len(texts), batch_size):
+            # token ids that are reused for embedding need the special tokens the model would add
+            input_ids = tokenizer(texts[start:start + batch_size].to_list(), add_special_tokens=keep_ids, verbose=False)['input_ids']
+            lengths[start:start + batch_size] = [len(ids) for ids in input_ids]
+            if keep_ids:
+                all_ids.append(np.fromiter((i for ids in input_ids for i in ids), dtype=np.int32))
+        if not keep_ids:
+            return lengths, None
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        return lengths, (np.concatenate(all_ids), offsets)
+
+    def encode_to_file(self, texts: List[str], path: str, batch_size: int = 10000, dtype=np.float32, show_progress_bar: bool = None) -> np.memmap:
+        """Embed texts into a memory-mapped `.npy` file in input order, without holding all embeddings in memory.
+
+        Texts are embedded in batches of similar token length, so little compute is spent on padding.
+        Embedders that set `can_encode_token_ids` embed the token ids from the length pass, so texts are only tokenized once.
+        Throughput is logged, and stored in `self.encode_report`.
+
+        Returns:
+            np.memmap: Embeddings backed by `path`, which can be reopened with `np.load(path, mmap_mode='r')`.
+        """
+        texts = pl.Series('text', texts, dtype=pl.String).fill_null('')
+        assert len(texts) > 0, "No texts to embed"
+        lengths, token_ids = self._tokenize(texts)
+        order = np.argsort(lengths, kind='stable')
+
+        start_time = time.time()
+        embeddings = None
+        for start in tqdm(range(0, len(texts), batch_size), desc="Embedding batches", disable=not show_progress_bar):
+            batch_idxs = order[start:start + batch_size]
+            if token_ids is None:
+                batch_embeddings = self.encode(texts.gather(batch_idxs).to_list(), show_progress_bar=False)
+            else:
+                flat_ids, offsets = token_ids
+                batch_embeddings = self.encode_token_ids([flat_ids[offsets[i]:offsets[i + 1]].tolist() for i in batch_idxs], show_progress_bar=False)
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(texts), batch_embeddings.shape[1]))
+            embeddings[batch_idxs] = batch_embeddings
+            del batch_embeddings
+        embeddings.flush()
+        duration = time.time() - start_time
+
+        self.encode_report = {
+            'num_texts': len(texts),
+            'num_tokens': int(lengths.sum()),
+            'seconds': duration,
+            'texts_per_second': len(texts) / duration,
+            'tokens_per_second': int(lengths.sum()) / duration,
+        }
+        logger.info(f"Embedded {len(texts)} texts to {path} at {self.encode_report['texts_per_second']:.1f} texts/s, {self.encode_report['tokens_per_second']:.1f} tokens/s")
+        return embeddings
     
 class SentenceTransformerEmbedder(Embedder):
     def __init__(self, model: str = "all-MiniLM-L6-v2", kwargs: dict = {}):
@@ -29,24 +104,303 @@ class SentenceTransformerEmbedder(Embedder):
         logger.debug(f"Generated embeddings with shape {embeddings.shape} using SentenceTransformer model {self.model}")
         return embeddings
 
+    def get_tokenizer(self):
+        return self.model.tokenizer
+
 class VLLMEmbedder(Embedder):
+    can_encode_token_ids = True
+
     def __init__(self, model: str = "all-MiniLM-L6-v2", kwargs: dict = {}):
         self.llm = vllm.LLM(model=model, task='embed', **kwargs)
 
     def encode(self, texts: List[str], show_progress_bar: bool = None) -> np.ndarray:
         outputs = self.llm.embed(texts, use_tqdm=show_progress_bar)
+        return self._outputs_to_array(outputs)
+
+    def encode_token_ids(self, token_ids: List[List[int]], show_progress_bar: bool = None) -> np.ndarray:
+        from vllm.inputs import TokensPrompt
+        outputs = self.llm.embed([TokensPrompt(prompt_token_ids=ids) for ids in token_ids], use_tqdm=show_progress_bar)
+        return self._outputs_to_array(outputs)
+
+    def _outputs_to_array(self, outputs) -> np.ndarray:
         logger.debug(f"Generated {len(outputs)} embeddings with shape {len(outputs[0].outputs.embedding)} using VLLM model {self.llm}")
-        embeddings = np.vstack([np.asarray(o.outputs.embedding, dtype=np.float32) for o in outputs])
+        # fill a preallocated array, rather than stacking a copy of every embedding
+        embeddings = np.empty((len(outputs), len(outputs[0].outputs.embedding)), dtype=np.float32)
+        for i, o in enumerate(outputs):
+            embeddings[i] = o.outputs.embedding
         logger.debug(f"Combined embeddings into array of shape {embeddings.shape}")
         return embeddings
 
-def cluster_target_embeddings(embeddings, max_distance = 0.2):
+    def get_tokenizer(self):
+        return self.llm.get_tokenizer()
+
+class EmbeddingBuffer:
+    """A C-contiguous embedding matrix, exposed without copying as a numpy array, a CPU torch tensor and a polars `Array` column.
+
+    Views alias the buffer's memory, and so the memory of a wrapped polars column or of the numpy array passed in, 
+    so a write through any of them shows up in all the others. Numpy views are read-only. 
+    Torch has no read-only tensors, so the tensor view must not be written to in place.
+
+    Args:
+        embeddings: 2D array of embeddings, copied only if not already contiguous and of `dtype`.
+        dtype: Dtype to store embeddings in, or None to keep their dtype.
+    """
+    def __init__(self, embeddings, dtype=np.float32):
+        self.array = np.ascontiguousarray(embeddings, dtype=dtype)
+        assert self.array.ndim == 2, f"Embeddings must be a 2D matrix, not {self.array.ndim}D"
+
+    @classmethod
+    def from_polars(cls, series: pl.Series, dtype=np.float32) -> 'EmbeddingBuffer':
+        """Wrap the values of a polars `Array` column, which are only copied if the column is chunked, has nulls or is not of `dtype`."""
+        assert isinstance(series.dtype, pl.Array), f"Embeddings must be a polars Array column, not {series.dtype}"
+        if series.n_chunks() > 1:
+            series = series.rechunk()
+        return cls(series.to_numpy(), dtype=dtype)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __len__(self):
+        return len(self.array)
+
+    def numpy(self) -> np.ndarray:
+        view = self.array.view()
+        view.setflags(write=False)
+        return view
+
+    def torch(self) -> torch.Tensor:
+        return torch.from_numpy(self.array)
+
+    def to_polars(self, name: str = 'embedding') -> pl.Series:
+        import pyarrow as pa
+
+        # arrow wraps the numpy memory, and polars imports arrow arrays without copying
+        values = pa.Array.from_buffers(pa.from_numpy_dtype(self.array.dtype), self.array.size, [None, pa.py_buffer(self.array)])
+        return pl.from_arrow(pa.FixedSizeListArray.from_arrays(values, self.array.shape[1])).alias(name)
+
+EMBEDDING_DTYPES = ['float32', 'float16', 'int8']
+
+class QuantizedEmbeddings:
+    """Embeddings stored as float16 or int8 codes with a float32 scale per vector, so that vector `i` is `codes[i] * scales[i]`.
+
+    Slicing dequantizes only the selected rows to float32, so search kernels can stream blocks out of the quantized form.
+    """
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        assert len(codes) == len(scales), "codes and scales must have the same length"
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def embedding_dtype(self) -> str:
+        return np.dtype(self.codes.dtype).name
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index) -> np.ndarray:
+        return np.asarray(self.codes[index], dtype=np.float32) * np.asarray(self.scales[index], dtype=np.float32)[..., None]
+
+    def dequantize(self) -> np.ndarray:
+        return self[:]
+
+def quantize_embeddings(embeddings: np.ndarray, embedding_dtype: str = 'int8') -> QuantizedEmbeddings:
+    """Scalar quantize embeddings with a scale per vector, set from the vector's largest absolute value.
+
+    Args:
+        embedding_dtype: 'int8' for 4x smaller codes, 'float16' for 2x smaller codes, or 'float32' to keep embeddings as they are, with unit scales.
+    """
+    assert embedding_dtype in EMBEDDING_DTYPES, f"Embedding dtype must be one of {EMBEDDING_DTYPES}, not '{embedding_dtype}'"
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embedding_dtype == 'float32':
+        return QuantizedEmbeddings(embeddings, np.ones(len(embeddings), dtype=np.float32))
+
+    max_abs = np.abs(embeddings).max(axis=1)
+    max_abs[max_abs == 0] = 1
+    if embedding_dtype == 'float16':
+        # scaling to [-1, 1] keeps large values within float16 range
+        scales = max_abs
+        codes = (embeddings / scales[:, None]).astype(np.float16)
+    else:
+        scales = max_abs / 127
+        codes = np.rint(embeddings / scales[:, None]).astype(np.int8)
+    return QuantizedEmbeddings(codes, scales.astype(np.float32))
+
+# polars has no float16 dtype, so float16 codes are stored in polars columns as their int16 bit patterns
+def _codes_to_storage(codes: np.ndarray) -> np.ndarray:
+    return codes.view(np.int16) if codes.dtype == np.float16 else codes
+
+def _codes_from_storage(values: np.ndarray, embedding_dtype: str) -> np.ndarray:
+    values = np.ascontiguousarray(values)
+    return values.view(np.float16) if embedding_dtype == 'float16' else values
+
+def _sample_normalized_embeddings(embeddings: np.ndarray, sample_size: int, seed: int) -> np.ndarray:
+    normalized_embeddings = sklearn.preprocessing.normalize(embeddings, axis=1, norm='l2').astype(np.float32)
+    if len(normalized_embeddings) > sample_size:
+        sample_idx = np.sort(np.random.default_rng(seed).choice(len(normalized_embeddings), sample_size, replace=False))
+        normalized_embeddings = normalized_embeddings[sample_idx]
+    return normalized_embeddings
+
+def _get_pair_keys(search_embeddings, max_distance: float) -> np.ndarray:
+    """Get the pairs (i, j), i < j, of unit vectors within `max_distance`, encoded as `i * n_samples + j`."""
+    n_samples = len(search_embeddings)
+    min_similarity, block_size = _get_range_search_params(max_distance, 256 * 1024**2)
+    pairs = [
+        _block_range_search(search_embeddings, i, i + block_size, min_similarity, block_size)
+        for i in range(0, n_samples, block_size)
+    ]
+    if not pairs:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([rows.astype(np.int64) * n_samples + cols for rows, cols in pairs])
+
+def _get_pair_recall_precision(pairs: np.ndarray, found_pairs: np.ndarray):
+    num_found = len(np.intersect1d(pairs, found_pairs))
+    recall = num_found / len(pairs) if len(pairs) > 0 else 1.0
+    precision = num_found / len(found_pairs) if len(found_pairs) > 0 else 1.0
+    return recall, precision
+
+def measure_quantized_recall(embeddings: np.ndarray, max_distance: float = 0.2, embedding_dtype: str = 'int8', sample_size: int = 10000, seed: int = 0) -> dict:
+    """Compare the pairs found within `max_distance` by exact search over quantized embeddings to those found over float32 embeddings.
+
+    Pairs are searched among a random sample of `sample_size` embeddings.
+
+    Returns:
+        dict: 'recall' and 'precision' of the quantized pairs, pair counts, and the bytes taken by float32 and quantized embeddings.
+    """
+    normalized_embeddings = _sample_normalized_embeddings(embeddings, sample_size, seed)
+    quantized_embeddings = quantize_embeddings(normalized_embeddings, embedding_dtype)
+
+    pairs = _get_pair_keys(normalized_embeddings, max_distance)
+    quantized_pairs = _get_pair_keys(quantized_embeddings, max_distance)
+    recall, precision = _get_pair_recall_precision(pairs, quantized_pairs)
+    return {
+        'embedding_dtype': embedding_dtype,
+        'num_samples': len(normalized_embeddings),
+        'num_pairs': len(pairs),
+        'num_quantized_pairs': len(quantized_pairs),
+        'recall': recall,
+        'precision': precision,
+        'bytes': normalized_embeddings.nbytes,
+        'quantized_bytes': quantized_embeddings.nbytes,
+    }
+
+class EmbeddingReducer:
+    """Reduces the dimensionality of embeddings before similarity search.
+
+    Reduced embeddings are L2 normalized, so cosine similarity thresholds still apply to them.
+
+    Args:
+        method: 'pca' to project onto the leading principal directions of a sample of normalized embeddings, fitted without centering so that dot products are preserved,
+            or 'matryoshka' to keep the leading dimensions, for models trained with Matryoshka representation learning.
+        n_components: Number of dimensions to keep.
+        max_fit_samples: Number of embeddings sampled to fit PCA on.
+    """
+    def __init__(self, method: str = 'pca', n_components: int = 128, max_fit_samples: int = 100000, seed: int = 0):
+        assert method in ['pca', 'matryoshka'], f"Embedding reduction method must be either 'pca' or 'matryoshka', not '{method}'"
+        self.method = method
+        self.n_components = n_components
+        self.max_fit_samples = max_fit_samples
+        self.seed = seed
+        self.components = None
+        self.is_fitted = False
+
+    def fit(self, embeddings: np.ndarray) -> 'EmbeddingReducer':
+        assert self.n_components <= embeddings.shape[1], f"Cannot reduce {embeddings.shape[1]} dimensional embeddings to {self.n_components} dimensions"
+        if self.method == 'pca':
+            from sklearn.decomposition import TruncatedSVD
+            sample = _sample_normalized_embeddings(embeddings, self.max_fit_samples, self.seed)
+            svd = TruncatedSVD(n_components=self.n_components, random_state=self.seed).fit(sample)
+            self.components = svd.components_.astype(np.float32)
+            logger.info(f"Fitted PCA to {len(sample)} embeddings, keeping {svd.explained_variance_ratio_.sum():.1%} of variance in {self.n_components} dimensions")
+        self.is_fitted = True
+        return self
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        assert self.is_fitted, "EmbeddingReducer must be fitted before transforming embeddings"
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.method == 'pca':
+            reduced_embeddings = embeddings @ self.components.T
+        else:
+            reduced_embeddings = embeddings[:, :self.n_components]
+        return sklearn.preprocessing.normalize(reduced_embeddings, axis=1, norm='l2')
+
+    def fit_transform(self, embeddings: np.ndarray) -> np.ndarray:
+        return self.fit(embeddings).transform(embeddings)
+
+    def reduce(self, embeddings: np.ndarray) -> np.ndarray:
+        """Transform embeddings, first fitting to them if not yet fitted, so the reducer is fitted once per run."""
+        if not self.is_fitted:
+            self.fit(embeddings)
+        return self.transform(embeddings)
+
+def calibrate_embedding_reduction(embeddings: np.ndarray, max_distance: float = 0.2, method: str = 'pca', dims: List[int] = None, sample_size: int = 10000, seed: int = 0) -> pl.DataFrame:
+    """Report how well dedup over reduced embeddings agrees with dedup over full dimension embeddings, at each candidate dimension.
+
+    Pairs within `max_distance`, and the clusters they connect, are found by exact search among a random sample of `sample_size` embeddings.
+
+    Args:
+        dims: Dimensions to try. Defaults to halving the embedding dimension down to 32.
+
+    Returns:
+        pl.DataFrame: Per dimension, the 'recall' and 'precision' of reduced pairs, and the 'adjusted_rand_index' of reduced clusters against full dimension clusters.
+    """
+    from sklearn.metrics import adjusted_rand_score
+
+    normalized_embeddings = _sample_normalized_embeddings(embeddings, sample_size, seed)
+    n_samples, n_dims = normalized_embeddings.shape
+    if dims is None:
+        dims = [n_dims // 2 ** i for i in range(1, int(math.log2(n_dims)) + 1) if n_dims // 2 ** i >= 32]
+
+    def get_labels(pairs):
+        return _connected_components(n_samples, pairs // n_samples, pairs % n_samples)
+
+    pairs = _get_pair_keys(normalized_embeddings, max_distance)
+    labels = get_labels(pairs)
+    rows = []
+    for n_components in dims:
+        reducer = EmbeddingReducer(method=method, n_components=n_components, seed=seed)
+        reduced_pairs = _get_pair_keys(reducer.fit_transform(normalized_embeddings), max_distance)
+        recall, precision = _get_pair_recall_precision(pairs, reduced_pairs)
+        rows.append({
+            'n_components': n_components,
+            'num_pairs': len(reduced_pairs),
+            'recall': recall,
+            'precision': precision,
+            'adjusted_rand_index': adjusted_rand_score(labels, get_labels(reduced_pairs)),
+        })
+    return pl.DataFrame(rows, schema={'n_components': pl.Int64, 'num_pairs': pl.Int64, 'recall': pl.Float64, 'precision': pl.Float64, 'adjusted_rand_index': pl.Float64})
+
+def cluster_target_embeddings(embeddings, max_distance = 0.2, method='auto', num_workers=1, embedding_dtype='float32'):
+    """Cluster embeddings connected by euclidean distances below `max_distance`, once normalized.
+
+    Args:
+        method: 'cuvs' for GPU approximate search, 'pynndescent' for CPU approximate search, or 'auto' to use cuVS if installed, otherwise pynndescent.
+            'exact' opts into blocked exact search on CPU, which finds every pair but takes time quadratic in the number of embeddings.
+        num_workers: Number of processes to shard exact search across, or None for all cores.
+        embedding_dtype: 'float16' or 'int8' to run exact search over quantized embeddings, see `quantize_embeddings`.
+            Approximate search always uses float32.
+    """
     normalized_embeddings = sklearn.preprocessing.normalize(embeddings, axis=1, norm='l2')
-    
-    try:
+
+    if method == 'auto':
+        try:
+            return _cuvl_clustering(normalized_embeddings, max_distance=max_distance)
+        except ImportError:
+            method = 'pynndescent'
+    if method == 'cuvs':
         return _cuvl_clustering(normalized_embeddings, max_distance=max_distance)
-    except ImportError:
+    elif method == 'pynndescent':
         return _pynndescent_clustering(normalized_embeddings, max_distance=max_distance)
+    elif method == 'exact' and num_workers == 1:
+        return _exact_clustering(normalized_embeddings, max_distance=max_distance, embedding_dtype=embedding_dtype)
+    elif method == 'exact':
+        return _sharded_exact_clustering(normalized_embeddings, max_distance=max_distance, num_workers=num_workers, embedding_dtype=embedding_dtype)
+    else:
+        raise ValueError(f"Unknown clustering method: {method}")
 
 def _propagate_clusters_cupy(cluster_labels, verbose=True):
     import cupy as cp
@@ -73,6 +427,17 @@ def _propagate_clusters_cupy(cluster_labels, verbose=True):
 
     return cluster_labels
 
+def _connected_components(n_samples, rows, cols):
+    """Get consecutive cluster labels of the transitive closure of a similarity edge list."""
+    import scipy.sparse
+    import scipy.sparse.csgraph
+
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    graph = scipy.sparse.coo_matrix((np.ones(len(rows), dtype=np.bool_), (rows, cols)), shape=(n_samples, n_samples)).tocsr()
+    _, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    return labels
+
 def _cuvl_clustering(embeddings, max_distance=0.2, batch_size=10000, verbose=True):
     """GPU-accelerated deduplication using cuVS (RAPIDS)."""
     from cuvs.neighbors import cagra
@@ -100,8 +465,8 @@ def _cuvl_clustering(embeddings, max_distance=0.2, batch_size=10000, verbose=Tru
         itopk_size=itopk_size,
     )
     
-    # Initialize cluster labels
-    cluster_labels = cp.arange(n_samples)
+    all_rows = []
+    all_cols = []
     
     # Process in batches to find neighbors within threshold
     for i in tqdm(range(0, n_samples, batch_size), desc="Finding neighbors", disable=not verbose):
@@ -115,29 +480,11 @@ def _cuvl_clustering(embeddings, max_distance=0.2, batch_size=10000, verbose=Tru
         sq_distances = cp.asarray(sq_distances)
         indices = cp.asarray(indices)
 
-        # Filter by distance threshold
+        # Keep edges to neighbors within threshold
         mask = sq_distances < max_distance ** 2
-        
-        # Merge clusters for points within threshold
-        for j in range(batch_end - i):
-            valid_neighbors = indices[j][mask[j]]
-            if len(valid_neighbors) > 0:
-                # Get minimum cluster label among neighbors
-                neighbor_labels = cluster_labels[valid_neighbors]
-                min_label = cp.min(cp.concatenate([
-                    cp.array([cluster_labels[i + j]]), 
-                    neighbor_labels
-                ]))
-                
-                # Update all connected points
-                cluster_labels[i + j] = min_label
-                cluster_labels[valid_neighbors] = min_label
-    
-    # Propagate cluster assignments (handle transitive closure)
-    cluster_labels = _propagate_clusters_cupy(cluster_labels, verbose=verbose)
-    
-    # Renumber clusters consecutively
-    cluster_labels_cpu = cp.asnumpy(cluster_labels)
+        rows = cp.broadcast_to(cp.arange(i, batch_end)[:, None], mask.shape)
+        all_rows.append(cp.asnumpy(rows[mask]))
+        all_cols.append(cp.asnumpy(indices[mask]))
 
     # Clean up GPU memory
     del embeddings_gpu, index
@@ -145,11 +492,7 @@ def _cuvl_clustering(embeddings, max_distance=0.2, batch_size=10000, verbose=Tru
     pinned_mempool.free_all_blocks()
     cp.cuda.Stream.null.synchronize()
 
-    unique_labels = np.unique(cluster_labels_cpu)
-    label_map = {old: new for new, old in enumerate(unique_labels)}
-    final_labels = np.array([label_map[label] for label in cluster_labels_cpu])
-    
-    return final_labels
+    return _connected_components(n_samples, np.concatenate(all_rows), np.concatenate(all_cols))
 
 def _pynndescent_clustering(normalized_embeddings, max_distance=0.2, n_neighbors=30, batch_size=100000):
     """Alternative: Process in batches with PyNNDescent for very large datasets.
@@ -161,11 +504,8 @@ def _pynndescent_clustering(normalized_embeddings, max_distance=0.2, n_neighbors
         raise ImportError("pynndescent is not installed. Please install it with `pip install pynndescent`.")
     n_samples = len(normalized_embeddings)
     
-    # Initialize with each point in its own cluster
-    cluster_labels = np.arange(n_samples)
-    
     # Build index on full dataset but query in batches
-    print("Building PyNNDescent index...")
+    logger.info("Building PyNNDescent index...")
     index = pynndescent.NNDescent(
         normalized_embeddings,
         n_neighbors=min(n_neighbors, n_samples - 1),
@@ -175,7 +515,9 @@ def _pynndescent_clustering(normalized_embeddings, max_distance=0.2, n_neighbors
         n_jobs=-1
     )
     
-    print("Querying for neighbors in batches...")
+    logger.info("Querying for neighbors in batches...")
+    all_rows = []
+    all_cols = []
     # Process queries in batches to control memory usage
     for i in range(0, n_samples, batch_size):
         batch_end = min(i + batch_size, n_samples)
@@ -184,35 +526,166 @@ def _pynndescent_clustering(normalized_embeddings, max_distance=0.2, n_neighbors
         # Query the index
         neighbors, distances = index.query(batch, k=n_neighbors)
         
-        # Process each point in the batch
-        for j, (point_neighbors, point_distances) in enumerate(zip(neighbors, distances)):
-            global_idx = i + j
-            
-            # Find neighbors within threshold
-            valid_mask = point_distances < max_distance
-            valid_neighbors = point_neighbors[valid_mask]
-            
-            if len(valid_neighbors) > 0:
-                # Find minimum cluster label
-                all_labels = np.append(cluster_labels[valid_neighbors], cluster_labels[global_idx])
-                min_label = np.min(all_labels)
-                
-                # Update labels
-                cluster_labels[global_idx] = min_label
-                cluster_labels[valid_neighbors] = min_label
+        # Keep edges to neighbors within threshold
+        valid_mask = (distances < max_distance) & (neighbors >= 0)
+        rows = np.broadcast_to(np.arange(i, batch_end)[:, None], valid_mask.shape)
+        all_rows.append(rows[valid_mask])
+        all_cols.append(neighbors[valid_mask])
         
         if (i + batch_size) % 500000 == 0:
-            print(f"Processed {min(i + batch_size, n_samples)}/{n_samples} embeddings")
-    
-    # Consolidate cluster labels (transitive closure)
-    print("Consolidating clusters...")
-    unique_labels = np.unique(cluster_labels)
-    label_mapping = {old: new for new, old in enumerate(unique_labels)}
-    cluster_labels = np.array([label_mapping[label] for label in cluster_labels])
+            logger.info(f"Processed {min(i + batch_size, n_samples)}/{n_samples} embeddings")
     
-    print(f"Found {len(unique_labels)} clusters from {n_samples} embeddings")
+    cluster_labels = _connected_components(n_samples, np.concatenate(all_rows), np.concatenate(all_cols))
+    logger.info(f"Found {cluster_labels.max() + 1 if n_samples > 0 else 0} clusters from {n_samples} embeddings")
     return cluster_labels
 
+def _compact_edges(n_samples, rows, cols):
+    """Replace an edge list with one edge from each clustered point to its cluster's root, which keeps the same components."""
+    labels = _connected_components(n_samples, rows, cols)
+    # labels are consecutive, so the first index of each label is its cluster's root
+    _, roots = np.unique(labels, return_index=True)
+    clustered = roots[labels] != np.arange(n_samples)
+    return np.nonzero(clustered)[0], roots[labels[clustered]]
+
+def _block_range_search(embeddings, start, end, min_similarity, block_size):
+    """Get the pairs (i, j), with `start <= i < end` and `i < j`, of unit vectors with similarity of at least `min_similarity`.
+
+    Embeddings can be a float32 array or `QuantizedEmbeddings`, which are dequantized a block at a time.
+    """
+    row_block = np.asarray(embeddings[start:end])
+    all_rows = []
+    all_cols = []
+    for j in range(start, len(embeddings), block_size):
+        similarities = row_block @ np.asarray(embeddings[j:j + block_size]).T
+        rows, cols = np.nonzero(similarities >= min_similarity)
+        if j == start:
+            # the diagonal block is symmetric
+            upper = rows < cols
+            rows, cols = rows[upper], cols[upper]
+        all_rows.append(rows + start)
+        all_cols.append(cols + j)
+    return np.concatenate(all_rows), np.concatenate(all_cols)
+
+def _get_range_search_params(max_distance, max_block_bytes):
+    # distance between unit vectors is sqrt(2 - 2 * cosine similarity)
+    min_similarity = 1 - max_distance ** 2 / 2
+    # similarity blocks are float32, whatever the embedding dtype
+    block_size = max(1, int(math.sqrt(max_block_bytes / np.dtype(np.float32).itemsize)))
+    return min_similarity, block_size
+
+def _get_search_embeddings(normalized_embeddings, embedding_dtype):
+    if embedding_dtype == 'float32':
+        return np.ascontiguousarray(normalized_embeddings, dtype=np.float32)
+    return quantize_embeddings(normalized_embeddings, embedding_dtype)
+
+def _exact_clustering(normalized_embeddings, max_distance=0.2, max_block_bytes=256 * 1024**2, max_edges=10_000_000, embedding_dtype='float32', verbose=True):
+    """Exact range search over tiles of the similarity matrix, computed with BLAS block matmuls.
+
+    Only blocks on or above the diagonal are computed, each at most `max_block_bytes` in size. 
+    Pairs within `max_distance` are streamed into connected components, and the edge list is compacted 
+    to one edge per clustered point whenever it exceeds `max_edges`, so memory stays bounded for dense clusters.
+    With a quantized `embedding_dtype`, embeddings are held quantized and dequantized a block at a time.
+    """
+    embeddings = _get_search_embeddings(normalized_embeddings, embedding_dtype)
+    n_samples = len(embeddings)
+    if n_samples == 0:
+        return np.zeros(0, dtype=np.int32)
+    min_similarity, block_size = _get_range_search_params(max_distance, max_block_bytes)
+
+    all_rows = []
+    all_cols = []
+    num_edges = 0
+    num_blocks = math.ceil(n_samples / block_size)
+    for i in tqdm(range(0, n_samples, block_size), desc="Searching blocks", total=num_blocks, disable=not verbose):
+        rows, cols = _block_range_search(embeddings, i, i + block_size, min_similarity, block_size)
+        all_rows.append(rows)
+        all_cols.append(cols)
+        num_edges += len(rows)
+
+        if num_edges > max_edges:
+            rows, cols = _compact_edges(n_samples, np.concatenate(all_rows), np.concatenate(all_cols))
+            all_rows, all_cols, num_edges = [rows], [cols], len(rows)
+
+    return _connected_components(n_samples, np.concatenate(all_rows), np.concatenate(all_cols))
+
+def _range_search_shard(embeddings_path, start, end, min_similarity, block_size, max_edges, scales_path=None):
+    from threadpoolctl import threadpool_limits
+
+    # the embeddings file is shared by all workers through the page cache
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    if scales_path is not None:
+        embeddings = QuantizedEmbeddings(embeddings, np.load(scales_path, mmap_mode='r'))
+    # one BLAS thread per worker, as each core runs its own worker
+    with threadpool_limits(limits=1):
+        rows, cols = _block_range_search(embeddings, start, end, min_similarity, block_size)
+    if len(rows) > max_edges:
+        rows, cols = _compact_edges(len(embeddings), rows, cols)
+    return rows, cols
+
+def _get_worker_context():
+    import multiprocessing
+
+    # workers are forked from a clean server process rather than from this one, which may hold CUDA contexts and BLAS thread pools,
+    # and the server imports this module once, so that each worker doesn't re-import torch and vllm
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+def _merge_shard_edges(n_samples, futures, max_edges, desc, verbose=True):
+    """Merge the edges of shard futures into global connected components as they complete, compacting the edge list whenever it exceeds `max_edges`."""
+    import concurrent.futures
+
+    all_rows = [np.zeros(0, dtype=np.int64)]
+    all_cols = [np.zeros(0, dtype=np.int64)]
+    num_edges = 0
+    for future in tqdm(concurrent.futures.as_completed(futures), desc=desc, total=len(futures), disable=not verbose):
+        rows, cols = future.result()
+        all_rows.append(rows)
+        all_cols.append(cols)
+        num_edges += len(rows)
+        if num_edges > max_edges:
+            rows, cols = _compact_edges(n_samples, np.concatenate(all_rows), np.concatenate(all_cols))
+            all_rows, all_cols, num_edges = [rows], [cols], len(rows)
+
+    return _connected_components(n_samples, np.concatenate(all_rows), np.concatenate(all_cols))
+
+def _sharded_exact_clustering(normalized_embeddings, max_distance=0.2, num_workers=None, max_block_bytes=64 * 1024**2, max_edges=10_000_000, embedding_dtype='float32', verbose=True):
+    """Exact range search with row blocks of the similarity matrix sharded across worker processes.
+
+    Each worker searches its rows against the full embedding matrix, memory mapped from a temporary file, 
+    and shard edges are merged into global connected components as they complete, compacting the edge list as in `_exact_clustering`.
+    With a quantized `embedding_dtype`, the quantized codes and scales are memory mapped instead.
+    """
+    import concurrent.futures
+    import tempfile
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    embeddings = _get_search_embeddings(normalized_embeddings, embedding_dtype)
+    n_samples = len(embeddings)
+    if n_samples == 0:
+        return np.zeros(0, dtype=np.int32)
+    min_similarity, block_size = _get_range_search_params(max_distance, max_block_bytes)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        embeddings_path = os.path.join(tmp_dir, 'embeddings.npy')
+        scales_path = None
+        if isinstance(embeddings, QuantizedEmbeddings):
+            scales_path = os.path.join(tmp_dir, 'scales.npy')
+            np.save(embeddings_path, embeddings.codes)
+            np.save(scales_path, embeddings.scales)
+        else:
+            np.save(embeddings_path, embeddings)
+        with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=_get_worker_context()) as executor:
+            # blocks nearer the top of the triangle are larger, so are submitted first
+            futures = [
+                executor.submit(_range_search_shard, embeddings_path, start, start + block_size, min_similarity, block_size, max_edges, scales_path)
+                for start in range(0, n_samples, block_size)
+            ]
+            return _merge_shard_edges(n_samples, futures, max_edges, "Searching shards", verbose=verbose)
+
 def _dbscan_clustering(normalized_embeddings, max_distance=0.2):
     fit_kwargs = {}
     try:
@@ -236,18 +709,20 @@ def _dbscan_clustering(normalized_embeddings, max_distance=0.2):
     
     return embed_clusters
 
-def _get_similar_target_mapper(target_df: pl.DataFrame, embedding_model: Union[str, Embedder], max_distance=0.2):
+def _get_similar_target_mapper(target_df: pl.DataFrame, embedding_model: Union[str, Embedder], max_distance=0.2, method='auto', num_workers=1, embedding_dtype='float32', embedding_reducer: EmbeddingReducer = None):
 
     if isinstance(embedding_model, str):
         embedding_model = VLLMEmbedder(model=embedding_model)
 
     embeddings = embedding_model.encode(target_df['Target'].to_list(), show_progress_bar=True)
+    if embedding_reducer is not None:
+        embeddings = embedding_reducer.reduce(embeddings)
 
     assert 'count' in target_df.columns, "target_df must contain 'count' column"
     assert 'Target' in target_df.columns, "target_df must contain 'Target' column"
     assert embeddings.shape[0] == target_df.shape[0], "embeddings must match the number of targets in target_df"
 
-    embed_clusters = cluster_target_embeddings(embeddings, max_distance=max_distance)
+    embed_clusters = cluster_target_embeddings(embeddings, max_distance=max_distance, method=method, num_workers=num_workers, embedding_dtype=embedding_dtype)
     return _clusters_to_mapper(embed_clusters, target_df)
 
 def _clusters_to_mapper(embed_clusters, target_df):
@@ -259,72 +734,78 @@ def _clusters_to_mapper(embed_clusters, target_df):
     target_df = target_df.filter(pl.col('cluster') != -1).join(primary_target_df, on='cluster', how='inner').filter(pl.col('top_target') != pl.col('Target'))
     return {k: v for k, v in target_df.select(['Target', 'top_target']).rows()}
 
-def _propagate_clusters_np(cluster_labels, verbose=True):
-
-    labels_range = np.arange(len(cluster_labels))
-
-    if np.array_equal(np.asarray(cluster_labels), labels_range):
-        return cluster_labels
-
-    for _ in tqdm(range(3), desc="Propagating clusters", disable=not verbose):  # Usually converges in 2-3 iterations
-        needs_update = cluster_labels != labels_range
-        if not needs_update.any():
-            break
-
-        old_labels = cluster_labels[needs_update]
-        new_labels = cluster_labels[old_labels]
-        cluster_labels[needs_update] = new_labels
-
-        if np.array_equal(old_labels, new_labels):
-            break
-    return cluster_labels
-
-def _minhash_clustering(target_df: pl.DataFrame, threshold=0.7):
-    """GPU-accelerated deduplication using cuVS (RAPIDS)"""
-    import datasketch
-
-    # Create LSH index
-    lsh = datasketch.MinHashLSH(threshold=threshold, num_perm=128)
-
-    byte_sets = target_df.select(pl.col('Target').str.split(' ').list.eval(pl.element().cast(pl.Binary)))['Target'].to_list()
-
-    hashes = datasketch.MinHash.bulk(byte_sets)
-    hashes = [datasketch.LeanMinHash(h) for h in hashes]
-    with lsh.insertion_session() as session:
-        for i, h in tqdm(enumerate(hashes), desc='Inserting hashes into LSH', total=len(hashes)):
-            session.insert(i, h)
-
-    n_samples = len(hashes)
-
-    cluster_labels = np.arange(n_samples)
-
-    for i, h in tqdm(enumerate(hashes), desc='Querying hash index', total=n_samples):
-        neighbour_indices = lsh.query(h)[1:] # remove first index because it will be the query hash itself
-
-        # Merge clusters for points within threshold
-        if len(neighbour_indices) > 0:
-            # Get minimum cluster label among neighbors
-            neighbor_labels = cluster_labels[neighbour_indices]
-            min_label = np.min(np.concatenate([
-                np.array([cluster_labels[i]]), 
-                neighbor_labels
-            ]))
-            
-            # Update all connected points
-            cluster_labels[i] = min_label
-            cluster_labels[neighbour_indices] = min_label
-
-    # Propagate cluster assignments (handle transitive closure)
-    cluster_labels = _propagate_clusters_np(cluster_labels, verbose=True)
-    
-    # Renumber clusters consecutively
-    unique_labels = np.unique(cluster_labels)
-    label_map = {old: new for new, old in enumerate(unique_labels)}
-    final_labels = np.array([label_map[label] for label in cluster_labels])
-
-    return final_labels
-
-def _get_similar_target_mapper_batch(target_df: pl.DataFrame, embedding_model: Union[str, Embedder], minhash_threshold=0.7, max_embedding_distance=0.2, batch_size=1000):
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+def _minhash_signatures(targets: pl.Series, num_perm=128, shingle_size=3, seed=0, batch_size=1 << 24) -> np.ndarray:
+    """Compute MinHash signatures of the character shingles of strings, with universal hashing vectorized over shingles and permutations."""
+    shingle_df = targets.rename('Target').to_frame()\
+        .select(pl.col('Target').fill_null('').str.to_lowercase())\
+        .with_row_index('index')\
+        .with_columns(pl.int_ranges(0, pl.max_horizontal(pl.col('Target').str.len_chars().cast(pl.Int64) - shingle_size + 1, 1)).alias('start'))\
+        .explode('start')\
+        .select('index', pl.col('Target').str.slice(pl.col('start'), shingle_size).hash(seed=seed).alias('hash'))\
+        .unique(maintain_order=True)
+    indices = shingle_df['index'].to_numpy()
+    hash_values = shingle_df['hash'].to_numpy() & _MAX_HASH
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    signatures = np.full((len(targets), num_perm), _MAX_HASH, dtype=np.uint64)
+    # bound the (shingles, permutations) matrix to batch_size elements
+    batch_rows = max(1, batch_size // num_perm)
+    for start in range(0, len(hash_values), batch_rows):
+        batch_indices = indices[start:start + batch_rows]
+        # products wrap modulo 2^64, as in datasketch
+        permuted = ((hash_values[start:start + batch_rows, None] * a + b) % _MERSENNE_PRIME) & _MAX_HASH
+        # shingles are sorted by target, so each target's shingles are contiguous
+        segment_starts = np.flatnonzero(np.r_[True, batch_indices[1:] != batch_indices[:-1]])
+        segment_indices = batch_indices[segment_starts]
+        signatures[segment_indices] = np.minimum(signatures[segment_indices], np.minimum.reduceat(permuted, segment_starts, axis=0))
+    return signatures
+
+def _lsh_params(threshold, num_perm):
+    """Get the number of bands and rows per band minimizing the false positive and false negative probability mass at a Jaccard threshold."""
+    similarities = np.linspace(0, 1, 201)
+    below = similarities < threshold
+    best_params, best_error = None, float('inf')
+    for num_bands in range(1, num_perm + 1):
+        for num_rows in range(1, num_perm // num_bands + 1):
+            match_probs = 1 - (1 - similarities ** num_rows) ** num_bands
+            error = np.trapz(match_probs[below], similarities[below]) + np.trapz(1 - match_probs[~below], similarities[~below])
+            if error < best_error:
+                best_params, best_error = (num_bands, num_rows), error
+    return best_params
+
+def _minhash_clustering(target_df: pl.DataFrame, threshold=0.7, num_perm=128, shingle_size=3, seed=0):
+    """Cluster targets whose character shingle sets are connected by MinHash LSH matches."""
+    n_samples = len(target_df)
+    signatures = _minhash_signatures(target_df['Target'], num_perm=num_perm, shingle_size=shingle_size, seed=seed)
+    num_bands, num_rows = _lsh_params(threshold, num_perm)
+    logger.debug(f"Bucketing {n_samples} MinHash signatures into {num_bands} bands of {num_rows} rows")
+
+    # odd multipliers combine the rows of a band into one 64 bit bucket key
+    key_weights = np.random.default_rng(seed).integers(0, 1 << 63, size=num_rows, dtype=np.uint64) | np.uint64(1)
+    indices = np.arange(n_samples, dtype=np.int64)
+    all_rows = []
+    all_cols = []
+    for band in range(num_bands):
+        keys = (signatures[:, band * num_rows:(band + 1) * num_rows] * key_weights).sum(axis=1, dtype=np.uint64)
+        # connect each bucket as a star, which gives the same components as all of its pairs
+        edge_df = pl.DataFrame({'index': indices, 'key': keys})\
+            .group_by('key')\
+            .agg(pl.col('index'))\
+            .filter(pl.col('index').list.len() > 1)\
+            .select(pl.col('index').list.first().alias('root'), pl.col('index').list.slice(1).alias('member'))\
+            .explode('member')
+        all_rows.append(edge_df['root'].to_numpy())
+        all_cols.append(edge_df['member'].to_numpy())
+
+    return _connected_components(n_samples, np.concatenate(all_rows), np.concatenate(all_cols))
+
+def _get_similar_target_mapper_batch(target_df: pl.DataFrame, embedding_model: Union[str, Embedder], minhash_threshold=0.7, max_embedding_distance=0.2, batch_size=1000, embedding_reducer: EmbeddingReducer = None):
     hash_clusters = _minhash_clustering(target_df, threshold=minhash_threshold)
     target_cluster_df = target_df.with_columns(pl.Series(name='cluster', values=hash_clusters))
 
@@ -347,6 +828,8 @@ def _get_similar_target_mapper_batch(target_df: pl.DataFrame, embedding_model: U
         logger.info(f"Finding embedding clusters in minhash clusters batch {batch_i + 1}/{len(batch_df)}")
         batch_targets = batch['Target']
         batch_embeddings = embedding_model.encode(batch_targets, show_progress_bar=True)
+        if embedding_reducer is not None:
+            batch_embeddings = embedding_reducer.reduce(batch_embeddings)
         sub_clusters = _cuvl_clustering(batch_embeddings, max_distance=max_embedding_distance, verbose=True)
         del batch_embeddings
         torch.cuda.empty_cache()
@@ -362,7 +845,13 @@ def _get_similar_target_mapper_batch(target_df: pl.DataFrame, embedding_model: U
 
     return _clusters_to_mapper(embed_clusters, target_df)
 
-def deduplicate_all_similar_targets(document_df: pl.DataFrame, embedding_model_name: str, batch_size: int = 1000, minhash_threshold=0.7, max_embedding_distance: float = 0.1) -> pl.DataFrame:
+def deduplicate_all_similar_targets(document_df: pl.DataFrame, embedding_model_name: str, batch_size: int = 1000, minhash_threshold=0.7, max_embedding_distance: float = 0.1, num_workers: int = 1, embedding_dtype: str = 'float32') -> pl.DataFrame:
+    """Map targets to the most common target among their similar targets.
+
+    With one worker, targets are blocked by MinHash clusters and embedding clusters are found in batches of blocks.
+    With more workers, or `num_workers=None` for all cores, exact embedding search over all targets is sharded across processes,
+    over embeddings quantized to `embedding_dtype`, and shard edges are merged through global connected components.
+    """
     target_df = document_df.select('Targets')\
         .explode('Targets')\
         .drop_nulls()\
@@ -370,7 +859,10 @@ def deduplicate_all_similar_targets(document_df: pl.DataFrame, embedding_model_n
         .group_by('Target')\
         .agg(pl.len().alias('count'))
     
-    target_mapper = _get_similar_target_mapper_batch(target_df, embedding_model_name, minhash_threshold=minhash_threshold, max_embedding_distance=max_embedding_distance, batch_size=batch_size)
+    if num_workers == 1:
+        target_mapper = _get_similar_target_mapper_batch(target_df, embedding_model_name, minhash_threshold=minhash_threshold, max_embedding_distance=max_embedding_distance, batch_size=batch_size)
+    else:
+        target_mapper = _get_similar_target_mapper(target_df, embedding_model_name, max_distance=max_embedding_distance, method='exact', num_workers=num_workers, embedding_dtype=embedding_dtype)
     document_df = document_df.with_columns(
         pl.col('Targets').list.eval(pl.element().replace(target_mapper)).list.unique()
     )
@@ -378,30 +870,9 @@ def deduplicate_all_similar_targets(document_df: pl.DataFrame, embedding_model_n
 
 
 def remove_bad_targets(target_df: pl.DataFrame):
-    phrases = [
-        'the primary stance target of the piece of text is',
-        'the primary stance target of this text is',
-        'the primary stance target in the given text is',
-        'the primary stance target of the text is',
-        'the primary stance target is the noun phrase', 
-        'the primary stance target of the given text is',
-        'the primary stance target is',
-        'stance target: 1.',
-        'stance target:',
-        'stance target',
-        'target1',
-        'target2'
-    ]
-    for phrase in phrases:
-        target_df = target_df.with_columns(pl.col('Target').str.replace(phrase, ''))
-    exclude_phrases = ['', 'url', 'rt', 'rt @', '@rt']
-    target_df = target_df.with_columns(pl.col('Target').str.strip_chars('"').str.strip_chars(':').str.strip_chars())
-    target_df = target_df.filter(~(pl.col('Target').str.contains('rt @\w+'))\
-                              .or_(pl.col('Target').str.contains('rt \w+'))\
-                              .or_(pl.col('Target').str.contains(r'^[\U0001F000-\U0001FFFF\u2600-\u26FF\u2700-\u27BF]+$'))\
-                              .or_(pl.col('Target').is_in(stopwords.words('english') + stopwords.words('french')))\
-                              .or_(pl.col('Target').str.to_lowercase().is_in(exclude_phrases)))
-    return target_df
+    """Strip generation boilerplate from the 'Target' column, and drop empty, stopword, retweet and emoji targets."""
+    target = normalize.get_normalize_expr(pl.col('Target'), lowercase=False)
+    return target_df.with_columns(target).filter(~normalize.get_exclude_expr(pl.col('Target')))
 
 def _get_var_and_max_var_target(documents_df: pl.DataFrame, target_info_df: pl.DataFrame) -> pl.DataFrame:
     if 'topic_id' in target_info_df.columns:
@@ -433,17 +904,80 @@ def _get_var_and_max_var_target(documents_df: pl.DataFrame, target_info_df: pl.D
 
 
 def _filter_stance_targets(all_targets: pl.Series) -> pl.Series:
-    # lower case all results
-    all_targets = all_targets.list.eval(
-        pl.element().str.to_lowercase().str.strip_chars().str.replace('stance target: ', '').str.replace('1. ', '').str.strip_chars().str.strip_chars('"').str.strip_chars("'")
+    # lower case and normalize all results, removing exact duplicates
+    return normalize.normalize_targets(all_targets)
+
+def get_rule_triage_expr(text_column: str, min_letters: int = 10) -> pl.Expr:
+    """Get an expression that is true for documents with enough text to carry a stance.
+
+    URLs and @mentions are removed before counting letters in any script, so link, mention, 
+    emoji and short greeting posts are skipped.
+    """
+    text = pl.col(text_column).fill_null('')\
+        .str.replace_all(r'(https?://|www\.)\S+', '')\
+        .str.replace_all(r'@\w+', '')
+    return text.str.count_matches(r'\p{L}') >= min_letters
+
+def get_text_windows(texts: List[str], tokenizer, window_tokens: int, overlap_tokens: int = 64) -> pl.DataFrame:
+    """Split texts into overlapping windows of at most `window_tokens` tokens.
+
+    Windows are cut at token boundaries of the original text using the tokenizer's offset mapping, so no text is re-decoded.
+    Texts that fit in one window are kept whole.
+
+    Returns:
+        pl.DataFrame: DataFrame with the `index` of the source text, the `window` index within it, and the window `text`, in input order.
+    """
+    assert 0 <= overlap_tokens < window_tokens, "overlap_tokens must be smaller than window_tokens"
+    stride = window_tokens - overlap_tokens
+    texts = [t if t is not None else '' for t in texts]
+    all_offsets = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, verbose=False)['offset_mapping']
+
+    indices, windows, window_texts = [], [], []
+    for idx, (text, offsets) in enumerate(zip(texts, all_offsets)):
+        if len(offsets) <= window_tokens:
+            spans = [(0, len(text))]
+        else:
+            spans = [
+                (offsets[start][0], offsets[min(start + window_tokens, len(offsets)) - 1][1])
+                for start in range(0, len(offsets) - overlap_tokens, stride)
+            ]
+        for window, (start_char, end_char) in enumerate(spans):
+            indices.append(idx)
+            windows.append(window)
+            window_texts.append(text[start_char:end_char])
+
+    return pl.DataFrame(
+        {'index': indices, 'window': windows, 'text': window_texts}, 
+        schema={'index': pl.UInt32, 'window': pl.UInt32, 'text': pl.String}
     )
-    # remove exact duplicates
-    all_targets = all_targets.list.unique()
-    return all_targets
 
-def _filter_phrases(target_embeds, similarity_threshold=0.9):
+class DocumentTriageClassifier:
+    """Predicts from document embeddings whether target extraction will find any stance targets.
+
+    Fit on the outcomes of past extraction runs, e.g. `document_df['Targets'].list.len() > 0`.
+
+    Args:
+        min_prob (float): Documents with a predicted probability of having targets below this are skipped.
+    """
+    def __init__(self, min_prob: float = 0.1):
+        from sklearn.linear_model import LogisticRegression
+        self.min_prob = min_prob
+        self.model = LogisticRegression(class_weight='balanced', max_iter=1000)
+
+    def fit(self, embeddings: np.ndarray, has_targets: Union[np.ndarray, pl.Series]) -> 'DocumentTriageClassifier':
+        has_targets = np.asarray(has_targets, dtype=bool)
+        assert len(np.unique(has_targets)) == 2, "Triage classifier needs documents both with and without targets to fit"
+        self.model.fit(sklearn.preprocessing.normalize(embeddings, axis=1, norm='l2'), has_targets)
+        return self
+
+    def predict_keep(self, embeddings: np.ndarray) -> np.ndarray:
+        probs = self.model.predict_proba(sklearn.preprocessing.normalize(embeddings, axis=1, norm='l2'))
+        return probs[:, list(self.model.classes_).index(True)] >= self.min_prob
+
+def _filter_phrases(target_embeds, similarity_threshold=0.9, embedding_dtype='float32'):
     # Compute cosine similarity matrix for current sublist
-    embeddings = target_embeds.struct.field('embeddings').to_numpy()
+    # cosine similarity ignores per-vector scales, so quantized codes are compared directly
+    embeddings = np.asarray(_codes_from_storage(target_embeds.struct.field('embeddings').to_numpy(), embedding_dtype), dtype=np.float32)
     phrases_list = target_embeds.struct.field('Targets').to_list()
     norms = np.linalg.norm(embeddings, axis=1)
     similarity = np.dot(embeddings, embeddings.T) / np.outer(norms, norms)
@@ -0,0 +1,75 @@
+import json
+import os
+import types
+
+import pytest
+
+from stancemining import artifacts
+
+@pytest.fixture
+def fake_hub(tmp_path, monkeypatch):
+    monkeypatch.setenv('STANCEMINING_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.delenv('STANCEMINING_MANIFEST', raising=False)
+    monkeypatch.delenv('STANCEMINING_OFFLINE', raising=False)
+    monkeypatch.delenv('HF_HUB_OFFLINE', raising=False)
+    calls = []
+    repo_files = {
+        'org/adapter': {'metadata.json': '{"prompt": "p"}', 'adapter_config.json': '{"base_model_name_or_path": "org/base"}'},
+        'org/base': {'config.json': '{}'},
+    }
+
+    def model_info(repo_id, revision=None):
+        calls.append(('model_info', repo_id))
+        return types.SimpleNamespace(sha='abc123')
+
+    def snapshot_download(repo_id, revision=None, local_dir=None, ignore_patterns=None):
+        calls.append(('snapshot_download', repo_id))
+        for filename, content in repo_files[repo_id].items():
+            with open(os.path.join(local_dir, filename), 'w') as f:
+                f.write(content)
+        return local_dir
+
+    def hf_hub_download(repo_id, filename, local_dir=None):
+        calls.append(('hf_hub_download', repo_id))
+        path = os.path.join(local_dir, filename)
+        with open(path, 'w') as f:
+            f.write(repo_files[repo_id][filename])
+        return path
+
+    monkeypatch.setattr(artifacts.huggingface_hub, 'model_info', model_info)
+    monkeypatch.setattr(artifacts.huggingface_hub, 'snapshot_download', snapshot_download)
+    monkeypatch.setattr(artifacts.huggingface_hub, 'hf_hub_download', hf_hub_download)
+    return calls
+
+def test_resolve_model_caches_by_content(fake_hub):
+    path = artifacts.resolve_model('org/adapter')
+    assert os.path.basename(path) == artifacts.get_directory_digest(path)
+    with open(os.path.join(path, 'metadata.json')) as f:
+        assert json.load(f) == {'prompt': 'p'}
+
+    num_calls = len(fake_hub)
+    assert artifacts.resolve_model('org/adapter') == path
+    assert artifacts.resolve_file('org/adapter', 'metadata.json') == os.path.join(path, 'metadata.json')
+    assert len(fake_hub) == num_calls
+    assert artifacts.load_manifest()['repos']['org/adapter'] == {'revision': 'abc123', 'snapshot': os.path.basename(path)}
+
+def test_resolve_file_downloads_only_the_file(fake_hub):
+    path = artifacts.resolve_file('org/adapter', 'metadata.json')
+    assert fake_hub == [('hf_hub_download', 'org/adapter')]
+    assert artifacts.resolve_file('org/adapter', 'metadata.json') == path
+    assert len(fake_hub) == 1
+
+def test_offline_fails_fast(fake_hub, monkeypatch):
+    monkeypatch.setenv('STANCEMINING_OFFLINE', '1')
+    with pytest.raises(FileNotFoundError, match='stancemining prefetch org/adapter'):
+        artifacts.resolve_model('org/adapter')
+    assert fake_hub == []
+
+def test_prefetch_includes_base_model(fake_hub, monkeypatch):
+    paths = artifacts.prefetch(['org/adapter'])
+    assert len(paths) == 2
+    monkeypatch.setenv('HF_HUB_OFFLINE', '1')
+    assert artifacts.resolve_model('org/base') == paths[1]
+
+def test_local_directories_are_returned_as_is(tmp_path, fake_hub):
+    assert artifacts.resolve_model(str(tmp_path)) == str(tmp_path)
@@ -0,0 +1,43 @@
+import numpy as np
+import polars as pl
+
+from stancemining import distill
+from stancemining.llms import BaseLLM
+
+class FakeTeacher(BaseLLM):
+    def __init__(self):
+        super().__init__('fake-teacher')
+
+    def generate(self, prompts, max_new_tokens=100, num_samples=3, add_generation_prompt=True, continue_final_message=False):
+        outputs = []
+        for prompt in prompts:
+            doc = prompt[-2]
+            if 'weather' in doc:
+                outputs.append(['none'])
+            else:
+                outputs.append(['Gun Control', 'gun control\nReasoning: ...'])
+        return outputs
+
+    def score_labels(self, prompts, labels, add_generation_prompt=True, continue_final_message=False):
+        # FAVOR, AGAINST, NEUTRAL
+        return np.tile([0.1, 0.8, 0.1], (len(prompts), 1))
+
+def test_label_corpus():
+    docs = ['We need stricter gun laws.', 'The weather was nice.']
+    target_df, stance_df = distill.label_corpus(FakeTeacher(), docs)
+
+    # documents without targets are not used for training
+    assert target_df['Text'].to_list() == ['We need stricter gun laws.']
+    assert target_df['Target'].to_list() == [['gun control']]
+    assert stance_df.select(['Text', 'Target', 'Stance']).rows() == [('We need stricter gun laws.', 'gun control', 'against')]
+
+def test_sample_docs_and_split():
+    docs = [f"doc {i}" for i in range(20)] + ['doc 0', '', None]
+    sampled = distill.sample_docs(docs, 10)
+    assert len(sampled) == len(set(sampled)) == 10
+
+    df = pl.DataFrame({'Text': ['a', 'a', 'b', 'c', 'd'], 'Target': ['x', 'y', 'x', 'x', 'x']})
+    train_df, val_df = distill._split(df, 0.25, seed=0)
+    assert len(val_df) > 0
+    assert set(train_df['Text']).isdisjoint(set(val_df['Text']))
+    assert len(train_df) + len(val_df) == len(df)
@@ -0,0 +1,178 @@
+import json
+import re
+
+import polars as pl
+import torch
+
+from stancemining import finetune
+
+class CharTokenizer:
+    name_or_path = 'char-tokenizer'
+    vocab = ['<eos>', '"', ',', ' ', 'a', 'b', '\n', '", "']
+    all_special_ids = [0]
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def decode(self, token_ids):
+        return ''.join(self.vocab[i] for i in token_ids)
+
+    def batch_decode(self, sequences):
+        return [self.decode(token_ids) for token_ids in sequences]
+
+def _allowed_next(processor, generated, prompt_length=2):
+    input_ids = torch.tensor([[4] * prompt_length + generated])
+    scores = processor(input_ids, torch.zeros((1, len(CharTokenizer.vocab))))
+    return {CharTokenizer.vocab[i] for i in torch.nonzero(scores[0] > -float('inf')).flatten().tolist()}
+
+def test_quoted_list_logits_processor():
+    processor = finetune.QuotedListLogitsProcessor(CharTokenizer(), 2, [0], max_items=2)
+
+    # a list can be empty or must open with a quote
+    assert _allowed_next(processor, []) == {'<eos>', '"', '", "'}
+    # items can't be empty or contain newlines
+    assert _allowed_next(processor, [1]) == {',', ' ', 'a', 'b'}
+    # an open item can't end the sequence
+    assert '<eos>' not in _allowed_next(processor, [1, 4])
+    # a closed item can end the list or continue it
+    assert _allowed_next(processor, [1, 4, 1]) == {'<eos>', ','}
+    # once max items are reached, the list must end
+    assert _allowed_next(processor, [1, 4, 7, 5, 1]) == {'<eos>'}
+    # the second item can't be continued into a third by a multi-char token
+    assert '", "' not in _allowed_next(processor, [1, 4, 7, 5])
+
+def test_quoted_list_transitions_are_cached_per_tokenizer():
+    first = finetune._get_quoted_list_transitions(CharTokenizer(), [0])
+    # a new instance of the same tokenizer reuses the transitions
+    assert finetune._get_quoted_list_transitions(CharTokenizer(), [0])[0] is first[0]
+    assert first[0].shape == (len(finetune._LIST_STATE_TRANSITIONS), len(CharTokenizer.vocab))
+
+def test_quoted_list_regex():
+    pattern = re.compile(finetune.get_quoted_list_regex(max_items=2))
+    assert pattern.fullmatch('"gun control", "climate change"')
+    assert pattern.fullmatch('')
+    assert not pattern.fullmatch('"a", "b", "c"')
+    assert not pattern.fullmatch('"a" "b"')
+
+class WordTokenizer:
+    def __init__(self):
+        self.vocab = {}
+
+    def encode(self, text, add_special_tokens=False):
+        return [self.vocab.setdefault(word, len(self.vocab)) for word in text.split()]
+
+    def decode(self, token_ids):
+        words = {v: k for k, v in self.vocab.items()}
+        return ' '.join(words[i] for i in token_ids)
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {'input_ids': [self.encode(text) for text in texts]}
+
+    def apply_chat_template(self, messages, add_generation_prompt=True, tokenize=True):
+        # two tokens of chat template per message
+        return [token for message in messages for token in [0, 0] + self.encode(message['content'])]
+
+def test_get_label_token_ids():
+    tokenizer = WordTokenizer()
+    assert finetune.get_label_token_ids(tokenizer, ['favor', 'against']) == [[0], [1]]
+    # as a continuation, labels are tokenized after the prompt
+    assert finetune.get_label_token_ids(tokenizer, ['favor', 'neutral'], prompt_text="stance of text:") == [[0], [5]]
+
+def test_truncate_parent_texts():
+    model_config = finetune.ModelConfig(
+        model_name=None,
+        task='stance-classification',
+        prompt="Text: {text}\nTarget: {target}",
+        parent_prompt="Parents:\n{parent_chain}\nText: {text}\nTarget: {target}",
+        tokenizer=WordTokenizer()
+    )
+    processor = finetune.DataProcessor(model_config, finetune.DataConfig(dataset_name=None))
+    df = pl.DataFrame({
+        'text': ['a b c', 'a b c', 'a b c'],
+        'topic': ['t', 't', 't'],
+        'parenttexts': [[' '.join(['p1'] * 10), 'p2 p2 p2', 'p3 p3'], [' '.join(['q'] * 30)], []]
+    })
+    # budget left for parents is 40 - 12 prompt tokens - 4 text and target tokens = 24, each parent costs 5 tokens of numbering,
+    # and marking dropped parents costs 5 tokens
+    truncated_df = processor._truncate_parent_texts(df, 40)
+
+    assert truncated_df['text'].to_list() == df['text'].to_list()
+    parenttexts = truncated_df['parenttexts'].to_list()
+    # most distant parent is dropped first
+    assert parenttexts[0] == ['p2 p2 p2', 'p3 p3']
+    # nearest parent is cut when it alone is over budget
+    assert parenttexts[1] == [' '.join(['q'] * 19)]
+    assert parenttexts[2] == []
+    assert truncated_df['omittedparents'].to_list() == [1, 0, 0]
+    assert processor.truncation_report == {
+        'num_prompts_truncated': 2,
+        'num_parent_texts_dropped': 1,
+        'num_parent_tokens_cut': 10 + 11,
+    }
+
+    # kept parents are labelled by their position in the full thread, after a marker for the dropped ones
+    chain_df, text = processor._stance_prompt_expr(truncated_df)
+    prompts = chain_df.select(text.alias('prompt'))['prompt'].to_list()
+    assert prompts[0] == "Parents:\n[… 1 earlier posts omitted]\n2. [Reply to 1]: 'p2 p2 p2'\n3. [Reply to 2]: 'p3 p3'\nText: a b c\nTarget: t"
+    expected = finetune.stance_examples_to_prompt(model_config.prompt, model_config.parent_prompt, model_config.context_prompt, truncated_df.to_dict(as_series=False))
+    assert prompts == expected
+
+def test_truncate_all_parent_texts_keeps_marker():
+    model_config = finetune.ModelConfig(
+        model_name=None,
+        task='stance-classification',
+        prompt="Text: {text}\nTarget: {target}",
+        parent_prompt="Parents:\n{parent_chain}\nText: {text}\nTarget: {target}",
+        tokenizer=WordTokenizer()
+    )
+    processor = finetune.DataProcessor(model_config, finetune.DataConfig(dataset_name=None))
+    text = ' '.join(['a'] * 23)
+    df = pl.DataFrame({'text': [text], 'topic': ['t'], 'parenttexts': [['p1 p1', 'p2 p2']]})
+    # 4 tokens are left for parents, which isn't enough for a numbered line
+    truncated_df = processor._truncate_parent_texts(df, 40)
+    assert truncated_df['parenttexts'].to_list() == [[]]
+    assert truncated_df['omittedparents'].to_list() == [2]
+
+    chain_df, prompt_expr = processor._stance_prompt_expr(truncated_df)
+    prompts = chain_df.select(prompt_expr.alias('prompt'))['prompt'].to_list()
+    assert prompts == [f"Parents:\n[… 2 earlier posts omitted]\nText: {text}\nTarget: t"]
+    expected = finetune.stance_examples_to_prompt(model_config.prompt, model_config.parent_prompt, model_config.context_prompt, truncated_df.to_dict(as_series=False))
+    assert prompts == expected
+
+def test_render_messages_matches_dataset_prompts():
+    model_config = finetune.ModelConfig(
+        model_name=None,
+        task='stance-classification',
+        prompt="Text: {text}\nTarget: {target}",
+        parent_prompt="Parents:\n{parent_chain}\nText: {text}\nTarget: {target} {{literal}}",
+        context_prompt="Context: {context}\nText: {text}\nTarget: {target}",
+    )
+    processor = finetune.DataProcessor(model_config, finetune.DataConfig(dataset_name=None))
+    df = pl.DataFrame({
+        'Text': ['a', 'b', 'c', 'd'],
+        'Target': ['t1', 't2', 't3', 't4'],
+        'ParentTexts': [['p1', 'p2', 'p3'], [], ['p4'], ['p5']],
+        'Context': [None, None, '', 'ctx'],
+    })
+    messages = processor.render_messages(df, 'head', None)['messages'].to_list()
+
+    examples = processor._process_stance_classification(df, 'head').to_dict(as_series=False)
+    expected = finetune.stance_examples_to_prompt(model_config.prompt, model_config.parent_prompt, model_config.context_prompt, examples)
+    assert messages == [finetune.to_message_format(p) for p in expected]
+
+def test_load_finetuned_prompts_prefers_merged_model(tmp_path):
+    adapter_path = tmp_path / 'adapter'
+    merged_path = tmp_path / 'adapter-merged'
+    adapter_path.mkdir()
+    merged_path.mkdir()
+    (adapter_path / 'adapter_config.json').write_text('{}')
+    (adapter_path / 'metadata.json').write_text(json.dumps({'merged_model': str(merged_path)}))
+    config = {'model_path': str(adapter_path), 'classification_method': 'head', 'prompting_method': 'stancemining'}
+
+    model_save_path, _, _ = finetune.load_finetuned_prompts('stance-classification', config)
+    assert model_save_path == str(merged_path)
+    assert not finetune.is_adapter(model_save_path)
+
+    model_save_path, _, _ = finetune.load_finetuned_prompts('stance-classification', {**config, 'use_merged': False})
+    assert model_save_path == str(adapter_path)
+    assert finetune.is_adapter(model_save_path)
@@ -0,0 +1,138 @@
+import http.server
+import json
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from stancemining import llms
+
+def _vllm_output(token_logprobs):
+    logprobs = {token_id: SimpleNamespace(logprob=logprob) for token_id, logprob in token_logprobs.items()}
+    return SimpleNamespace(outputs=[SimpleNamespace(logprobs=[logprobs])])
+
+def test_logprobs_to_label_probs():
+    label_token_ids = [[5], [7, 8], [9]]
+    outputs = [
+        _vllm_output({5: np.log(0.6), 7: np.log(0.3), 9: np.log(0.1)}),
+        _vllm_output({9: np.log(0.5), 7: np.log(0.25)}),
+    ]
+    probs = llms.logprobs_to_label_probs(outputs, label_token_ids)
+
+    assert probs.shape == (2, 3)
+    np.testing.assert_allclose(probs.sum(axis=1), 1.0)
+    np.testing.assert_allclose(probs[0], [0.6, 0.3, 0.1])
+    # labels missing from the returned logprobs get no probability
+    assert probs[1, 0] == 0
+    assert np.argmax(probs[1]) == 2
+
+def test_iter_chunks():
+    prompts = (f"prompt {i}" for i in range(7))
+    chunks = list(llms.iter_chunks(prompts, 3))
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert [p for c in chunks for p in c] == [f"prompt {i}" for i in range(7)]
+    assert list(llms.iter_chunks([], 3)) == []
+
+class StandInChatHandler(http.server.BaseHTTPRequestHandler):
+    """Answers chat completions with the model id and last message, failing the first request for each message with a 503."""
+    protocol_version = 'HTTP/1.1'
+    num_requests = 0
+    seen = set()
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        StandInChatHandler.num_requests += 1
+        content = f"{payload['model']}: {payload['messages'][-1]['content']}"
+        if content not in StandInChatHandler.seen:
+            StandInChatHandler.seen.add(content)
+            self._send(503, {'error': 'busy'})
+            return
+        self._send(200, {'choices': [{'message': {'role': 'assistant', 'content': content}} for _ in range(payload['n'])]})
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stand_in_server():
+    StandInChatHandler.num_requests = 0
+    StandInChatHandler.seen = set()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInChatHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def test_openai_compatible_generate(stand_in_server):
+    pytest.importorskip('httpx')
+    llm = llms.OpenAICompatible('topic-extraction-adapter', {'base_url': stand_in_server, 'max_concurrency': 2, 'retry_backoff': 0.01})
+    prompts = [f"doc {i}" for i in range(5)]
+    outputs = llm.generate(prompts, max_new_tokens=5, num_samples=2)
+    llm.unload_model()
+
+    # every request is retried once, and outputs stay in input order
+    assert StandInChatHandler.num_requests == 10
+    assert outputs == [[f"topic-extraction-adapter: doc {i}"] * 2 for i in range(5)]
+
+def test_chat_logprobs_to_label_probs():
+    response = {'choices': [{'logprobs': {'content': [{'top_logprobs': [
+        {'token': 'token_id:5', 'logprob': np.log(0.75)},
+        {'token': 'token_id:9', 'logprob': np.log(0.25)},
+    ]}]}}]}
+    probs = llms.chat_logprobs_to_label_probs([response], [[5], [7], [9]])
+    np.testing.assert_allclose(probs[0], [0.75, 0.0, 0.25])
+
+def test_label_probs_without_label_tokens_raise():
+    # raw logprobs taken before allowed_token_ids can miss every label
+    outputs = [_vllm_output({5: np.log(0.6), 9: np.log(0.4)}), _vllm_output({1: np.log(0.9), 2: np.log(0.1)})]
+    with pytest.raises(ValueError, match="1 of 2 prompts"):
+        llms.logprobs_to_label_probs(outputs, [[5], [9]])
+
+def test_vllm_session_reuses_engine_and_switches_adapters(monkeypatch):
+    pytest.importorskip('vllm')
+    loaded = []
+    def load_stub_model(model_name, model_kwargs, sampling_param_kwargs):
+        loaded.append((model_name, model_kwargs))
+        return SimpleNamespace(model_name=model_name), None
+    monkeypatch.setattr(llms, 'load_vllm_model', load_stub_model)
+
+    session = llms.VLLMSession()
+    model_kwargs = {'task': 'generate', 'enable_lora': True}
+    llm, _ = session.get_llm('base-model', model_kwargs, {'temperature': 0.0})
+    extraction_request = session.get_lora_request('topic-extraction_adapter', '/adapters/topic-extraction')
+    same_llm, _ = session.get_llm('base-model', model_kwargs, {'temperature': 0.0})
+    stance_request = session.get_lora_request('stance-classification_adapter', '/adapters/stance-classification')
+
+    # both adapters are served by one engine, loaded once
+    assert same_llm is llm
+    assert len(loaded) == 1
+    assert loaded[0][1]['max_loras'] == 2
+    assert 'max_loras' not in model_kwargs
+    assert extraction_request.lora_int_id != stance_request.lora_int_id
+    assert session.get_lora_request('topic-extraction_adapter', '/adapters/topic-extraction').lora_int_id == extraction_request.lora_int_id
+
+    # an engine for another task is loaded alongside, with GPU memory split between them
+    classify_llm, _ = session.get_llm('stance-head', {'task': 'classify'}, {'temperature': 0.0})
+    assert len(loaded) == 2
+    assert loaded[0][1]['gpu_memory_utilization'] == loaded[1][1]['gpu_memory_utilization'] == pytest.approx(0.4)
+    # switching back between tasks reloads nothing
+    assert session.get_llm('base-model', model_kwargs, {'temperature': 0.0})[0] is llm
+    assert session.get_llm('stance-head', {'task': 'classify'}, {'temperature': 0.0})[0] is classify_llm
+    assert len(loaded) == 2
+
+    # a different base model for a task replaces only that task's engine
+    session.get_llm('other-model', model_kwargs, {'temperature': 0.0})
+    assert len(loaded) == 3
+    assert session.engines['classify'][1] is classify_llm
+
+    session.unload()
+    assert session.engines == {} and session.lora_ids == {}
@@ -1,4 +1,5 @@
 import random
+import re
 
 import numpy as np
 import polars as pl
@@ -6,7 +7,7 @@ import pytest
 from scipy.stats import dirichlet as scipy_dirichlet
 
 from stancemining.main import StanceMining
-from stancemining import metrics
+from stancemining import metrics, utils
 
 class MockTopicModel:
     def __init__(self, num_topics, **kwargs):
@@ -215,3 +216,134 @@ def test_bleu_targets():
     bleu_score = metrics.bleu_targets(doc_targets, gold_docs)
     assert 0 <= bleu_score <= 1
 
+
+class MockScoringLLM:
+    def score_labels(self, prompts, labels, **kwargs):
+        # always prefers the last label, 'NEUTRAL'
+        return np.tile(np.arange(len(labels), dtype=float), (len(prompts), 1))
+
+    def unload_model(self):
+        pass
+
+class MockCascadeStanceMining(StanceMining):
+    def _get_finetuned_stance(self, task, data, return_probs=False):
+        probs = np.array([[0.9, 0.05, 0.05], [0.4, 0.35, 0.25], [0.1, 0.8, 0.1]])[:len(data)]
+        labels = ['favor', 'against', 'neutral']
+        return [labels[i] for i in np.argmax(probs, axis=1)], probs
+
+    def _get_llm(self):
+        return MockScoringLLM()
+
+def test_stance_cascade_escalates_low_confidence_pairs():
+    miner = MockCascadeStanceMining(stance_cascade_threshold=0.5)
+    stances = miner._ask_llm_stance(['doc a', 'doc b', 'doc c'], ['x', 'y', 'z'])
+    assert stances == ['FAVOR', 'NEUTRAL', 'AGAINST']
+    assert miner.stance_cascade_report['num_pairs'] == 3
+    assert miner.stance_cascade_report['num_escalated'] == 1
+    assert miner.stance_cascade_report['escalation_rate'] == pytest.approx(1 / 3)
+    tiers = miner.stance_cascade_report['tiers']
+    assert tiers['finetuned']['num_pairs'] == 3
+    assert tiers['prompting']['num_pairs'] == 1
+    assert tiers['prompting']['model'] == miner.model_name
+    assert all(tier['seconds'] >= 0 for tier in tiers.values())
+
+def test_stance_cascade_releases_predictor_session():
+    miner = MockCascadeStanceMining(stance_cascade_threshold=0.5)
+    miner._predictor_session = StubSession()
+    session = miner._predictor_session
+    miner._ask_llm_stance(['doc a', 'doc b', 'doc c'], ['x', 'y', 'z'])
+    assert session.num_unloads == 1
+    assert miner._predictor_session is None
+
+def test_openai_compatible_kwargs_are_not_shared_between_instances():
+    StanceMining(model_inference='openai-compatible', model_kwargs={'base_url': 'http://localhost:8000'})
+    model = StanceMining(model_inference='openai-compatible')
+    assert 'base_url' not in model.stance_detection_model_kwargs
+    assert 'base_url' not in model.target_extraction_model_kwargs
+
+class StubSession:
+    def __init__(self):
+        self.num_unloads = 0
+
+    def unload(self):
+        self.num_unloads += 1
+
+class FailingExtractionStanceMining(StanceMining):
+    def _get_predictor_session(self, **kwargs):
+        self.session = StubSession()
+        return self.session
+
+    def _get_embedding_model(self):
+        return None
+
+    def get_base_targets(self, *args, **kwargs):
+        raise RuntimeError("Target extraction failed")
+
+def test_fit_transform_unloads_session_on_failure():
+    miner = FailingExtractionStanceMining()
+    with pytest.raises(RuntimeError):
+        miner.fit_transform(['doc a', 'doc b'])
+    assert miner.session.num_unloads == 1
+    assert miner._predictor_session is None
+
+class WhitespaceTokenizer:
+    def __call__(self, texts, **kwargs):
+        self.num_texts = getattr(self, 'num_texts', 0) + len(texts)
+        return {'offset_mapping': [[m.span() for m in re.finditer(r'\S+', t)] for t in texts]}
+
+class MockWindowedStanceMining(StanceMining):
+    window_stances = {'a b': 'AGAINST', 'c d': 'FAVOR', 'e f': 'NEUTRAL', 'g h': 'NEUTRAL', 'i j': 'NEUTRAL'}
+
+    def _ask_llm_stance(self, docs, stance_targets, parent_docs=None):
+        return [self.window_stances[doc] for doc in docs]
+
+def test_windowed_stance_windows_unique_documents_once():
+    miner = MockWindowedStanceMining(window_tokens=2, window_overlap_tokens=0)
+    miner._window_tokenizer = WhitespaceTokenizer()
+    docs = pl.Series(['a b c d e f', 'a b c d e f', 'g h i j'])
+    stances = miner._ask_llm_windowed_stance(docs, pl.Series(['x', 'y', 'x']))
+    assert miner._window_tokenizer.num_texts == 2
+    # one against and one favor window is a tie, which goes to the earliest window
+    assert stances == ['AGAINST', 'AGAINST', 'NEUTRAL']
+
+def test_predictor_session_splits_gpu_between_engines_it_runs():
+    # default extraction adapter generates, and default stance head classifies, so each needs its own engine
+    assert StanceMining()._get_predictor_session().num_engines == 2
+    assert StanceMining()._get_predictor_session(extract_targets=False).num_engines == 1
+    generation_stance = StanceMining(stance_detection_finetune_kwargs={'classification_method': 'generation'})
+    assert generation_stance._get_predictor_session().num_engines == 1
+
+def test_base_targets_are_normalized_once(monkeypatch):
+    from stancemining import llms, normalize
+    monkeypatch.setattr(llms, 'iter_vllm_predictions', lambda *args, **kwargs: iter([[['Stance target: Gun Control', 'the', 'gun control']], [['"climate change"']]]))
+    calls = []
+    normalize_targets = normalize.normalize_targets
+    monkeypatch.setattr(normalize, 'normalize_targets', lambda *args, **kwargs: calls.append(args) or normalize_targets(*args, **kwargs))
+    document_df = StanceMining().get_base_targets(['doc a', 'doc b'], embedding_model=object())
+    assert document_df['Targets'].to_list() == [['gun control'], ['climate change']]
+    # once per chunk of predictions, so each document's targets are normalized once
+    assert [len(args[0]) for args in calls] == [1, 1]
+
+def test_stances_are_consumed_per_chunk(monkeypatch):
+    from stancemining import llms
+    chunks = [['favor', 'against'], ['neutral']]
+    monkeypatch.setattr(llms, 'iter_vllm_predictions', lambda *args, **kwargs: iter(chunks))
+    monkeypatch.setattr(llms, 'get_vllm_predictions', None)
+    stances = StanceMining()._ask_llm_stance(['doc a', 'doc a', 'doc b'], ['x', 'y', 'z'])
+    assert stances == ['FAVOR', 'AGAINST', 'NEUTRAL']
+
+class HashEmbedder(utils.Embedder):
+    def encode(self, texts, show_progress_bar=None):
+        return np.stack([np.random.default_rng(len(t)).normal(size=384) for t in texts]).astype(np.float32)
+
+def test_large_inputs_are_embedded_to_file(monkeypatch):
+    docs = ['a', 'bb', 'ccc', 'a']
+    for embedding_dtype in ['float32', 'int8']:
+        in_memory = StanceMining(embedding_dtype=embedding_dtype)._get_embeddings(docs, model=HashEmbedder())
+        miner = StanceMining(embedding_dtype=embedding_dtype, embedding_file_min_texts=2)
+        embedder = HashEmbedder()
+        encode_to_file = embedder.encode_to_file
+        paths = []
+        monkeypatch.setattr(embedder, 'encode_to_file', lambda texts, path, **kwargs: paths.append(path) or encode_to_file(texts, path, **kwargs))
+        np.testing.assert_array_equal(miner._get_embeddings(docs, model=embedder), in_memory)
+        assert len(paths) == 1
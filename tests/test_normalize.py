@@ -0,0 +1,33 @@
+import polars as pl
+
+from stancemining import normalize, prompting, utils
+
+def test_stopwords_are_bundled():
+    stopwords = normalize.get_stopwords()
+    assert 'the' in stopwords and 'avec' in stopwords
+    # read once per process
+    assert normalize.get_stopwords() is stopwords
+
+def test_normalize_targets():
+    targets = pl.Series('Targets', [
+        ['Stance target: Gun Control', '"gun control"', '1. climate change', 'the'],
+        ['rt @user', '😀😀', 'the primary stance target is: universal basic income', None],
+        [],
+    ])
+    normalized = normalize.normalize_targets(targets)
+    assert normalized.name == 'Targets'
+    assert normalized.to_list() == [['gun control', 'climate change'], ['universal basic income'], []]
+
+def test_call_sites_share_rules():
+    target_df = pl.DataFrame({'ID': [0, 1, 2, 3], 'Target': ['stance target: Gun Control', 'url', 'et', "'climate change':"]})
+    assert utils.remove_bad_targets(target_df)['Target'].to_list() == ['Gun Control', 'climate change']
+
+    assert utils._filter_stance_targets(pl.Series('Targets', [['Gun Control', 'gun control ']])).to_list() == [['gun control']]
+
+    # case is kept, e.g. for generalized claims
+    outputs = prompting.parse_generated_targets(['Renewable Energy Subsidies', 'none', '', 'Renewable Energy Subsidies', 'resistance movements'])
+    assert outputs == ['Renewable Energy Subsidies', 'resistance movements']
+
+def test_retweet_markers_only_match_whole_words():
+    targets = ['rt @user', 'RT someone', '@rt', 'support groups', 'airport security', 'art history', 'heart disease']
+    assert normalize.normalize_targets(targets).to_list() == ['support groups', 'airport security', 'art history', 'heart disease']
@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import numpy as np
+import polars as pl
+import pytest
+
+from stancemining import serve
+
+def test_micro_batcher_coalesces_concurrent_requests():
+    batches = []
+    def batch_fn(items):
+        batches.append(list(items))
+        return [i * 2 for i in items]
+
+    batcher = serve.MicroBatcher(batch_fn, max_batch_size=100, max_wait_ms=500)
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(batcher.submit, [[1, 2], [3], [4, 5, 6], [7]]))
+    batcher.stop()
+
+    # each request gets back its own results, in order
+    assert results == [[2, 4], [6], [8, 10, 12], [14]]
+    assert len(batches) < 4
+    assert sorted(i for batch in batches for i in batch) == [1, 2, 3, 4, 5, 6, 7]
+
+def test_micro_batcher_runs_full_batches_without_waiting():
+    batcher = serve.MicroBatcher(lambda items: items, max_batch_size=2, max_wait_ms=10000)
+    start_time = time.monotonic()
+    assert batcher.submit(['a', 'b']) == ['a', 'b']
+    assert time.monotonic() - start_time < 5
+    batcher.stop()
+
+def test_micro_batcher_propagates_errors():
+    def batch_fn(items):
+        raise ValueError("model failed")
+
+    batcher = serve.MicroBatcher(batch_fn, max_wait_ms=1)
+    with pytest.raises(ValueError, match="model failed"):
+        batcher.submit(['a'])
+    batcher.stop()
+
+class FakeStanceMining:
+    llm_method = 'finetuned'
+    _predictor_session = None
+
+    def _get_predictor_session(self):
+        return None
+
+    def _get_embedding_model(self):
+        return self
+
+    def encode(self, texts, show_progress_bar=None):
+        return np.array([[len(t), 1.0] for t in texts])
+
+    def _ask_llm_stance_target(self, docs):
+        return [[doc.split()[0]] for doc in docs]
+
+    def _ask_llm_stance(self, docs, stance_targets, parent_docs=None):
+        return ['FAVOR' if target in doc else 'NEUTRAL' for doc, target in zip(docs, stance_targets)]
+
+def test_server_and_client():
+    server = serve.StanceMiningServer(FakeStanceMining(), port=0, max_wait_ms=1)
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.httpd.server_address[:2]
+    client = serve.StanceMiningClient(f"http://{host}:{port}")
+
+    assert client.extract_targets(pl.Series(['guns are bad', 'taxes are good'])) == [['guns'], ['taxes']]
+    assert client.classify_stance(['guns are bad', 'taxes are good'], ['guns', 'climate']) == ['FAVOR', 'NEUTRAL']
+    np.testing.assert_allclose(client.encode(['ab', 'abc']), [[2, 1], [3, 1]])
+
+    server.httpd.shutdown()
+    server.shutdown()
@@ -1,7 +1,10 @@
+import re
 import time
 
 from sentence_transformers import SentenceTransformer
 import numpy as np
+import polars as pl
+import pytest
 
 from stancemining import utils
 
@@ -31,5 +34,221 @@ def test_propagate_clusters():
     print(f"Propagation took {end_time - start_time:.4f} seconds")
     assert np.asarray(cluster_labels) == np.array([0, 1, 0, 3, 0])
 
+def test_rule_triage_expr():
+    df = pl.DataFrame({'text': [
+        'https://t.co/abc123',
+        '@someone 😂😂😂',
+        'thanks!',
+        None,
+        'Carbon taxes are the only credible path to cutting emissions.',
+        '我们必须反对这项新的住房政策',
+    ]})
+    keep = df.select(utils.get_rule_triage_expr('text'))['text'].to_list()
+    assert keep == [False, False, False, False, True, True]
+
+def test_document_triage_classifier():
+    rng = np.random.default_rng(0)
+    embeddings = np.concatenate([rng.normal(1, 0.1, (20, 4)), rng.normal(-1, 0.1, (20, 4))])
+    has_targets = np.array([True] * 20 + [False] * 20)
+    classifier = utils.DocumentTriageClassifier(min_prob=0.5).fit(embeddings, has_targets)
+    assert (classifier.predict_keep(embeddings) == has_targets).all()
+
+def test_connected_components_is_transitive():
+    # 0-1 and 1-3 are connected through 1, 2 and 4 are singletons
+    labels = utils._connected_components(5, [0, 3, 2], [1, 1, 2])
+    assert labels[0] == labels[1] == labels[3]
+    assert len({labels[0], labels[2], labels[4]}) == 3
+    assert sorted(set(labels)) == [0, 1, 2]
+
+def test_exact_clustering_matches_brute_force():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(5, 8))
+    embeddings = np.concatenate([center + rng.normal(scale=0.05, size=(10, 8)) for center in centers])
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    distances = np.linalg.norm(embeddings[:, None] - embeddings[None], axis=-1)
+    rows, cols = np.nonzero(distances < 0.3)
+    expected = utils._connected_components(len(embeddings), rows, cols)
+
+    # small blocks and edge budget exercise tiling and edge compaction
+    for kwargs in [{}, {'max_block_bytes': 7 * 7 * 4, 'max_edges': 5}]:
+        labels = utils._exact_clustering(embeddings, max_distance=0.3, verbose=False, **kwargs)
+        assert (labels == expected).all()
+
+        labels = utils._sharded_exact_clustering(embeddings, max_distance=0.3, num_workers=2, verbose=False, **kwargs)
+        assert (labels == expected).all()
+
+def test_embedding_buffer_shares_memory():
+    embeddings = np.arange(12, dtype=np.float32).reshape(4, 3)
+    buffer = utils.EmbeddingBuffer(embeddings)
+    assert np.shares_memory(buffer.numpy(), embeddings)
+    assert buffer.torch().data_ptr() == embeddings.ctypes.data
+    # numpy views can't write through to the shared memory
+    with pytest.raises(ValueError):
+        buffer.numpy()[0, 0] = 1
+    assert embeddings.flags.writeable
+
+    series = buffer.to_polars('embedding')
+    assert series.dtype == pl.Array(pl.Float32, 3)
+    assert series.to_list() == embeddings.tolist()
+    assert np.shares_memory(utils.EmbeddingBuffer.from_polars(series).numpy(), embeddings)
+
+    codes = np.ones((2, 3), dtype=np.int8)
+    assert utils.EmbeddingBuffer(codes, dtype=None).to_polars().dtype == pl.Array(pl.Int8, 3)
+
+def test_quantized_embeddings():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(50, 16)).astype(np.float32)
+    for embedding_dtype, code_dtype, atol in [('float16', np.float16, 1e-2), ('int8', np.int8, 5e-2)]:
+        quantized = utils.quantize_embeddings(embeddings, embedding_dtype)
+        assert quantized.codes.dtype == code_dtype
+        assert quantized.nbytes < embeddings.nbytes
+        np.testing.assert_allclose(quantized.dequantize(), embeddings, atol=atol)
+        np.testing.assert_allclose(quantized[10:20], embeddings[10:20], atol=atol)
+        codes = utils._codes_from_storage(utils._codes_to_storage(quantized.codes), embedding_dtype)
+        assert (codes == quantized.codes).all()
+
+def test_quantized_exact_clustering():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(5, 8))
+    embeddings = np.concatenate([center + rng.normal(scale=0.05, size=(10, 8)) for center in centers])
+    expected = utils._exact_clustering(embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True), max_distance=0.3, verbose=False)
+
+    for embedding_dtype in ['float16', 'int8']:
+        labels = utils.cluster_target_embeddings(embeddings, max_distance=0.3, method='exact', embedding_dtype=embedding_dtype)
+        assert (labels == expected).all()
+        labels = utils.cluster_target_embeddings(embeddings, max_distance=0.3, method='exact', num_workers=2, embedding_dtype=embedding_dtype)
+        assert (labels == expected).all()
+
+        report = utils.measure_quantized_recall(embeddings, max_distance=0.3, embedding_dtype=embedding_dtype)
+        assert report['num_pairs'] > 0
+        assert report['recall'] > 0.95 and report['precision'] > 0.95
+
+def test_embedding_reducer():
+    rng = np.random.default_rng(0)
+    # embeddings that vary in 8 of 64 dimensions
+    embeddings = rng.normal(size=(200, 8)) @ rng.normal(size=(8, 64))
+    reducer = utils.EmbeddingReducer(method='pca', n_components=8)
+    reduced = reducer.reduce(embeddings)
+    assert reduced.shape == (200, 8)
+    np.testing.assert_allclose(np.linalg.norm(reduced, axis=1), 1, rtol=1e-5)
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.testing.assert_allclose(reduced @ reduced.T, normalized @ normalized.T, atol=1e-4)
+
+    matryoshka_reducer = utils.EmbeddingReducer(method='matryoshka', n_components=16)
+    assert matryoshka_reducer.reduce(embeddings).shape == (200, 16)
+
+def test_calibrate_embedding_reduction():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(5, 64))
+    embeddings = np.concatenate([center + rng.normal(scale=0.05, size=(10, 64)) for center in centers])
+    report = utils.calibrate_embedding_reduction(embeddings, max_distance=0.3)
+    assert report['n_components'].to_list() == [32]
+    assert report['recall'][0] > 0.9
+    assert report['adjusted_rand_index'][0] > 0.9
+
+def test_minhash_clustering():
+    target_df = pl.DataFrame({'Target': [
+        'climate change policy', 
+        'gun control', 
+        'the climate change policy', 
+        'universal basic income', 
+        'Gun Control',
+        '',
+    ]})
+    labels = utils._minhash_clustering(target_df, threshold=0.7)
+    assert labels[0] == labels[2]
+    assert labels[1] == labels[4]
+    assert len({labels[0], labels[1], labels[3], labels[5]}) == 4
+
+def test_minhash_signatures_estimate_jaccard():
+    targets = pl.Series(['abcdefghij', 'abcdefghik'])
+    signatures = utils._minhash_signatures(targets, num_perm=256)
+    # 7 of the 9 distinct shingles are shared
+    assert abs((signatures[0] == signatures[1]).mean() - 7 / 9) < 0.1
+
+def test_lsh_params():
+    num_bands, num_rows = utils._lsh_params(0.7, 128)
+    assert num_bands * num_rows <= 128
+    assert 0.5 < (1 / num_bands) ** (1 / num_rows) < 0.9
+
+class LengthEmbedder(utils.Embedder):
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, texts, show_progress_bar=None):
+        self.batches.append(texts)
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+class ClusterEmbedder(utils.Embedder):
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        self.centers = rng.normal(size=(5, 8))
+        self.rng = rng
+
+    def encode(self, texts, show_progress_bar=None):
+        return np.array([self.centers[int(t.split()[0])] + self.rng.normal(scale=0.05, size=8) for t in texts], dtype=np.float32)
+
+def test_sharded_similar_target_mapper_matches_one_process():
+    target_df = pl.DataFrame({'Target': [f"{i % 5} target {i}" for i in range(50)], 'count': list(range(50))})
+    for embedding_dtype in ['float32', 'int8']:
+        mappers = [
+            utils._get_similar_target_mapper(target_df, ClusterEmbedder(), max_distance=0.3, method='exact', num_workers=num_workers, embedding_dtype=embedding_dtype)
+            for num_workers in [1, 2]
+        ]
+        assert mappers[0] == mappers[1]
+        # each cluster maps to its most common target
+        assert mappers[0]['0 target 0'] == '0 target 45'
+
+def test_encode_to_file_keeps_input_order(tmp_path):
+    texts = ['ccc', 'a', 'bbbb', 'dd', None]
+    embedder = LengthEmbedder()
+    path = str(tmp_path / 'embeddings.npy')
+    embeddings = embedder.encode_to_file(texts, path, batch_size=2)
+    # batches are sorted by length
+    assert embedder.batches == [['', 'a'], ['dd', 'ccc'], ['bbbb']]
+    np.testing.assert_array_equal(np.load(path, mmap_mode='r')[:, 0], [3, 1, 4, 2, 0])
+    assert embeddings.shape == (5, 2)
+    assert embedder.encode_report['num_texts'] == 5
+
+class CountingTokenizer:
+    def __init__(self):
+        self.num_calls = 0
+
+    def __call__(self, texts, add_special_tokens=True, **kwargs):
+        self.num_calls += 1
+        return {'input_ids': [([0] if add_special_tokens else []) + [len(w) for w in t.split()] for t in texts]}
+
+class TokenIdEmbedder(utils.Embedder):
+    can_encode_token_ids = True
+
+    def __init__(self):
+        self.tokenizer = CountingTokenizer()
+
+    def get_tokenizer(self):
+        return self.tokenizer
+
+    def encode(self, texts, show_progress_bar=None):
+        return self.encode_token_ids(self.tokenizer(texts)['input_ids'])
+
+    def encode_token_ids(self, token_ids, show_progress_bar=None):
+        return np.array([[len(ids), sum(ids)] for ids in token_ids], dtype=np.float32)
+
+def test_encode_to_file_tokenizes_once(tmp_path):
+    texts = ['a bb ccc', 'dddd', 'e ff']
+    embedder = TokenIdEmbedder()
+    embeddings = embedder.encode_to_file(texts, str(tmp_path / 'embeddings.npy'), batch_size=2)
+    assert embedder.tokenizer.num_calls == 1
+    np.testing.assert_array_equal(embeddings, embedder.encode(texts))
+
+class WhitespaceTokenizer:
+    def __call__(self, texts, **kwargs):
+        return {'offset_mapping': [[m.span() for m in re.finditer(r'\S+', t)] for t in texts]}
+
+def test_get_text_windows():
+    window_df = utils.get_text_windows(['a b c d e f g', 'short text', None], WhitespaceTokenizer(), window_tokens=3, overlap_tokens=1)
+    assert window_df['index'].to_list() == [0, 0, 0, 1, 2]
+    assert window_df['window'].to_list() == [0, 1, 2, 0, 0]
+    assert window_df['text'].to_list() == ['a b c', 'c d e', 'e f g', 'short text', '']
+
 if __name__ == '__main__':
     test_propagate_clusters()